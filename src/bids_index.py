@@ -0,0 +1,232 @@
+'''
+Index of the files in a BIDS dataset (saved as JSON next to the dataset), so paths are looked up instead of found by listing directories.
+Only directories that changed since they were indexed are listed again.
+'''
+import pathlib
+import json
+import re
+import fcntl
+
+from cache import write_atomic
+
+# directories of a subject that are indexed (location -> directory relative to the dataset root)
+SUBJECT_DIRS = {
+    "raw/func": "sub-{subject}/func",
+    "derivatives/func": "derivatives/sub-{subject}/func",
+    "derivatives/anat": "derivatives/sub-{subject}/anat",
+}
+
+# indexes loaded in this process (index path -> index)
+LOADED_INDEXES = {}
+
+def default_index_path(bids_path:pathlib.Path):
+    '''
+    Path of the index of a dataset if none is given (a hidden file next to the dataset, e.g., .BIDS_2023E_index.json).
+    '''
+    bids_path = pathlib.Path(bids_path)
+
+    return bids_path.parent / f".{bids_path.name}_index.json"
+
+def parse_bids_name(name:str):
+    '''
+    Split a BIDS file name into its entities, suffix and extension
+    (e.g., "sub-0116_task-boldinnerspeech_run-1_events.tsv" -> {"sub": "0116", "task": "boldinnerspeech", "run": "1"}, "events", ".tsv").
+    '''
+    parts = name.split("_")
+    suffix, _, ext = parts[-1].partition(".")
+    entities = dict(part.split("-", 1) for part in parts[:-1] if "-" in part)
+
+    return entities, suffix, f".{ext}" if ext else ""
+
+def lookup_key(location:str, suffix:str, ext:str, space:str=None, desc:str=None):
+    '''
+    Key of a group of files in the lookup table of a subject (e.g., "derivatives/func|bold|.nii.gz|MNI152NLin2009cAsym|preproc").
+    '''
+    return "|".join([location, suffix, ext, space or "", desc or ""])
+
+def list_dir(dir_path:pathlib.Path):
+    '''
+    List a directory and record its modification time (a missing directory is indexed as empty).
+    '''
+    try:
+        mtime_ns = dir_path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return {"mtime_ns": None, "files": []}
+
+    return {"mtime_ns": mtime_ns, "files": sorted(path.name for path in dir_path.iterdir())}
+
+def dir_changed(dir_path:pathlib.Path, listing:dict):
+    '''
+    Check if a directory changed since it was listed (one stat instead of a listing).
+    '''
+    try:
+        return dir_path.stat().st_mtime_ns != listing["mtime_ns"]
+    except FileNotFoundError:
+        return listing["mtime_ns"] is not None
+
+def index_subject(bids_path:pathlib.Path, subject:str, subject_index:dict=None):
+    '''
+    Index the files of a subject. Directories that did not change since they were indexed in subject_index are not listed again.
+
+    Returns
+        subject_index: dictionary with the listings of the directories "dirs" and the lookup table "files"
+                       (lookup key -> run -> file paths relative to the dataset root)
+    '''
+    dirs = dict(subject_index["dirs"]) if subject_index is not None else {}
+
+    for location, rel_dir in SUBJECT_DIRS.items():
+        dir_path = bids_path / rel_dir.format(subject=subject)
+
+        if location not in dirs or dir_changed(dir_path, dirs[location]):
+            dirs[location] = list_dir(dir_path)
+
+    # lookup table of all files
+    files = {}
+
+    for location, listing in dirs.items():
+        rel_dir = SUBJECT_DIRS[location].format(subject=subject)
+
+        for name in listing["files"]:
+            entities, suffix, ext = parse_bids_name(name)
+            key = lookup_key(location, suffix, ext, entities.get("space"), entities.get("desc"))
+            files.setdefault(key, {}).setdefault(entities.get("run", ""), []).append(f"{rel_dir}/{name}")
+
+    return {"dirs": dirs, "files": files}
+
+def read_bids_index(index_path:pathlib.Path):
+    '''
+    Read an index from disk (an empty index if it does not exist or is unreadable).
+    '''
+    try:
+        with open(index_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"root": {"mtime_ns": None, "files": []}, "subjects": {}}
+
+def save_bids_index(index:dict, index_path:pathlib.Path, subjects:list=[]):
+    '''
+    Save an index (JSON). Other processes may have saved the index since it was loaded, so the index on disk is
+    read again under a lock and only the root listing and the given subjects are replaced.
+
+    Args
+        index: index in memory (see load_bids_index)
+        index_path: path of the index
+        subjects: IDs of the subjects that were (re)indexed
+
+    Returns
+        index: the merged index
+    '''
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(index_path.parent / f"{index_path.name}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        merged = read_bids_index(index_path)
+        merged["root"] = index["root"]
+        merged["subjects"].update({subject: index["subjects"][subject] for subject in subjects})
+
+        write_atomic(index_path, json.dumps(merged).encode())
+
+    return merged
+
+def load_bids_index(bids_path:pathlib.Path, index_path:pathlib.Path=None):
+    '''
+    Load the index of a dataset (from memory if it was loaded before in this process, otherwise from disk),
+    and update the list of subjects if the dataset root changed. A new index is made if none exists.
+
+    Args
+        bids_path: path to bids directory (root)
+        index_path: path of the index. If None, see default_index_path
+
+    Returns
+        index: dictionary with the listing of the dataset root "root" and the index of every subject that was looked up "subjects"
+    '''
+    bids_path = pathlib.Path(bids_path)
+    index_path = pathlib.Path(index_path) if index_path is not None else default_index_path(bids_path)
+
+    index = LOADED_INDEXES.get(index_path)
+
+    if index is None:
+        index = read_bids_index(index_path)
+
+    # subjects added or removed
+    if index["root"]["mtime_ns"] is None or dir_changed(bids_path, index["root"]):
+        index["root"] = list_dir(bids_path)
+        index = save_bids_index(index, index_path)
+
+    LOADED_INDEXES[index_path] = index
+
+    return index
+
+def list_subjects(bids_path:pathlib.Path, exclude_subjects:list=[], index_path:pathlib.Path=None):
+    '''
+    Get the IDs of all subjects in a dataset that have preprocessed data (e.g., ["0116", "0117", ...]).
+    Subjects without a folder in derivatives are left out.
+
+    Args
+        bids_path: path to bids directory (root)
+        exclude_subjects: IDs of subjects to leave out (e.g., ["0119"])
+        index_path: path of the index (see load_bids_index)
+    '''
+    bids_path = pathlib.Path(bids_path)
+    index = load_bids_index(bids_path, index_path)
+
+    subjects = [name[4:] for name in index["root"]["files"] if re.fullmatch(r"sub-[^._]+", name)]
+    subjects = [subject for subject in subjects if (bids_path / "derivatives" / f"sub-{subject}").is_dir()]
+
+    return [subject for subject in subjects if subject not in exclude_subjects]
+
+def subject_files(bids_path:pathlib.Path, subject:str, index_path:pathlib.Path=None):
+    '''
+    Get the lookup table of the files of a subject (indexed the first time a subject is looked up, updated if its directories changed).
+
+    Returns
+        files: lookup table of the subject (see index_subject)
+    '''
+    bids_path = pathlib.Path(bids_path)
+    index_path = pathlib.Path(index_path) if index_path is not None else default_index_path(bids_path)
+
+    index = load_bids_index(bids_path, index_path)
+    subject_index = index["subjects"].get(subject)
+
+    # (re)index the subject if it is new or one of its directories changed
+    if subject_index is None or any(dir_changed(bids_path / SUBJECT_DIRS[location].format(subject=subject), listing) for location, listing in subject_index["dirs"].items()):
+        index["subjects"][subject] = index_subject(bids_path, subject, subject_index)
+        index = save_bids_index(index, index_path, subjects=[subject])
+        LOADED_INDEXES[index_path] = index
+
+    return index["subjects"][subject]["files"]
+
+def find_paths(bids_path:pathlib.Path, subject:str, location:str, suffix:str, ext:str, space:str=None, desc:str=None, runs:list=None, task:str=None, echo:str=None, index_path:pathlib.Path=None):
+    '''
+    Find the files of a subject (sorted by run).
+
+    Args
+        bids_path: path to bids directory (root)
+        subject: ID of subject (e.g., "0116")
+        location: "raw/func", "derivatives/func" or "derivatives/anat"
+        suffix, ext, space, desc: BIDS suffix, extension, space and desc of the files (e.g., "bold", ".nii.gz", "MNI152NLin2009cAsym", "preproc")
+        runs: runs to get (e.g., range(1, 7)). If None, all runs
+        task, echo: task and echo of the files (e.g., "boldinnerspeech", "1"). If None, files of any task and echo
+        index_path: path of the index (see load_bids_index)
+
+    Returns
+        paths: list of paths
+    '''
+    bids_path = pathlib.Path(bids_path)
+    files_per_run = subject_files(bids_path, subject, index_path).get(lookup_key(location, suffix, ext, space, desc), {})
+
+    if runs is not None:
+        files_per_run = {run: files for run, files in files_per_run.items() if run.isdigit() and int(run) in runs}
+
+    # sort by run number (files without run first)
+    sorted_runs = sorted(files_per_run, key=lambda run: int(run) if run.isdigit() else -1)
+
+    paths = [bids_path / file for run in sorted_runs for file in sorted(files_per_run[run])]
+
+    # filter on the entities that are not part of the lookup key (e.g., one echo of multi-echo data)
+    for entity, value in [("task", task), ("echo", echo)]:
+        if value is not None:
+            paths = [path for path in paths if parse_bids_name(path.name)[0].get(entity) == str(value)]
+
+    return paths
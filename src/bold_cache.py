@@ -0,0 +1,199 @@
+'''
+Cache of decompressed BOLD runs (float32, masked, memory-mapped) for repeated first level fits.
+'''
+import pathlib, os
+import json
+import shutil
+
+import numpy as np
+import nibabel as nib
+
+from nibabel.fileslice import canonical_slicers
+
+from cache import hash_file, hash_params, hash_array, evict_lru, touch, pin, unpin
+from ingest import probe_image
+
+def bold_cache_key(bold_path:pathlib.Path, mask:np.ndarray, cache_dir:pathlib.Path):
+    '''
+    Key of a run in the cache (content hash of the BOLD file, memoized in the cache, and hash of the mask).
+    '''
+    return hash_params({"bold": hash_file(bold_path, memo_dir=cache_dir), "mask": hash_array(mask)})
+
+def save_bold_entry(bold_img, mask:np.ndarray, entry_path:pathlib.Path):
+    '''
+    Decompress a run one scan at a time and save the voxels in the mask (written to a temporary folder and renamed).
+    '''
+    tmp_path = entry_path.with_name(f".{entry_path.name}.{os.getpid()}.tmp")
+    tmp_path.mkdir(parents=True, exist_ok=True)
+
+    n_scans = bold_img.shape[3]
+    data = np.lib.format.open_memmap(tmp_path / "data.npy", mode="w+", dtype=np.float32, shape=(n_scans, int(mask.sum())))
+
+    for scan in range(n_scans):
+        data[scan] = np.asarray(bold_img.dataobj[..., scan], dtype=np.float32)[mask]
+
+    data.flush()
+    del data
+
+    np.save(tmp_path / "voxels.npy", np.flatnonzero(mask))
+
+    with open(tmp_path / "header.json", "w") as f:
+        json.dump({"shape": list(bold_img.shape), "affine": bold_img.affine.tolist(), "zooms": [float(zoom) for zoom in bold_img.header.get_zooms()]}, f)
+
+    try:
+        os.rename(tmp_path, entry_path)
+    except OSError: # written by another process in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+class MaskedArrayProxy:
+    '''
+    Array proxy of a cached run (see nibabel.arrayproxy). The data is read from the memory-mapped masked data when it is accessed.
+    '''
+    is_proxy = True
+
+    def __init__(self, entry_path:pathlib.Path, shape:tuple):
+        self.entry_path = pathlib.Path(entry_path)
+        self.shape = tuple(shape)
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(np.float32)
+
+        # the data is stored unscaled (nilearn checks the scaling of proxies to get the dtype of the data)
+        self.slope = 1.0
+        self.inter = 0.0
+
+    def __array__(self, dtype=None, copy=None):
+        volumes = self.dense()
+
+        return volumes if dtype is None else volumes.astype(dtype)
+
+    def __getitem__(self, slicer):
+        '''
+        Read a part of the run (e.g., proxy[..., 0] for the first scan). Only the requested scans are read from the memory-mapped data
+        and only the requested voxels are filled in.
+        '''
+        # fancy indexing and new axes are left to numpy (on the full volumes)
+        try:
+            slicers = canonical_slicers(slicer, self.shape)
+        except ValueError:
+            return self.dense()[slicer]
+
+        if not all(isinstance(s, (slice, int, np.integer)) for s in slicers):
+            return self.dense()[slicer]
+
+        data = np.load(self.entry_path / "data.npy", mmap_mode="r")
+        voxels = np.load(self.entry_path / "voxels.npy")
+
+        # column of every voxel of the volume in the masked data (-1 outside the mask)
+        columns = np.full(int(np.prod(self.shape[:3])), -1, dtype=np.int64)
+        columns[voxels] = np.arange(len(voxels))
+        columns = columns.reshape(self.shape[:3])[tuple(slicers[:3])]
+
+        # requested scans (scans x voxels in the mask)
+        scans = np.arange(self.shape[3])[slicers[3]]
+        rows = data[np.atleast_1d(scans)]
+
+        inside = columns >= 0
+        volumes = np.zeros(columns.shape + (rows.shape[0],), dtype=np.float32)
+        volumes[inside] = rows[:, columns[inside]].T
+
+        return volumes[..., 0] if np.ndim(scans) == 0 else volumes
+
+    def dense(self):
+        '''
+        All volumes of the run (x, y, z, scans). FirstLevelModel.fit reads the run this way and keeps the volumes in the image for the whole fit, 
+        so the cache saves the decompression but not memory (the peak is about one run higher than when the run is read from its file).
+        '''
+        data = np.load(self.entry_path / "data.npy", mmap_mode="r")
+        voxels = np.load(self.entry_path / "voxels.npy")
+
+        # scans x voxels -> (x, y, z, scans), without copying the scan axis to the end
+        volumes = np.zeros((self.shape[3], int(np.prod(self.shape[:3]))), dtype=np.float32)
+        volumes[:, voxels] = data
+
+        return np.moveaxis(volumes.reshape(self.shape[3], *self.shape[:3]), 0, -1)
+
+def load_bold_entry(entry_path:pathlib.Path):
+    '''
+    Load a run from the cache as a Nifti image (zero outside the mask). The data is read lazily (see MaskedArrayProxy).
+    '''
+    with open(entry_path / "header.json") as f:
+        header = json.load(f)
+
+    img = nib.Nifti1Image(MaskedArrayProxy(entry_path, header["shape"]), np.array(header["affine"]))
+    img.header.set_zooms(header["zooms"])
+
+    return img
+
+def cached_bold(bold_path:pathlib.Path, mask_img, cache_dir:pathlib.Path, max_bytes:int=None):
+    '''
+    Get a BOLD run through the cache (decompressed and cached the first time, memory-mapped afterwards).
+
+    Args
+        bold_path: path to the (gzipped) BOLD series
+        mask_img: mask of the subject (the mask of the first level model). Only the voxels in the mask are cached
+        cache_dir: path to the cache
+        max_bytes: maximum size of the cache in bytes (least recently used runs are evicted). If None, the cache is unbounded
+
+    Returns
+        img: Nifti image of the run (same values as the BOLD series within the mask, as float32). The entry is pinned until release_runs is called.
+             The path itself if there is no mask or the mask is not on the grid of the run (the first level model would then compute its own mask or resample the run, which uses voxels outside the mask)
+    '''
+    if mask_img is None:
+        return bold_path
+
+    bold_img = nib.load(bold_path)
+    mask_img = nib.load(mask_img) if isinstance(mask_img, (str, pathlib.Path)) else mask_img
+
+    if mask_img.shape[:3] != bold_img.shape[:3] or not np.allclose(mask_img.affine, bold_img.affine):
+        return bold_path
+
+    mask = np.asarray(mask_img.dataobj) != 0
+
+    cache_dir = pathlib.Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    key = bold_cache_key(bold_path, mask, cache_dir)
+    entry_path = cache_dir / key
+
+    # pin before checking the entry, so it cannot be evicted after the check
+    pin(cache_dir, key)
+
+    if (entry_path / "header.json").exists():
+        touch(entry_path)
+    else:
+        save_bold_entry(bold_img, mask, entry_path)
+
+        if max_bytes is not None:
+            evict_lru(cache_dir, max_bytes, keep=[key])
+
+    return load_bold_entry(entry_path)
+
+def cached_runs(bold_paths:list, mask_img, cache_dir:pathlib.Path=None, max_bytes:int=None):
+    '''
+    Get all runs of a subject through the cache (see cached_bold). If cache_dir is None, the paths are returned as they are (the runs are read from the BOLD files).
+    '''
+    if cache_dir is None:
+        return list(bold_paths)
+
+    run_imgs = [cached_bold(path, mask_img, cache_dir) for path in bold_paths]
+
+    # evict once all runs are cached, so no run of the subject is evicted before it is read
+    if max_bytes is not None:
+        evict_lru(cache_dir, max_bytes, keep=[img.dataobj.entry_path.name for img in run_imgs if isinstance(img, nib.Nifti1Image)])
+
+    return run_imgs
+
+def release_runs(run_imgs:list):
+    '''
+    Unpin the cached runs once the model that reads them is fitted (see cached_bold). Paths are skipped.
+    '''
+    for img in run_imgs:
+        if isinstance(img, nib.Nifti1Image) and isinstance(img.dataobj, MaskedArrayProxy):
+            unpin(img.dataobj.entry_path.parent, img.dataobj.entry_path.name)
+
+def mapped_bytes(bold_paths:list, table_cache:pathlib.Path=None):
+    '''
+    Upper bound of the bytes memory-mapped when the runs are read through the cache (float32 volumes, from the headers only, see ingest.probe_image).
+    Used to budget the address space of the workers (see workers.limit_worker_memory).
+    '''
+    return sum(4 * int(np.prod(probe_image(path, table_cache)["shape"])) for path in bold_paths)
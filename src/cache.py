@@ -0,0 +1,288 @@
+'''
+Content-addressed on-disk cache (used to skip refitting models and recomputing results when their inputs have not changed)
+'''
+import pathlib, os
+import hashlib
+import json
+import pickle
+import shutil
+import fcntl
+
+import numpy as np
+
+def hash_file(path:pathlib.Path, memo_dir:pathlib.Path=None, chunk_size:int=2**20):
+    '''
+    Hash the content of a file.
+
+    Args
+        path: path to file
+        memo_dir: if specified, the hash is memoized here (keyed by path, size and modification time) so unchanged files are only read once
+        chunk_size: number of bytes read at a time
+
+    Returns
+        digest: hex digest of the file content
+    '''
+    path = pathlib.Path(path)
+
+    # check if the file has already been hashed
+    if memo_dir is not None:
+        stat = path.stat()
+        memo_key = hash_params([str(path.resolve()), stat.st_size, stat.st_mtime_ns])
+        memo_file = pathlib.Path(memo_dir) / "file_hashes" / f"{memo_key}.txt"
+
+        try:
+            digest = memo_file.read_text()
+            touch(memo_file)
+            return digest
+        except FileNotFoundError:
+            pass
+
+    # hash file in chunks (BOLD files do not fit in memory several times over)
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+
+    if memo_dir is not None:
+        memo_file.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(memo_file, digest.encode())
+
+    return digest
+
+def hash_params(params):
+    '''
+    Hash a (json serialisable) set of parameters, e.g., model parameters and file hashes.
+
+    Args
+        params: dict or list of parameters (non-serialisable values are converted to strings)
+
+    Returns
+        digest: hex digest of the parameters
+    '''
+    serialised = json.dumps(params, sort_keys=True, default=str)
+
+    return hashlib.sha256(serialised.encode()).hexdigest()
+
+def hash_array(array):
+    '''
+    Hash the content (values, shape and dtype) of a numpy array, e.g., the data of a mask.
+    '''
+    array = np.ascontiguousarray(array)
+
+    digest = hashlib.sha256(array.tobytes())
+    digest.update(f"{array.shape}{array.dtype}".encode())
+
+    return digest.hexdigest()
+
+def write_atomic(file_path:pathlib.Path, content:bytes):
+    '''
+    Write bytes to a file via a temporary file, so other processes never see a half-written file.
+    '''
+    tmp_path = file_path.with_name(f".{file_path.name}.{os.getpid()}.tmp")
+
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+
+    os.replace(tmp_path, file_path)
+
+def write_atomic_exclusive(file_path:pathlib.Path, content:bytes):
+    '''
+    Write bytes to a file that must not exist yet (raises FileExistsError if another process wrote it first).
+    '''
+    tmp_path = file_path.with_name(f".{file_path.name}.{os.getpid()}.tmp")
+
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+
+    # linking fails if the file exists, so only one process can create it
+    try:
+        os.link(tmp_path, file_path)
+    finally:
+        tmp_path.unlink()
+
+def entry_size(path:pathlib.Path):
+    '''
+    Size of a cache entry in bytes (entries can be files or directories).
+    '''
+    if not path.is_dir():
+        return path.stat().st_size
+
+    size = 0
+    for file in path.rglob("*"):
+        try:
+            size += file.stat().st_size if file.is_file() else 0
+        except FileNotFoundError: # removed by another process in the meantime
+            pass
+
+    return size
+
+def touch(path:pathlib.Path):
+    '''
+    Mark a cache entry as used (the modification time is used as last access time for the LRU eviction).
+    '''
+    try:
+        os.utime(path)
+    except FileNotFoundError: # evicted by another process in the meantime
+        pass
+
+# pins held by this process (cache folder and entry name -> open pin files)
+PINS = {}
+
+def open_pin(cache_dir:pathlib.Path, name:str, operation:int):
+    '''
+    Open and lock the pin file of an entry (cache_dir/.pins/name). The lock is retried if the pin file was removed while waiting for it.
+
+    Returns
+        f: the locked pin file (None if operation is non-blocking and the lock is held by another pin)
+    '''
+    pin_path = pathlib.Path(cache_dir) / ".pins" / name
+    pin_path.parent.mkdir(parents=True, exist_ok=True)
+
+    while True:
+        f = open(pin_path, "a")
+
+        try:
+            fcntl.flock(f, operation)
+        except BlockingIOError:
+            f.close()
+            return None
+
+        # the pin file is removed by evict_lru once an entry is evicted, in which case the lock is on a stale file
+        try:
+            if os.fstat(f.fileno()).st_ino == os.stat(pin_path).st_ino:
+                return f
+        except FileNotFoundError:
+            pass
+
+        f.close()
+
+def pin(cache_dir:pathlib.Path, name:str):
+    '''
+    Pin an entry, so evict_lru (of any process) does not evict it while it is read. Pin before checking that the entry exists.
+    Pins are shared locks, so they are released when the process ends, also if it crashes.
+    '''
+    PINS.setdefault((str(cache_dir), name), []).append(open_pin(cache_dir, name, fcntl.LOCK_SH))
+
+def unpin(cache_dir:pathlib.Path, name:str):
+    '''
+    Release a pin of an entry (see pin).
+    '''
+    pins = PINS.get((str(cache_dir), name))
+
+    if pins:
+        pins.pop().close()
+
+def evict_lru(cache_dir:pathlib.Path, max_bytes:int, keep:list=[]):
+    '''
+    Evict the least recently used entries until the cache is no larger than max_bytes.
+
+    Args
+        cache_dir: path to cache
+        max_bytes: maximum size of the cache in bytes
+        keep: names of entries that should not be evicted (e.g., the entry that was just written). Pinned entries are not evicted either (see pin)
+    '''
+    cache_dir = pathlib.Path(cache_dir)
+    memo_dir = cache_dir / "file_hashes"
+
+    # all entries except the bookkeeping folders, and the memoized file hashes (see hash_file)
+    paths = [entry for entry in cache_dir.iterdir() if entry.name not in ["refs", "file_hashes"] and not entry.name.startswith(".")]
+    if memo_dir.exists():
+        paths += [entry for entry in memo_dir.iterdir() if not entry.name.startswith(".")]
+
+    # stat every entry once (entries can be evicted by other processes at any time)
+    entries = []
+    for entry in paths:
+        try:
+            entries.append((entry.stat().st_mtime, entry_size(entry), entry))
+        except FileNotFoundError:
+            continue
+
+    total = sum(size for _, size, _ in entries)
+
+    # evict oldest entries first
+    for _, size, entry in sorted(entries, key=lambda entry: entry[0]):
+        if total <= max_bytes:
+            break
+
+        if entry.name in keep:
+            continue
+
+        # skip entries that are in use
+        f = open_pin(cache_dir, entry.name, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if f is None:
+            continue
+
+        if entry.is_dir():
+            shutil.rmtree(entry, ignore_errors=True)
+        else:
+            entry.unlink(missing_ok=True)
+
+        (cache_dir / ".pins" / entry.name).unlink(missing_ok=True)
+        f.close()
+
+        total -= size
+
+def cache_load(cache_dir:pathlib.Path, key:str):
+    '''
+    Load an object from the cache.
+
+    Args
+        cache_dir: path to cache
+        key: key of the object (e.g., from hash_params)
+
+    Returns
+        obj: cached object (None if the key is not in the cache)
+    '''
+    file_path = pathlib.Path(cache_dir) / f"{key}.pkl"
+
+    try:
+        with open(file_path, "rb") as f:
+            obj = pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+    touch(file_path)
+
+    return obj
+
+def cache_save(cache_dir:pathlib.Path, key:str, obj, max_bytes:int=None):
+    '''
+    Save an object to the cache and evict least recently used entries if the cache grows larger than max_bytes.
+
+    Args
+        cache_dir: path to cache
+        key: key of the object (e.g., from hash_params)
+        obj: object to save
+        max_bytes: maximum size of the cache in bytes. If None, the cache is unbounded
+    '''
+    cache_dir = pathlib.Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    write_atomic(cache_dir / f"{key}.pkl", pickle.dumps(obj))
+
+    if max_bytes is not None:
+        evict_lru(cache_dir, max_bytes, keep=[f"{key}.pkl"])
+
+def set_ref(cache_dir:pathlib.Path, name:str, key:str):
+    '''
+    Point a readable name (e.g., "flm_0116") to a cache key, so entries can be found without their inputs.
+    '''
+    refs_path = pathlib.Path(cache_dir) / "refs"
+    refs_path.mkdir(parents=True, exist_ok=True)
+
+    write_atomic(refs_path / f"{name}.key", key.encode())
+
+def get_refs(cache_dir:pathlib.Path):
+    '''
+    Get all named references of a cache.
+
+    Returns
+        refs: dictionary of name -> key
+    '''
+    refs_path = pathlib.Path(cache_dir) / "refs"
+
+    if not refs_path.exists():
+        return {}
+
+    return {file.stem: file.read_text() for file in sorted(refs_path.iterdir()) if file.name.endswith(".key")}
@@ -6,20 +6,30 @@ import pathlib, os
 import pandas as pd
 import numpy as np
 import pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # neuroimaging 
-import nibabel as nib
-from nilearn import masking
 from nilearn.glm.first_level import FirstLevelModel
 
-def get_paths(bids_path, subject:str, n_runs:int):
+# custom modules
+from cache import hash_file, hash_params, cache_load, cache_save, set_ref
+from flm_store import save_flm_store, open_flm_store, store_key, cache_contrasts, cache_smoothed_contrasts
+from ingest import read_table, check_run_geometry
+from bids_index import find_paths, list_subjects
+from bold_cache import cached_runs, release_runs, mapped_bytes
+from masks import subject_mask, save_mask_store
+from workers import split_cores, limit_worker_memory, init_worker
+
+def get_paths(bids_path, subject:str, n_runs:int, index_path=None):
     '''
     Get all paths to files needed to fit a first level model for a particular subject.
+    Paths are looked up in the index of the dataset (see bids_index.py), so the directories are only listed when they changed.
 
     Args
         bids_path: path to bids directory (root)
         subject: ID of subject (e.g., "0116")
         n_runs: number of blocks in the experiment
+        index_path: path of the dataset index. If None, the index is kept next to the dataset (see bids_index.default_index_path)
 
     Returns
         fprep_f_paths: path to functional fMRIprep processed data
@@ -30,34 +40,45 @@ def get_paths(bids_path, subject:str, n_runs:int):
     # define space ()
     space = "MNI152NLin2009cAsym"
 
-    # define functional paths
-    raw_fdir = bids_path / f"sub-{subject}" / "func"
-    fprep_fdir = bids_path / f"derivatives" / f"sub-{subject}" / "func"
+    # get fprep paths (first echo of the inner speech task)
+    fprep_f_paths = find_paths(bids_path, subject, "derivatives/func", "bold", ".nii.gz", space=space, desc="preproc", runs=range(1, n_runs+1), task="boldinnerspeech", echo="1", index_path=index_path)
 
-    # get fprep paths 
-    fprep_f_paths = [fprep_fdir / f"sub-{subject}_task-boldinnerspeech_run-{run}_echo-1_space-{space}_desc-preproc_bold.nii.gz" for run in range(1, n_runs+1)]
+    if not fprep_f_paths:
+        raise FileNotFoundError(f"No preprocessed BOLD data found for subject {subject} in {bids_path / 'derivatives'}")
 
     # get event paths
-    event_paths = [path for path in raw_fdir.iterdir() if path.name.endswith("_events.tsv")]
+    event_paths = find_paths(bids_path, subject, "raw/func", "events", ".tsv", index_path=index_path)
 
     # get confounds paths
-    confounds_paths = [path for path in fprep_fdir.iterdir() if path.name.endswith("_desc-confounds_timeseries.tsv")]
+    confounds_paths = find_paths(bids_path, subject, "derivatives/func", "timeseries", ".tsv", desc="confounds", index_path=index_path)
 
     # get mask paths 
-    mask_paths = [path for path in fprep_fdir.iterdir() if path.name.endswith(f"_space-{space}_desc-brain_mask.nii.gz")]
+    mask_paths = find_paths(bids_path, subject, "derivatives/func", "mask", ".nii.gz", space=space, desc="brain", index_path=index_path)
 
-    # sort lists in place (to ensure that the runs are in the right order)
-    for p in [fprep_f_paths, event_paths, confounds_paths, mask_paths]:
-        p.sort()
-    
+    # (the paths are sorted by run, to ensure that the runs are in the right order)
     return fprep_f_paths, event_paths, confounds_paths, mask_paths
 
-def update_events(events_dfs):
+# recoding of the raw trial types (raw trial type -> new trial type). Add an entry to recode another trial type
+TRIAL_TYPE_RULES = {
+    "IMG_PS": "positive_img",
+    "IMG_PO": "positive_img",
+    "IMG_NS": "negative_img",
+    "IMG_NO": "negative_img",
+    "IMG_BI": "button_img",
+}
+
+# events derived from existing trials. A new event of "trial_type" is added at onset + "delay" (column) for every "source" trial with a recorded delay
+DERIVED_EVENT_RULES = [
+    {"trial_type": "button_press", "source": "IMG_BI", "delay": "RT"},
+]
+
+def update_events(events_dfs, rules=TRIAL_TYPE_RULES):
     '''
     Update events dataframes renaming trial types IMG_PS and IMG_PO to "positive" and IMG_NS and IMG_NO to "negative"
 
     Args
         events_dfs: list of dataframes containing events data
+        rules: dictionary mapping raw trial types to new trial types (trial types not in the dictionary are kept)
 
     Returns 
         modified_events_dfs: list of dataframes containing events data with new trial types
@@ -66,31 +87,23 @@ def update_events(events_dfs):
 
     # iterate over runs
     for df in events_dfs:
-        # iterate over events in each run
-        for i, row in df.iterrows():
-            # get trial type
-            trial_type = row["trial_type"]
-
-            # update trial type
-            if trial_type == "IMG_PS" or trial_type == "IMG_PO":
-                df.at[i, "trial_type"] = "positive_img"
-            elif trial_type == "IMG_NS" or trial_type == "IMG_NO":
-                df.at[i, "trial_type"] = "negative_img"
-            elif trial_type == "IMG_BI":
-                df.at[i, "trial_type"] = "button_img"
+        # relabel all trial types at once (unmapped trial types are kept as they are)
+        df["trial_type"] = df["trial_type"].map(rules).fillna(df["trial_type"])
 
         # append modified df to list
         modified_events_dfs.append(df)
 
     return modified_events_dfs
 
-def add_buttonpress_events(events_dfs, drop_RT=True):
+def add_buttonpress_events(events_dfs, drop_RT=True, rules=DERIVED_EVENT_RULES):
     '''
     Add button press events to events dataframe. 
     This is done by adding a new row to the dataframe with the onset + RT of the trial and a trial type of "button_press".
 
     Args
         events_dfs: list of dataframes containing events data
+        drop_RT: whether to drop the RT column after the events have been added
+        rules: list of rules for the derived events (see DERIVED_EVENT_RULES)
 
     Returns
         modified_events_dfs: list of dataframes containing events data with button press events added
@@ -99,29 +112,25 @@ def add_buttonpress_events(events_dfs, drop_RT=True):
     
     # iterate over runs
     for df in events_dfs:
+        new_events = []
 
-        # iterate over events in each run
-        for i, row in df.iterrows():
-            
-            # get trial type, onset and reaction time
-            trial_type = row["trial_type"]
-            onset = row["onset"]
-            rt = row["RT"]
-
-            if trial_type == "IMG_BI" and np.isnan(rt) == False:
-                # calculate new onset based on reaction
-                new_onset = onset + rt
+        for rule in rules:
+            # select all source trials with a recorded delay (e.g., IMG_BI trials with a RT)
+            source = df.loc[(df["trial_type"] == rule["source"]) & df[rule["delay"]].notna()]
 
-                new_trial_type = "button_press"
+            # define new rows (onset + delay)
+            new_events.append(pd.DataFrame({
+                "onset": source["onset"] + source[rule["delay"]],
+                "duration": 0.0,
+                "trial_type": rule["trial_type"],
+                rule["delay"]: 0
+            }))
 
-                # define new row
-                new_row = {"onset": new_onset, "duration": 0.0, "trial_type": "button_press", "RT": 0}
-                
-                # append new row to df
-                df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
+        # append all new rows to df at once
+        df = pd.concat([df, *new_events], ignore_index=True)
 
         # sort df by onset
-        df = df.sort_values(by="onset").reset_index(drop=True)
+        df = df.sort_values(by="onset", kind="mergesort").reset_index(drop=True)
 
         # drop RT col
         if drop_RT == True:
@@ -133,103 +142,284 @@ def add_buttonpress_events(events_dfs, drop_RT=True):
     return modified_events_dfs
 
 
-def get_events(events_paths, drop_RT=True): 
+def get_events(events_paths, drop_RT=True, trial_type_rules=TRIAL_TYPE_RULES, derived_event_rules=DERIVED_EVENT_RULES, table_cache=None): 
+    '''
+    Load the events of all runs, with the button press events added and the trial types recoded.
+
+    Args
+        events_paths: paths to the events files (one per run)
+        drop_RT: whether to drop the RT column
+        trial_type_rules, derived_event_rules: see update_events and add_buttonpress_events
+        table_cache: path to the columnar cache of the tables (see ingest.read_table). If None, the files are always parsed
+    '''
     events = []
 
     # read in events 
     for path in events_paths: 
-        # load the raw events df
-        event_df = pd.read_csv(path, sep="\t")
-
-        # remove all cols except onset, duration, trial type, RT (RT is only used to calculate button_press triggers)
-        event_df = event_df.loc[:, ["onset", "duration", "trial_type", "RT"]]
+        # load only the cols onset, duration, trial type, RT (RT is only used to calculate button_press triggers)
+        event_df = read_table(path, ["onset", "duration", "trial_type", "RT"], cache_dir=table_cache)
         
         # append to events
         events.append(event_df)
 
     # add the button press events (also removes RT)
-    events = add_buttonpress_events(events, drop_RT)
+    events = add_buttonpress_events(events, drop_RT, rules=derived_event_rules)
 
     # combine positive and negative events
-    events = update_events(events)
+    events = update_events(events, rules=trial_type_rules)
 
     return events 
 
 def get_masks(mask_paths, save_path = None):
-    masks = []
+    '''
+    Intersection of the run masks of a subject. If save_path is given, the mask is stored (see masks.py) and only recomputed if the run masks changed.
 
-    for path in mask_paths: 
-        mask = nib.load(path)
-        masks.append(mask)
+    Args
+        mask_paths: paths to the run masks
+        save_path: path to save the mask in (in the folder "masks", also used in sanity_check.py and second_level.py). If None, the mask is not saved
 
+    Returns
+        mask_image: mask image of the subject
+    '''
     # get subject id (from first mask path, does not matter which as all pertain to subject)
     subject_name = mask_paths[0].name[4:8]
 
-    # merge masks 
-    mask_image = masking.intersect_masks(masks, threshold=0.8)
+    # merge masks (reused from the mask store if the run masks did not change)
+    mask_image = subject_mask(mask_paths, name=f"sub-{subject_name}", masks_path=save_path / "masks" if save_path else None, threshold=0.8)
 
-    # if specified, save the mask image for future use (also used in sanity_check.py)
-    if save_path:
-        file_path = save_path / "mask_objects"
-        file_path.mkdir(parents=True, exist_ok=True)
-        pickle.dump(mask_image, open(file_path / f"mask_{subject_name}.pkl", "wb"))
-        
     return mask_image
 
+def save_mask(mask_image, subject_name, save_path):
+    '''
+    Save the mask of a subject in the mask store (packed bits and flat voxel indices, see masks.py).
+    '''
+    save_mask_store(mask_image, f"sub-{subject_name}", save_path / "masks")
 
-def get_confounds(confound_paths, cols:list=["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"]):
+
+def get_confounds(confound_paths, cols:list=["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"], table_cache=None):
+    '''
+    Load the confounds of all runs.
+
+    Args
+        confound_paths: paths to the fMRIPrep confounds files (one per run)
+        cols: confound cols to keep
+        table_cache: path to the columnar cache of the tables (see ingest.read_table). If None, the files are always parsed
+    '''
     confounds = []
 
     for path in confound_paths:
-        confounds_df = pd.read_csv(path, sep="\t")
-
-        # select confound cols we are interested in
-        confounds_df = confounds_df.loc[:, cols]
+        # only parse the confound cols we are interested in (the files have hundreds of cols)
+        confounds_df = read_table(path, cols, cache_dir=table_cache)
 
         confounds.append(confounds_df)
 
     return confounds                
     
 
-def first_level_fit(fprep_f_paths, event_paths, confounds_paths, mask_paths, save_path): 
-    # get TR from first functional fmri path (based on https://nipy.org/nibabel/devel/biaps/biap_0006.html)
-    TR = int(nib.load(fprep_f_paths[0]).header["pixdim"][4])
+def flm_cache_key(fprep_f_paths, event_paths, confounds_paths, mask_paths, flm_params, cache_dir):
+    '''
+    Get the cache key of a first level model from the content of all its input files and its parameters.
+
+    Args
+        fprep_f_paths, event_paths, confounds_paths, mask_paths: paths to the input files (output of get_paths)
+        flm_params: parameters of the FirstLevelModel (and of the preprocessing of its inputs)
+        cache_dir: path to cache (file hashes are memoized here)
+
+    Returns
+        key: cache key
+    '''
+    input_hashes = {
+        name: [hash_file(path, memo_dir=cache_dir) for path in paths]
+        for name, paths in [("bold", fprep_f_paths), ("events", event_paths), ("confounds", confounds_paths), ("masks", mask_paths)]
+    }
+
+    return hash_params({"inputs": input_hashes, "params": flm_params})
+
+def first_level_key(fprep_f_paths, event_paths, confounds_paths, mask_paths, cache_dir=None, table_cache=None):
+    '''
+    Get the parameters of the first level model of a subject and its cache key.
+
+    Args
+        fprep_f_paths, event_paths, confounds_paths, mask_paths: paths to the input files (output of get_paths)
+        cache_dir: path to cache (file hashes are memoized here). If None, no key is computed
+        table_cache: path to the cache of the image headers (see ingest.py)
+
+    Returns
+        flm_params: parameters of the FirstLevelModel
+        key: cache key (None if cache_dir is None)
+    '''
+    # check that all runs are on the same grid, and get TR from the first functional fmri path (headers only, see ingest.probe_image)
+    TR = int(check_run_geometry(fprep_f_paths, cache_dir=table_cache)["tr"])
+
+    # model parameters (n_jobs and verbose do not change the fit and are therefore not part of the cache key)
+    flm_params = {
+        "t_r": TR,
+        "slice_time_ref": 0.5, # Ask Mikkel as notebook 13 has it set to 0.5. And it is mentioned as 0.5 in boilerplate
+        "hrf_model": "glover",
+        "noise_model": "ar1", # We use the ar1 noise model as it assumes time-series data. See https://nilearn.github.io/dev/auto_examples/04_glm_first_level/plot_first_level_details.html
+    }
+
+    if cache_dir is None:
+        return flm_params, None
+
+    # the event recoding is part of the key, as it changes the design
+    key = flm_cache_key(fprep_f_paths, event_paths, confounds_paths, mask_paths, {**flm_params, "trial_type_rules": TRIAL_TYPE_RULES, "derived_event_rules": DERIVED_EVENT_RULES}, cache_dir)
+
+    return flm_params, key
+
+def first_level_fit(fprep_f_paths, event_paths, confounds_paths, mask_paths, save_path, n_jobs=-2, cache_dir=None, max_cache_bytes=None, table_cache=None, bold_cache=None, max_bold_cache_bytes=None): 
+    '''
+    Fit a first level model for a single subject. 
+
+    Args
+        fprep_f_paths, event_paths, confounds_paths, mask_paths: paths to the input files (output of get_paths)
+        save_path: path to save the mask image in (see get_masks)
+        n_jobs: number of jobs passed to the FirstLevelModel
+        cache_dir: if specified, the fitted model is cached here, and the fit is skipped if the inputs and parameters match a cached model
+        max_cache_bytes: maximum size of the cache in bytes (least recently used models are evicted). If None, the cache is unbounded
+        table_cache: path to the cache of the events, confounds and image headers (see ingest.py)
+        bold_cache: if specified, the runs are read through the cache of decompressed BOLD series here (see bold_cache.py). If None, the runs are read from the BOLD files
+        max_bold_cache_bytes: maximum size of the BOLD cache in bytes. If None, the cache is unbounded
+
+    Returns
+        first_level_mdl: fitted first level model
+    '''
+    flm_params, key = first_level_key(fprep_f_paths, event_paths, confounds_paths, mask_paths, cache_dir, table_cache=table_cache)
+
+    # check the cache for a model fitted on the same inputs
+    if cache_dir is not None:
+        subject_name = mask_paths[0].name[4:8]
+        first_level_mdl = cache_load(cache_dir, key)
+
+        if first_level_mdl is not None:
+            print(f"[INFO:] Using cached first level model for subject {subject_name}")
+            set_ref(cache_dir, f"flm_{subject_name}", key)
+
+            # store the mask as if the model was fitted (only computed if it is not stored yet)
+            if save_path:
+                get_masks(mask_paths, save_path=save_path)
+
+            return first_level_mdl
 
     # get events, confonds and mask img
-    events = get_events(event_paths)
-    confounds = get_confounds(confounds_paths)
+    events = get_events(event_paths, table_cache=table_cache)
+    confounds = get_confounds(confounds_paths, table_cache=table_cache)
     mask_image = get_masks(mask_paths, save_path = save_path)
 
     # create first lvl model 
     first_level_mdl = FirstLevelModel(
-        t_r=TR,
-        slice_time_ref=0.5, # Ask Mikkel as notebook 13 has it set to 0.5. And it is mentioned as 0.5 in boilerplate
-        hrf_model="glover", 
+        **flm_params,
         mask_img = mask_image, 
-        noise_model="ar1", # We use the ar1 noise model as it assumes time-series data. See https://nilearn.github.io/dev/auto_examples/04_glm_first_level/plot_first_level_details.html
         verbose=1,
-        n_jobs=-2 # all cores except 1
+        n_jobs=n_jobs # defaults to all cores except 1 (lowered when several subjects are fitted at once)
     )
 
-    # fit model 
-    first_level_mdl.fit(fprep_f_paths, events, confounds)
+    # fit model (runs are memory-mapped from the BOLD cache if it is used)
+    run_imgs = cached_runs(fprep_f_paths, mask_image, bold_cache, max_bold_cache_bytes)
+    try:
+        first_level_mdl.fit(run_imgs, events, confounds)
+    finally:
+        release_runs(run_imgs)
+
+    # add model to cache
+    if cache_dir is not None:
+        cache_save(cache_dir, key, first_level_mdl, max_bytes=max_cache_bytes)
+        set_ref(cache_dir, f"flm_{subject_name}", key)
 
     return first_level_mdl
 
-def all_subjects_pipeline(bids_path, subjects_list, save_path=None):
-    for subject in subjects_list: 
-        # get paths
-        fprep_f_paths, event_paths, confounds_paths, mask_paths = get_paths(bids_path, subject, n_runs=6)
-        
-        # first level model 
-        first_level_mdl = first_level_fit(fprep_f_paths, event_paths, confounds_paths, mask_paths, save_path=save_path)
+def subject_pipeline(bids_path, subject, save_path=None, n_jobs=-2, cache_dir=None, max_cache_bytes=None, table_cache=None, bold_cache=None, max_bold_cache_bytes=None):
+    '''
+    Fit the first level model for a single subject and save it as soon as it is done.
 
-        # save if savepath is 
-        if save_path:
-            file_name = f"flm_{subject}.pkl"
-            file_path = save_path / "all_flms"
-            file_path.mkdir(parents=True, exist_ok=True)
-            pickle.dump(first_level_mdl, open(file_path / file_name, "wb"))
+    Args
+        bids_path: path to bids directory (root)
+        subject: ID of subject (e.g., "0116")
+        save_path: path to save the model in (in the folder "all_flms"). If None, the model is not saved
+        n_jobs: number of jobs passed to the FirstLevelModel
+        cache_dir, max_cache_bytes: cache for fitted models (see first_level_fit)
+        table_cache: path to the cache of the events, confounds and image headers (see ingest.py)
+        bold_cache, max_bold_cache_bytes: cache of decompressed BOLD series (see first_level_fit)
+
+    Returns
+        first_level_mdl: fitted first level model
+    '''
+    # get paths
+    fprep_f_paths, event_paths, confounds_paths, mask_paths = get_paths(bids_path, subject, n_runs=6)
+    
+    # first level model 
+    first_level_mdl = first_level_fit(fprep_f_paths, event_paths, confounds_paths, mask_paths, save_path=save_path, n_jobs=n_jobs, cache_dir=cache_dir, max_cache_bytes=max_cache_bytes, table_cache=table_cache, bold_cache=bold_cache, max_bold_cache_bytes=max_bold_cache_bytes)
+
+    # save if savepath is 
+    if save_path:
+        file_name = f"flm_{subject}.pkl"
+        file_path = save_path / "all_flms"
+        store_path = save_path / "flm_store"
+
+        # the saved model, store and contrasts are already up to date if the store was saved from the same cached model
+        key = first_level_key(fprep_f_paths, event_paths, confounds_paths, mask_paths, cache_dir, table_cache=table_cache)[1]
+        if key is not None and store_key(store_path, subject) == key and (file_path / file_name).exists():
+            return first_level_mdl
+
+        file_path.mkdir(parents=True, exist_ok=True)
+        with open(file_path / file_name, "wb") as f:
+            pickle.dump(first_level_mdl, f)
+
+        # save compact store (betas, variances and design matrices) used for the contrasts at group level
+        save_flm_store(first_level_mdl, subject, store_path, key=key)
+
+        # cache the contrast maps used in sanity_check.py and second_level.py (and their smoothed maps used at group level)
+        store = open_flm_store(store_path, subject)
+        cache_contrasts(store)
+        cache_smoothed_contrasts(store)
+
+    return first_level_mdl
+
+def fit_and_save_subject(bids_path, subject, save_path, n_jobs, cache_dir, max_cache_bytes, table_cache, bold_cache, max_bold_cache_bytes, mem_per_worker=None):
+    '''
+    Worker function for the process pool. Only the subject id is sent back, as the (large) model is already written to disk by the worker.
+    The memory cap of the worker is raised by the runs of the subject memory-mapped from the BOLD cache, as they count in its address space.
+    '''
+    if mem_per_worker is not None and bold_cache is not None:
+        fprep_f_paths = get_paths(bids_path, subject, n_runs=6)[0]
+        limit_worker_memory(mem_per_worker, mapped_bytes=mapped_bytes(fprep_f_paths, table_cache))
+
+    subject_pipeline(bids_path, subject, save_path=save_path, n_jobs=n_jobs, cache_dir=cache_dir, max_cache_bytes=max_cache_bytes, table_cache=table_cache, bold_cache=bold_cache, max_bold_cache_bytes=max_bold_cache_bytes)
+
+    return subject
+
+def all_subjects_pipeline(bids_path, subjects_list, save_path=None, n_workers=None, n_cores=None, mem_per_worker=None, cache_dir=None, max_cache_bytes=None, table_cache=None, bold_cache=None, max_bold_cache_bytes=None):
+    '''
+    Fit first level models for all subjects. Subjects are fitted in parallel worker processes, and each model is saved as soon as its subject is done.
+
+    Args
+        bids_path: path to bids directory (root)
+        subjects_list: list of subject IDs
+        save_path: path to save the models in (in the folder "all_flms")
+        n_workers: number of subjects fitted at the same time. If None, determined from the cores (and memory) available
+        n_cores: total number of cores to use. If None, all cores except 1
+        mem_per_worker: memory cap per worker in bytes (e.g., 16 * 1024**3). If None, no cap
+        cache_dir, max_cache_bytes: cache for fitted models (see first_level_fit). Subjects with unchanged inputs are not refitted
+        table_cache: path to the cache of the events, confounds and image headers (see ingest.py)
+        bold_cache, max_bold_cache_bytes: cache of decompressed BOLD series (see first_level_fit)
+    '''
+    n_workers, n_jobs = split_cores(len(subjects_list), n_workers=n_workers, n_cores=n_cores, mem_per_worker=mem_per_worker)
+
+    # fit subjects one after another in the main process if only one worker is available
+    if n_workers == 1:
+        for subject in subjects_list:
+            subject_pipeline(bids_path, subject, save_path=save_path, n_jobs=n_jobs, cache_dir=cache_dir, max_cache_bytes=max_cache_bytes, table_cache=table_cache, bold_cache=bold_cache, max_bold_cache_bytes=max_bold_cache_bytes)
+        return
+
+    print(f"[INFO:] Fitting {len(subjects_list)} subjects with {n_workers} workers ({n_jobs} jobs each) ...")
+
+    # one BLAS thread per worker (the cores of a worker are used by the n_jobs processes of its model) and a memory cap (see workers.limit_worker_memory)
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(mem_per_worker, 1)) as executor:
+        futures = [executor.submit(fit_and_save_subject, bids_path, subject, save_path, n_jobs, cache_dir, max_cache_bytes, table_cache, bold_cache, max_bold_cache_bytes, mem_per_worker) for subject in subjects_list]
+
+        for future in as_completed(futures):
+            subject = future.result()
+            print(f"[INFO:] Subject {subject} done")
 
 
 def main():    
@@ -240,8 +430,12 @@ def main():
     save_path = path.parents[1] / "data"
     save_path.mkdir(parents=True, exist_ok=True)
     
-    subjects = ["0116", "0117", "0118", "0119", "0120", "0121", "0122", "0123"]
-    all_subjects_pipeline(bids_path, subjects, save_path=save_path)
+    # cache of fitted models (only subjects with new or changed inputs are refitted)
+    cache_dir = save_path / "cache" / "flms"
+    
+    # all subjects with preprocessed data (subject 0119 is fitted too, it is excluded at the second level after the sanity check)
+    subjects = list_subjects(bids_path, exclude_subjects=[])
+    all_subjects_pipeline(bids_path, subjects, save_path=save_path, cache_dir=cache_dir, max_cache_bytes=50 * 1024**3, table_cache=save_path / "cache" / "tables", bold_cache=save_path / "cache" / "bold", max_bold_cache_bytes=100 * 1024**3)
 
 
 if __name__ == "__main__":
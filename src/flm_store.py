@@ -0,0 +1,343 @@
+'''
+Store of fitted first level models as memory-mappable arrays (betas, residual variances, design matrix) instead of whole-object pickles.
+Contrasts are computed from the arrays and cached in the subject folder.
+'''
+import pathlib
+import json
+import re
+import shutil
+
+import numpy as np
+import nibabel as nib
+from scipy.stats import norm, t as t_dist
+from scipy.ndimage import gaussian_filter1d
+from nilearn.glm.contrasts import expression_to_contrast_vector
+
+from cache import hash_array, hash_params, write_atomic
+
+# contrasts cached as soon as a first level model is fitted (used by second_level.py and sanity_check.py)
+DEFAULT_CONTRASTS = ["positive_img - negative_img", "button_press"]
+
+# maps cached per contrast
+CACHED_OUTPUT_TYPES = ["effect_size", "effect_variance", "z_score"]
+
+# smoothing of the first level maps at group level (FWHM in mm, as the smoothing_fwhm of the second level model)
+DEFAULT_SMOOTHING_FWHM = 8.0
+
+def save_flm_store(flm, subject:str, store_path:pathlib.Path, key:str=None):
+    '''
+    Save the parts of a fitted first level model needed to compute contrasts.
+
+    Args
+        flm: fitted first level model
+        subject: subject id (e.g., "0116")
+        store_path: path to the store (a folder "sub-{subject}" is made here)
+        key: cache key of the model (see first_level.first_level_key). If None, the key is a hash of the betas
+
+    Returns
+        subject_path: path to the subject folder
+    '''
+    subject_path = store_path / f"sub-{subject}"
+    subject_path.mkdir(parents=True, exist_ok=True)
+
+    # cached contrasts of a previous fit are outdated
+    shutil.rmtree(subject_path / "contrasts", ignore_errors=True)
+
+    # voxels of the mask (flat indices into the volume)
+    mask_img = flm.masker_.mask_img_
+    mask_indices = np.flatnonzero(np.asarray(mask_img.dataobj).astype(bool))
+    np.save(subject_path / "mask.npy", mask_indices)
+
+    runs = []
+    beta_hashes = []
+
+    for run, (labels, results, design_matrix) in enumerate(zip(flm.labels_, flm.results_, flm.design_matrices_), start=1):
+        n_regressors = design_matrix.shape[1]
+        label_keys = list(results.keys())
+
+        betas = np.zeros((n_regressors, labels.size), dtype=np.float32)
+        variances = np.zeros(labels.size, dtype=np.float32)
+        label_idx = np.zeros(labels.size, dtype=np.int32)
+        covs = np.zeros((len(label_keys), n_regressors, n_regressors))
+
+        # the AR(1) model fits one regression per label (voxels with similar autocorrelation), so the betas are gathered back in voxel order
+        for i, label_key in enumerate(label_keys):
+            label_mask = labels == label_key
+            betas[:, label_mask] = results[label_key].theta
+            variances[label_mask] = results[label_key].dispersion
+            label_idx[label_mask] = i
+            covs[i] = results[label_key].cov
+
+        np.save(subject_path / f"run-{run}_betas.npy", betas)
+        beta_hashes.append(hash_array(betas))
+        np.save(subject_path / f"run-{run}_variances.npy", variances)
+        np.save(subject_path / f"run-{run}_labels.npy", label_idx)
+        np.save(subject_path / f"run-{run}_covs.npy", covs)
+        np.save(subject_path / f"run-{run}_design.npy", design_matrix.to_numpy())
+
+        runs.append({
+            "columns": list(design_matrix.columns),
+            "dof": float(results[label_keys[0]].df_residuals),
+        })
+
+    # metadata header
+    header = {
+        "subject": subject,
+        "shape": list(mask_img.shape[:3]),
+        "affine": np.asarray(mask_img.affine).tolist(),
+        "n_voxels": int(mask_indices.size),
+        "runs": runs,
+        "key": key if key is not None else hash_params(beta_hashes),
+    }
+
+    # header is written last, so a store is only opened once its arrays are complete
+    write_atomic(subject_path / "header.json", json.dumps(header, indent=2).encode())
+
+    return subject_path
+
+def open_flm_store(store_path:pathlib.Path, subject:str):
+    '''
+    Open the store of a subject. Only the header is read, the arrays are memory-mapped when a contrast is computed.
+
+    Args
+        store_path: path to the store
+        subject: subject id (e.g., "0116")
+
+    Returns
+        store: dictionary with the header and the path of the subject folder
+    '''
+    subject_path = store_path / f"sub-{subject}"
+
+    with open(subject_path / "header.json") as f:
+        header = json.load(f)
+
+    return {"path": subject_path, **header}
+
+def store_key(store_path:pathlib.Path, subject:str):
+    '''
+    Key of the model saved in the store of a subject (identifies the fit, see save_flm_store). None if the subject is not in the store.
+    '''
+    try:
+        return open_flm_store(store_path, subject).get("key")
+    except FileNotFoundError:
+        return None
+
+def load_store_array(store, name:str):
+    '''
+    Memory-map an array of a store (e.g., "run-1_betas").
+    '''
+    return np.load(store["path"] / f"{name}.npy", mmap_mode="r")
+
+def z_from_t(stat, dof):
+    '''
+    Convert t statistics to z scores (via the p-values, as in nilearn to avoid infinite values for large t values).
+    '''
+    p_value = t_dist.sf(stat, dof)
+    one_minus_p_value = t_dist.cdf(stat, dof)
+
+    return np.where(p_value < 0.5, norm.isf(p_value), -norm.isf(one_minus_p_value))
+
+def compute_store_effects(store, contrast:str):
+    '''
+    Compute the (fixed effects) effect size and variance of a contrast over all runs from the store.
+
+    Args
+        store: store of a subject (output of open_flm_store)
+        contrast: contrast expression (e.g., "positive_img - negative_img")
+
+    Returns
+        effect: effect size of all voxels in the mask (1D array)
+        variance: variance of the effect size (1D array)
+        dof: degrees of freedom (summed over the runs)
+    '''
+    effect, variance, dof, n_contrasts = 0, 0, 0, 0
+
+    for run, run_info in enumerate(store["runs"], start=1):
+        con_val = expression_to_contrast_vector(contrast, run_info["columns"])
+
+        # skip runs where the contrast is null (as in nilearn)
+        if np.all(con_val == 0):
+            continue
+
+        # only read the betas of the regressors in the contrast
+        nonzero = np.flatnonzero(con_val)
+        betas = load_store_array(store, f"run-{run}_betas")[nonzero]
+
+        effect = effect + con_val[nonzero] @ betas
+
+        # variance of the contrast = c' cov c (per AR label) * residual variance (per voxel)
+        covs = load_store_array(store, f"run-{run}_covs")
+        label_var = np.einsum("i,lij,j->l", con_val, covs, con_val)
+        variance = variance + label_var[load_store_array(store, f"run-{run}_labels")] * load_store_array(store, f"run-{run}_variances")
+
+        dof += run_info["dof"]
+        n_contrasts += 1
+
+    if n_contrasts == 0:
+        raise ValueError("All contrasts provided were null contrasts.")
+
+    # average over runs
+    return effect / n_contrasts, variance / n_contrasts**2, dof
+
+def compute_store_contrast(store, contrast:str, output_type:str="z_score"):
+    '''
+    Compute a (fixed effects) contrast over all runs from the store, equivalent to FirstLevelModel.compute_contrast for t contrasts.
+
+    Args
+        store: store of a subject (output of open_flm_store)
+        contrast: contrast expression (e.g., "positive_img - negative_img")
+        output_type: "z_score", "stat", "effect_size" or "effect_variance"
+
+    Returns
+        values: contrast values of all voxels in the mask (1D array)
+    '''
+    effect, variance, dof = compute_store_effects(store, contrast)
+
+    if output_type == "effect_size":
+        return effect
+    if output_type == "effect_variance":
+        return variance
+
+    stat = effect / np.sqrt(np.maximum(variance, 1e-50))
+
+    if output_type == "stat":
+        return stat
+    if output_type == "z_score":
+        return z_from_t(stat, dof)
+
+    raise ValueError(f"output_type {output_type} is not supported")
+
+def store_to_img(store, values):
+    '''
+    Put the values of all voxels in the mask back into a volume (Nifti image).
+
+    Args
+        store: store of a subject (output of open_flm_store)
+        values: 1D array of values (e.g., output of compute_store_contrast)
+
+    Returns
+        img: Nifti image
+    '''
+    volume = np.zeros(np.prod(store["shape"]), dtype=np.float32)
+    volume[load_store_array(store, "mask")] = values
+
+    return nib.Nifti1Image(volume.reshape(store["shape"]), np.array(store["affine"]))
+
+def contrast_file_path(store, contrast:str, output_type:str):
+    '''
+    Path of a cached contrast map (e.g., "positive_img - negative_img" -> contrasts/positive_img-negative_img_67212a3b_z_score.npy, ending with a hash of the expression).
+    '''
+    expression = contrast.replace(" ", "")
+    contrast_name = re.sub(r"[^\w.+-]", "_", expression) + "_" + hash_params(expression)[:8]
+
+    return store["path"] / "contrasts" / f"{contrast_name}_{output_type}.npy"
+
+def cache_contrasts(store, contrasts:list=DEFAULT_CONTRASTS):
+    '''
+    Compute and cache the effect size, variance and z-score maps of contrasts.
+
+    Args
+        store: store of a subject (output of open_flm_store)
+        contrasts: list of contrast expressions
+    '''
+    for contrast in contrasts:
+        effect, variance, dof = compute_store_effects(store, contrast)
+        z_score = z_from_t(effect / np.sqrt(np.maximum(variance, 1e-50)), dof)
+
+        for output_type, values in zip(CACHED_OUTPUT_TYPES, [effect, variance, z_score]):
+            file_path = contrast_file_path(store, contrast, output_type)
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            np.save(file_path, values.astype(np.float32))
+
+def smooth_volumes(volumes, affine, fwhm:float):
+    '''
+    Smooth several volumes at once with a separable Gaussian kernel (one 1D filter per axis, the same filter as nilearn's smooth_img).
+
+    Args
+        volumes: array of shape (n_volumes, x, y, z)
+        affine: affine of the volumes (for the voxel size)
+        fwhm: FWHM of the kernel in mm
+
+    Returns
+        volumes: smoothed float32 array of the same shape
+    '''
+    volumes = np.array(volumes, dtype=np.float32)
+
+    # FWHM in mm -> sigma in voxels per axis
+    vox_size = np.sqrt(np.sum(np.asarray(affine)[:3, :3] ** 2, axis=0))
+    sigmas = fwhm / (np.sqrt(8 * np.log(2)) * vox_size)
+
+    for axis, sigma in enumerate(sigmas, start=1):
+        if sigma > 0:
+            gaussian_filter1d(volumes, sigma, axis=axis, output=volumes)
+
+    return volumes
+
+def smoothed_file_path(store, contrast:str, output_type:str, fwhm:float):
+    '''
+    Path of a cached smoothed contrast map, next to the unsmoothed map (e.g., contrasts/positive_img-negative_img_67212a3b_effect_size_fwhm-8.0.npy).
+    '''
+    file_path = contrast_file_path(store, contrast, output_type)
+
+    return file_path.with_name(f"{file_path.stem}_fwhm-{float(fwhm)}.npy")
+
+def cache_smoothed_contrasts(store, contrasts:list=DEFAULT_CONTRASTS, fwhm:float=DEFAULT_SMOOTHING_FWHM, output_type:str="effect_size"):
+    '''
+    Smooth the contrast maps of a subject (whole volumes, as in nilearn) and cache the smoothed volumes.
+    The whole volume is kept, as the smoothing spreads the map outside the mask of the subject (e.g., into a group mask that reaches outside it).
+
+    Args
+        store: store of a subject (output of open_flm_store)
+        contrasts: list of contrast expressions
+        fwhm: FWHM of the smoothing kernel in mm
+        output_type: map to smooth (see load_contrast)
+    '''
+    mask = load_store_array(store, "mask")
+
+    volumes = np.zeros((len(contrasts), int(np.prod(store["shape"]))), dtype=np.float32)
+    for row, contrast in enumerate(contrasts):
+        volumes[row, mask] = load_contrast(store, contrast, output_type=output_type)
+
+    smoothed = smooth_volumes(volumes.reshape(len(contrasts), *store["shape"]), store["affine"], fwhm).reshape(len(contrasts), -1)
+
+    for row, contrast in enumerate(contrasts):
+        file_path = smoothed_file_path(store, contrast, output_type, fwhm)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        np.save(file_path, smoothed[row])
+
+def load_smoothed_contrast(store, contrast:str, fwhm:float=DEFAULT_SMOOTHING_FWHM, output_type:str="effect_size"):
+    '''
+    Load a smoothed contrast map from the contrast cache of a subject (smoothed and cached first if it is not cached yet).
+
+    Returns
+        values: smoothed contrast values of all voxels of the grid (flat 1D float32 array, memory-mapped), to be indexed with the flat voxel indices of a mask
+    '''
+    file_path = smoothed_file_path(store, contrast, output_type, fwhm)
+
+    # maps cached before the whole volume was kept only hold the voxels in the mask
+    if not file_path.exists() or np.load(file_path, mmap_mode="r").size != int(np.prod(store["shape"])):
+        cache_smoothed_contrasts(store, contrasts=[contrast], fwhm=fwhm, output_type=output_type)
+
+    return np.load(file_path, mmap_mode="r")
+
+def load_contrast(store, contrast:str, output_type:str="z_score"):
+    '''
+    Load a contrast map from the contrast cache of a subject. Contrasts that are not cached yet are computed and cached first.
+
+    Args
+        store: store of a subject (output of open_flm_store)
+        contrast: contrast expression (e.g., "positive_img - negative_img")
+        output_type: "z_score", "effect_size" or "effect_variance" (other output types are computed without caching)
+
+    Returns
+        values: contrast values of all voxels in the mask (1D float32 array, memory-mapped)
+    '''
+    if output_type not in CACHED_OUTPUT_TYPES:
+        return compute_store_contrast(store, contrast, output_type=output_type)
+
+    file_path = contrast_file_path(store, contrast, output_type)
+
+    if not file_path.exists():
+        cache_contrasts(store, contrasts=[contrast])
+
+    return np.load(file_path, mmap_mode="r")
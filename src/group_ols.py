@@ -0,0 +1,323 @@
+'''
+Second level (group) OLS engine over stacked first level maps.
+The fit can also be made from the sufficient statistics of the model, so subjects are added or removed without refitting all subjects.
+'''
+import pathlib
+import json
+import io
+import fcntl
+
+import numpy as np
+import pandas as pd
+from nilearn.glm.contrasts import expression_to_contrast_vector
+
+from cache import hash_array, hash_params, write_atomic
+from flm_store import open_flm_store, load_contrast, load_smoothed_contrast, load_store_array, z_from_t
+
+def stack_effect_maps(store_path:pathlib.Path, contrast:str, subjects:list, mask, smoothing_fwhm:float=8.0, output_type:str="effect_size"):
+    '''
+    Stack the first level maps of a contrast of all subjects into one matrix (one subject at a time). Smoothed maps are cached in the model store, so they are only smoothed once.
+
+    Args
+        store_path: path to the first level model store (see flm_store.py)
+        contrast: first level contrast expression (e.g., "positive_img - negative_img")
+        subjects: list of subject ids (rows of the matrix, in this order)
+        mask: group mask (stored mask, see masks.py) on the grid of the first level models
+        smoothing_fwhm: FWHM of the Gaussian smoothing in mm (as the smoothing_fwhm of SecondLevelModel). If None, the maps are not smoothed
+        output_type: first level output type (see flm_store.load_contrast)
+
+    Returns
+        Y: float32 array of shape (n_subjects, n_voxels)
+    '''
+    Y = np.empty((len(subjects), len(mask["voxels"])), dtype=np.float32)
+    group_voxels = np.asarray(mask["voxels"])
+
+    for row, subject in enumerate(subjects):
+        store = open_flm_store(store_path, subject)
+
+        if list(store["shape"]) != list(mask["shape"]) or not np.allclose(store["affine"], mask["affine"]):
+            raise ValueError(f"The first level model of subject {subject} is not on the grid of the group mask")
+
+        # smoothed volumes are read from the contrast cache (smoothed once per FWHM, see flm_store.cache_smoothed_contrasts), also where the mask reaches outside the mask of the subject
+        if smoothing_fwhm:
+            Y[row] = load_smoothed_contrast(store, contrast, fwhm=smoothing_fwhm, output_type=output_type)[group_voxels]
+            continue
+
+        # the volume of the subject (zero outside its mask)
+        volume = np.zeros(int(np.prod(store["shape"])), dtype=np.float32)
+        volume[load_store_array(store, "mask")] = load_contrast(store, contrast, output_type=output_type)
+
+        Y[row] = volume[group_voxels]
+
+    return Y
+
+def fit_ols(Y, design_matrix:pd.DataFrame=None, voxel_chunk:int=65536):
+    '''
+    Fit an OLS model for all voxels at once.
+
+    Args
+        Y: array of shape (n_subjects, n_voxels) (e.g., output of stack_effect_maps)
+        design_matrix: group design matrix with one row per subject. If None, a one sample test (intercept only)
+        voxel_chunk: number of voxels solved at a time (bounds the memory used on top of Y)
+
+    Returns
+        fit: dictionary with the "beta" (n_regressors, n_voxels), the residual variance "sigma2" (n_voxels,), the degrees of freedom "dof",
+             the unscaled covariance of the betas "cov" ((X'X)^-1) and the names of the regressors "columns"
+    '''
+    if design_matrix is None:
+        design_matrix = pd.DataFrame([1] * Y.shape[0], columns=["intercept"])
+
+    X = design_matrix.to_numpy(dtype=np.float64)
+    pinv_X = np.linalg.pinv(X)
+    dof = X.shape[0] - np.linalg.matrix_rank(X)
+
+    if dof <= 0:
+        raise ValueError(f"The design matrix has no residual degrees of freedom ({X.shape[0]} subjects, rank {np.linalg.matrix_rank(X)})")
+
+    beta = np.empty((X.shape[1], Y.shape[1]), dtype=np.float32)
+    sigma2 = np.empty(Y.shape[1], dtype=np.float32)
+
+    for start in range(0, Y.shape[1], voxel_chunk):
+        Y_chunk = np.asarray(Y[:, start:start + voxel_chunk], dtype=np.float64)
+
+        beta_chunk = pinv_X @ Y_chunk
+        residuals = Y_chunk - X @ beta_chunk
+
+        beta[:, start:start + voxel_chunk] = beta_chunk
+        sigma2[start:start + voxel_chunk] = (residuals ** 2).sum(axis=0) / dof
+
+    return {"beta": beta, "sigma2": sigma2, "dof": int(dof), "cov": pinv_X @ pinv_X.T, "columns": list(design_matrix.columns)}
+
+def contrast_matrix(contrasts:dict, columns:list):
+    '''
+    Stack group contrasts into one matrix (one row per contrast).
+
+    Args
+        contrasts: dictionary of contrast name -> expression of the regressors (e.g., "intercept" or "age - sex") or contrast vector
+        columns: names of the regressors of the design matrix
+
+    Returns
+        C: array of shape (n_contrasts, n_regressors)
+    '''
+    rows = [expression_to_contrast_vector(contrast, columns) if isinstance(contrast, str) else np.asarray(contrast, dtype=np.float64) for contrast in contrasts.values()]
+
+    return np.vstack(rows)
+
+def compute_group_contrasts(fit, contrasts:dict, output_types:list=["stat", "z_score"]):
+    '''
+    Compute the maps of several group contrasts at once.
+
+    Args
+        fit: fitted OLS model (output of fit_ols)
+        contrasts: dictionary of contrast name -> expression or vector (see contrast_matrix)
+        output_types: maps to return ("effect_size", "effect_variance", "stat" (t) and/or "z_score")
+
+    Returns
+        maps: dictionary of contrast name -> output type -> values (n_voxels,)
+    '''
+    C = contrast_matrix(contrasts, fit["columns"])
+
+    # effects and variances of all contrasts in one product
+    effects = C @ fit["beta"]
+    variances = np.einsum("kp,pq,kq->k", C, fit["cov"], C)[:, None] * fit["sigma2"][None, :]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stats = np.where(variances > 0, effects / np.sqrt(variances), 0)
+
+    outputs = {"effect_size": effects, "effect_variance": variances, "stat": stats}
+
+    if "z_score" in output_types:
+        outputs["z_score"] = z_from_t(stats, fit["dof"])
+
+    return {name: {output_type: outputs[output_type][k].astype(np.float32) for output_type in output_types} for k, name in enumerate(contrasts)}
+
+def group_stats(n_voxels:int, columns:list=["intercept"]):
+    '''
+    Empty sufficient statistics of a group model.
+
+    Args
+        n_voxels: number of voxels (columns of the stacked maps)
+        columns: names of the regressors of the group design
+
+    Returns
+        stats: dictionary with "XtX" (n_regressors, n_regressors), "XtY" (n_regressors, n_voxels) and "YtY" (n_voxels,) as float64,
+               the design row of every subject in the model "subjects" and the names of the regressors "columns"
+    '''
+    return {
+        "XtX": np.zeros((len(columns), len(columns))),
+        "XtY": np.zeros((len(columns), n_voxels)),
+        "YtY": np.zeros(n_voxels),
+        "subjects": {},
+        "columns": list(columns),
+    }
+
+def add_subject(stats, subject:str, y, x=None):
+    '''
+    Add a subject to the statistics of a group model (new statistics are returned, the input is not changed).
+
+    Args
+        stats: statistics of the group model (output of group_stats)
+        subject: subject id
+        y: map of the subject (n_voxels,), e.g., a row of stack_effect_maps
+        x: design row of the subject (one value per regressor). If None, 1 for every regressor (one sample test)
+
+    Returns
+        stats: statistics with the subject
+    '''
+    if subject in stats["subjects"]:
+        raise ValueError(f"Subject {subject} is already in the group model")
+
+    x = np.ones(len(stats["columns"])) if x is None else np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    return {
+        "XtX": stats["XtX"] + np.outer(x, x),
+        "XtY": stats["XtY"] + x[:, None] * y[None, :],
+        "YtY": stats["YtY"] + y ** 2,
+        "subjects": {**stats["subjects"], subject: x.tolist()},
+        "columns": stats["columns"],
+    }
+
+def remove_subject(stats, subject:str, y):
+    '''
+    Remove a subject from the statistics of a group model (new statistics are returned, the input is not changed).
+
+    Args
+        stats: statistics of the group model
+        subject: subject id
+        y: map of the subject (the same values it was added with)
+
+    Returns
+        stats: statistics without the subject
+    '''
+    if subject not in stats["subjects"]:
+        raise ValueError(f"Subject {subject} is not in the group model")
+
+    x = np.asarray(stats["subjects"][subject])
+    y = np.asarray(y, dtype=np.float64)
+
+    return {
+        "XtX": stats["XtX"] - np.outer(x, x),
+        "XtY": stats["XtY"] - x[:, None] * y[None, :],
+        "YtY": stats["YtY"] - y ** 2,
+        "subjects": {name: row for name, row in stats["subjects"].items() if name != subject},
+        "columns": stats["columns"],
+    }
+
+def select_voxels(stats, columns):
+    '''
+    Statistics of a subset of the voxels (e.g., the voxels of the current group mask). The statistics of each voxel are independent of the others.
+    '''
+    return {**stats, "XtY": stats["XtY"][:, columns], "YtY": stats["YtY"][columns]}
+
+def fit_group_stats(stats, columns=None):
+    '''
+    Fit the OLS model from the statistics of a group model (the same fit as fit_ols on the stacked maps of its subjects).
+
+    Args
+        stats: statistics of the group model
+        columns: indices of the voxels to fit (e.g., the voxels of the current group mask). If None, all voxels
+
+    Returns
+        fit: fitted OLS model (see fit_ols)
+    '''
+    if columns is not None:
+        stats = select_voxels(stats, columns)
+
+    XtY, YtY = stats["XtY"], stats["YtY"]
+
+    cov = np.linalg.pinv(stats["XtX"])
+    dof = len(stats["subjects"]) - np.linalg.matrix_rank(stats["XtX"])
+
+    if dof <= 0:
+        raise ValueError(f"The group model has no residual degrees of freedom ({len(stats['subjects'])} subjects)")
+
+    beta = cov @ XtY
+
+    # residual sum of squares: Y'Y - b'X'Y (clipped, as rounding can make it slightly negative for voxels with a perfect fit)
+    rss = np.maximum(YtY - np.einsum("pv,pv->v", beta, XtY), 0)
+
+    return {"beta": beta.astype(np.float32), "sigma2": (rss / dof).astype(np.float32), "dof": int(dof), "cov": cov, "columns": stats["columns"]}
+
+def leave_one_subject_out(stats, Y, subjects:list, contrasts:dict={"intercept": "intercept"}, output_types:list=["z_score"], columns=None):
+    '''
+    Leave-one-subject-out analysis: the group contrasts without each subject, from one set of statistics (one downdate per subject, no refit of all subjects).
+
+    Args
+        stats: statistics of the group model with all subjects
+        Y: maps of the subjects (n_subjects, n_voxels), in the order of subjects (the values they were added with, on the voxels in columns if given)
+        subjects: subject ids of the rows of Y
+        contrasts, output_types: see compute_group_contrasts
+        columns: indices of the voxels to fit (see fit_group_stats)
+
+    Returns
+        maps: dictionary of left out subject -> contrast name -> output type -> values
+    '''
+    if columns is not None:
+        stats = select_voxels(stats, columns)
+
+    return {subject: compute_group_contrasts(fit_group_stats(remove_subject(stats, subject, Y[row])), contrasts, output_types) for row, subject in enumerate(subjects)}
+
+def save_group_stats(stats, stats_path:pathlib.Path, voxels=None, versions:dict=None):
+    '''
+    Save the statistics of a group model (arrays as .npy named by their content, and a JSON header that is replaced last, under a lock).
+
+    Args
+        stats: statistics of the group model
+        stats_path: folder to save the statistics in
+        voxels: flat indices of the voxels of the statistics (saved to check that a later update uses the same voxels)
+        versions: version of the first level model of every subject in the statistics (e.g., flm_store.store_key)
+    '''
+    stats_path = pathlib.Path(stats_path)
+    stats_path.mkdir(parents=True, exist_ok=True)
+
+    arrays = {"XtY": stats["XtY"], "YtY": stats["YtY"]}
+    if voxels is not None:
+        arrays["voxels"] = np.asarray(voxels)
+
+    token = hash_params({name: hash_array(array) for name, array in arrays.items()})[:16]
+    header = {"XtX": stats["XtX"].tolist(), "subjects": stats["subjects"], "columns": stats["columns"], "versions": versions or {}, "arrays": {name: f"{name}-{token}.npy" for name in arrays}}
+
+    with open(stats_path / ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        for name, array in arrays.items():
+            buffer = io.BytesIO()
+            np.save(buffer, array)
+            write_atomic(stats_path / header["arrays"][name], buffer.getvalue())
+
+        write_atomic(stats_path / "header.json", json.dumps(header, indent=2).encode())
+
+        # arrays of earlier saves
+        for path in stats_path.glob("*.npy"):
+            if path.name not in header["arrays"].values():
+                path.unlink(missing_ok=True)
+
+def load_group_stats(stats_path:pathlib.Path):
+    '''
+    Load the statistics of a group model (None if none are saved, or if they were replaced while loading).
+
+    Returns
+        stats: statistics of the group model (see group_stats)
+        voxels: flat indices of the voxels of the statistics (None if they were not saved)
+        versions: version of the first level model of every subject in the statistics (see save_group_stats)
+    '''
+    stats_path = pathlib.Path(stats_path)
+
+    try:
+        with open(stats_path / "header.json") as f:
+            header = json.load(f)
+
+        arrays = {name: np.load(stats_path / file_name) for name, file_name in header["arrays"].items()}
+    except (FileNotFoundError, KeyError):
+        return None, None, {}
+
+    stats = {
+        "XtX": np.array(header["XtX"]),
+        "XtY": arrays["XtY"],
+        "YtY": arrays["YtY"],
+        "subjects": header["subjects"],
+        "columns": header["columns"],
+    }
+
+    return stats, arrays.get("voxels"), header["versions"]
@@ -0,0 +1,246 @@
+'''
+Non-parametric group inference with sign-flip permutations and threshold-free cluster enhancement (TFCE).
+'''
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import ndimage
+from scipy.stats import t as t_dist
+
+from workers import limit_worker_threads
+
+# data shared with the worker processes (set once per worker, see init_worker)
+WORKER_DATA = {}
+
+def sign_flips(n_subjects:int, n_permutations:int, random_state:int=None):
+    '''
+    Sign flips of the subjects (one row per permutation, the first row is the original data). All sign flips if there are no more than n_permutations + 1, random otherwise.
+    '''
+    if 2 ** n_subjects <= n_permutations + 1:
+        # bit k of the row number flips subject k (row 0 flips none)
+        bits = (np.arange(2 ** n_subjects)[:, None] >> np.arange(n_subjects)[None, :]) & 1
+
+        return (1 - 2 * bits).astype(np.float32)
+
+    rng = np.random.default_rng(random_state)
+    flips = rng.choice(np.array([-1, 1], dtype=np.float32), size=(n_permutations + 1, n_subjects))
+    flips[0] = 1
+
+    return flips
+
+def flipped_t(Y, flips):
+    '''
+    One sample t maps of several sign flips at once.
+
+    Args
+        Y: array of shape (n_subjects, n_voxels)
+        flips: array of shape (n_flips, n_subjects) with the signs (output of sign_flips)
+
+    Returns
+        t: array of shape (n_flips, n_voxels)
+    '''
+    n = Y.shape[0]
+
+    # the sum of squares is the same for all sign flips, only the mean changes
+    mean = (flips @ Y) / n
+    sum_squares = np.einsum("ij,ij->j", Y, Y, dtype=np.float64)
+
+    var = (sum_squares[None, :] - n * mean.astype(np.float64) ** 2) / (n - 1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(var > 0, mean / np.sqrt(var / n), 0)
+
+    return t.astype(np.float32)
+
+def to_volumes(values, grid_index, box_shape):
+    '''
+    Put the values of the voxels of several maps into volumes cropped to the bounding box of the mask (zero outside the mask).
+
+    Args
+        values: array of shape (n_maps, n_voxels)
+        grid_index: flat index of every voxel in the bounding box
+        box_shape: shape of the bounding box
+    '''
+    volumes = np.zeros((values.shape[0], int(np.prod(box_shape))), dtype=np.float32)
+    volumes[:, grid_index] = values
+
+    return volumes.reshape(values.shape[0], *box_shape)
+
+def tfce(volumes, dh:float, E:float=0.5, H:float=2.0, connectivity:int=1):
+    '''
+    Threshold-free cluster enhancement (Smith & Nichols, 2009) of the positive values of several maps at once.
+
+    Args
+        volumes: array of shape (n_maps, x, y, z)
+        dh: step between the thresholds
+        E, H: exponents of the cluster extent and height
+        connectivity: connectivity of the voxels (1 = faces, 2 = edges, 3 = corners, as scipy.ndimage.generate_binary_structure)
+
+    Returns
+        scores: array of the same shape as volumes
+    '''
+    # neighbours within each map only (no connections along the first axis)
+    structure = np.zeros((3, 3, 3, 3), dtype=bool)
+    structure[1] = ndimage.generate_binary_structure(3, connectivity)
+
+    scores = np.zeros(volumes.shape, dtype=np.float32)
+    map_max = volumes.reshape(len(volumes), -1).max(axis=1)
+
+    for h in np.arange(dh, map_max.max() + dh, dh):
+        # only maps with voxels above the threshold are labelled (most null maps drop out after the first thresholds)
+        active = np.flatnonzero(map_max >= h)
+        if active.size == 0:
+            break
+
+        labels, _ = ndimage.label(volumes[active] >= h, structure=structure)
+
+        # contribution of every cluster (extent^E * h^H * dh), given to its voxels
+        weights = np.bincount(labels.ravel()).astype(np.float32) ** E * (h ** H) * dh
+        weights[0] = 0
+
+        scores[active] += weights[labels]
+
+    return scores
+
+def max_cluster_sizes(volumes, threshold:float, connectivity:int=1):
+    '''
+    Size of the largest cluster above the threshold (either sign) of every map.
+    '''
+    structure = np.zeros((3, 3, 3, 3), dtype=bool)
+    structure[1] = ndimage.generate_binary_structure(3, connectivity)
+
+    sizes = np.zeros(volumes.shape[0], dtype=np.int64)
+    map_index = np.repeat(np.arange(volumes.shape[0]), volumes[0].size)
+
+    for above in [volumes >= threshold, volumes <= -threshold]:
+        labels, n_labels = ndimage.label(above, structure=structure)
+        if n_labels == 0:
+            continue
+
+        # map of every cluster (all voxels of a cluster are in the same map)
+        map_of_label = np.zeros(n_labels + 1, dtype=np.int64)
+        map_of_label[labels.ravel()] = map_index
+
+        extents = np.bincount(labels.ravel(), minlength=n_labels + 1)
+        np.maximum.at(sizes, map_of_label[1:], extents[1:])
+
+    return sizes
+
+def fwe_pvalues(null_max, observed):
+    '''
+    FWE corrected p-values from the null distribution of the maxima (which includes the original data, kept in it with a small tolerance).
+    '''
+    null_max = np.sort(null_max)
+    observed = np.abs(observed) * (1 - 1e-6)
+
+    return (len(null_max) - np.searchsorted(null_max, observed, side="left")) / len(null_max)
+
+def signed_tfce(volumes, dh:float, E:float=0.5, H:float=2.0, connectivity:int=1):
+    '''
+    TFCE of the positive and negative values of several maps (negative scores for negative values).
+    '''
+    return tfce(volumes, dh, E, H, connectivity) - tfce(-volumes, dh, E, H, connectivity)
+
+def init_worker(data:dict):
+    '''
+    Share the stacked maps and the geometry with a worker process (sent once per worker instead of once per chunk).
+    The worker uses one BLAS thread, as the chunks are already spread over the cores.
+    '''
+    limit_worker_threads(1)
+    WORKER_DATA.update(data)
+
+def permutation_chunk(flips, dh:float, cluster_threshold:float, E:float=0.5, H:float=2.0, connectivity:int=1):
+    '''
+    Maxima of a chunk of sign flips (worker function for sign_flip_inference).
+
+    Returns
+        max_t, max_tfce, max_cluster: maximum absolute t, maximum absolute TFCE score and largest cluster of every permutation in the chunk
+    '''
+    t = flipped_t(WORKER_DATA["Y"], flips)
+    volumes = to_volumes(t, WORKER_DATA["grid_index"], WORKER_DATA["box_shape"])
+
+    max_t = np.abs(t).max(axis=1)
+    max_tfce = np.abs(signed_tfce(volumes, dh, E, H, connectivity)).reshape(len(flips), -1).max(axis=1)
+    max_cluster = max_cluster_sizes(volumes, cluster_threshold, connectivity)
+
+    return max_t, max_tfce, max_cluster
+
+def sign_flip_inference(Y, mask, n_permutations:int=5000, cluster_pval:float=0.001, n_steps:int=100, E:float=0.5, H:float=2.0, connectivity:int=1, chunk_size:int=50, n_jobs:int=-1, random_state:int=2502):
+    '''
+    Sign-flip permutation test of a one sample t test with TFCE, with FWE corrected voxel, TFCE and cluster p-values (two-sided).
+
+    Args
+        Y: stacked subject maps, array of shape (n_subjects, n_voxels) (e.g., output of group_ols.stack_effect_maps)
+        mask: group mask of the columns of Y (stored mask, see masks.py)
+        n_permutations: number of sign flips (on top of the original data). All 2^n_subjects sign flips are used if there are not more than that (see sign_flips)
+        cluster_pval: uncorrected p-value of the cluster-forming threshold (converted to a t value)
+        n_steps: number of TFCE thresholds up to the maximum of the original t map
+        E, H, connectivity: TFCE parameters (see tfce)
+        chunk_size: number of permutations processed at once (bounds the memory to about 3 * chunk_size volumes)
+        n_jobs: number of worker processes. If -1, all cores
+        random_state: seed of the sign flips
+
+    Returns
+        results: dictionary with the "t" and "tfce" maps of the original data, the FWE corrected p-values "p_voxel_fwe" (max t), "p_tfce_fwe" (max TFCE)
+                 and "p_cluster_fwe" (max cluster size, 1 outside clusters) of every voxel, and the null distributions "null_max_t", "null_max_tfce" and "null_max_cluster"
+    '''
+    Y = np.asarray(Y, dtype=np.float32)
+    n_subjects = Y.shape[0]
+
+    # bounding box of the mask (the volumes are cropped to it)
+    coords = np.array(np.unravel_index(np.asarray(mask["voxels"]), mask["shape"]))
+    origin = coords.min(axis=1)
+    box_shape = tuple(coords.max(axis=1) - origin + 1)
+    grid_index = np.ravel_multi_index(tuple(coords - origin[:, None]), box_shape)
+
+    flips = sign_flips(n_subjects, n_permutations, random_state)
+    cluster_threshold = t_dist.isf(cluster_pval, n_subjects - 1)
+
+    # original data (the TFCE step is fixed by its maximum, as in FSL's randomise)
+    t_orig = flipped_t(Y, flips[:1])
+    dh = max(float(np.abs(t_orig).max()), 1e-6) / n_steps
+
+    volume_orig = to_volumes(t_orig, grid_index, box_shape)
+    tfce_orig = signed_tfce(volume_orig, dh, E, H, connectivity).reshape(1, -1)[:, grid_index][0]
+
+    # permutations in chunks (the first chunk includes the original data, as the observed statistic is part of the null distribution)
+    chunks = [flips[start:start + chunk_size] for start in range(0, len(flips), chunk_size)]
+    data = {"Y": Y, "grid_index": grid_index, "box_shape": box_shape}
+
+    n_jobs = (os.cpu_count() or 1) if n_jobs == -1 else n_jobs
+
+    if n_jobs == 1:
+        WORKER_DATA.update(data)
+        maxima = [permutation_chunk(chunk, dh, cluster_threshold, E, H, connectivity) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(chunks)), initializer=init_worker, initargs=(data,)) as executor:
+            maxima = list(executor.map(permutation_chunk, chunks, *[[arg] * len(chunks) for arg in [dh, cluster_threshold, E, H, connectivity]]))
+
+    null_max_t, null_max_tfce, null_max_cluster = [np.concatenate(values) for values in zip(*maxima)]
+
+    # FWE corrected p-values of the voxels and TFCE scores
+    p_voxel = fwe_pvalues(null_max_t, t_orig[0])
+    p_tfce = fwe_pvalues(null_max_tfce, tfce_orig)
+
+    # cluster p-values of the clusters of the original data (either sign, 1 outside clusters)
+    structure = ndimage.generate_binary_structure(3, connectivity)
+    p_cluster = np.ones(len(grid_index))
+
+    for above in [volume_orig[0] >= cluster_threshold, volume_orig[0] <= -cluster_threshold]:
+        labels, n_labels = ndimage.label(above, structure=structure)
+        voxel_labels = labels.ravel()[grid_index]
+
+        cluster_p = fwe_pvalues(null_max_cluster, np.bincount(voxel_labels, minlength=n_labels + 1))
+        p_cluster = np.where(voxel_labels > 0, cluster_p[voxel_labels], p_cluster)
+
+    return {
+        "t": t_orig[0],
+        "tfce": tfce_orig.astype(np.float32),
+        "p_voxel_fwe": p_voxel,
+        "p_tfce_fwe": p_tfce,
+        "p_cluster_fwe": p_cluster,
+        "null_max_t": null_max_t,
+        "null_max_tfce": null_max_tfce,
+        "null_max_cluster": null_max_cluster,
+    }
@@ -0,0 +1,201 @@
+'''
+Reading of the BIDS inputs with an on-disk cache: the columns of the tables (events and confounds) and the headers of the images.
+'''
+import pathlib
+import io
+import json
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+from cache import hash_params, write_atomic
+
+def table_cache_path(path:pathlib.Path, cache_dir:pathlib.Path):
+    '''
+    Folder of the cached columns of a file. Each file has one folder (keyed by its path) with a subfolder per version (keyed by its size and modification time).
+
+    Returns
+        file_path: folder of the file (holds all versions)
+        version_path: folder of the current version of the file
+    '''
+    stat = path.stat()
+    file_path = pathlib.Path(cache_dir) / hash_params(str(path.resolve()))
+
+    return file_path, file_path / f"{stat.st_size}_{stat.st_mtime_ns}"
+
+def column_file_path(version_path:pathlib.Path, column:str):
+    '''
+    Path of a cached column (e.g., "trans_x" -> trans_x_ed3f0cf5.npy). The name ends with a hash of the column, as names that only differ in replaced characters must not share a file.
+    '''
+    column_name = re.sub(r"[^\w.+-]", "_", column) + "_" + hash_params(column)[:8]
+
+    return version_path / f"{column_name}.npy"
+
+def save_column(version_path:pathlib.Path, column:str, values:pd.Series):
+    '''
+    Save a parsed column as .npy (text columns with a mask of missing values and their dtype in a header, columns of mixed types are not cached).
+    '''
+    column_file = column_file_path(version_path, column)
+
+    if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+        write_npy(column_file, values.to_numpy())
+        return
+
+    if not all(isinstance(value, str) for value in values.dropna()):
+        return
+
+    if isinstance(values.dtype, pd.StringDtype):
+        dtype = {"dtype": "string", "storage": values.dtype.storage, "na_value": "NA" if values.dtype.na_value is pd.NA else "nan"}
+    else:
+        dtype = {"dtype": "object"}
+    write_atomic(column_file.with_suffix(".json"), json.dumps(dtype).encode())
+
+    missing = values.isna().to_numpy()
+    if missing.any():
+        write_npy(column_file.with_suffix(".na.npy"), missing)
+
+    # the values are written last, so a column is only loaded once its mask and dtype are written
+    write_npy(column_file, values.to_numpy(dtype=object, na_value="").astype(str))
+
+def load_column(version_path:pathlib.Path, column:str):
+    '''
+    Load a cached column, with the dtype it was parsed with (None if it is not cached).
+    '''
+    column_file = column_file_path(version_path, column)
+
+    try:
+        values = np.load(column_file)
+    except FileNotFoundError:
+        return None
+
+    if values.dtype.kind != "U":
+        return pd.Series(values, name=column)
+
+    # restore missing values and the dtype of text columns
+    dtype = json.loads(column_file.with_suffix(".json").read_text())
+
+    values = values.astype(object)
+    if column_file.with_suffix(".na.npy").exists():
+        values[np.load(column_file.with_suffix(".na.npy"))] = np.nan
+
+    if dtype["dtype"] == "string":
+        return pd.Series(values, name=column, dtype=pd.StringDtype(storage=dtype["storage"], na_value=pd.NA if dtype["na_value"] == "NA" else np.nan))
+
+    return pd.Series(values, name=column, dtype=object)
+
+def write_npy(file_path:pathlib.Path, array):
+    '''
+    Save an array as .npy in one atomic write (several workers can read the same tables at the same time).
+    '''
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+
+    write_atomic(file_path, buffer.getvalue())
+
+def read_table(path:pathlib.Path, columns:list, cache_dir:pathlib.Path=None, sep:str="\t"):
+    '''
+    Read some columns of a TSV file.
+
+    Args
+        path: path to the file
+        columns: columns to read (in this order)
+        cache_dir: path to the columnar cache. If None, the file is always parsed
+        sep: separator of the file
+
+    Returns
+        df: dataframe with the requested columns
+    '''
+    path = pathlib.Path(path)
+
+    if cache_dir is None:
+        return pd.read_csv(path, sep=sep, usecols=columns).loc[:, columns]
+
+    file_path, version_path = table_cache_path(path, cache_dir)
+
+    # cached columns
+    cached = {column: load_column(version_path, column) for column in columns}
+    missing = [column for column, values in cached.items() if values is None]
+
+    # parse only the columns that are not cached yet
+    if missing:
+        parsed = pd.read_csv(path, sep=sep, usecols=missing)
+
+        # the file changed, so the columns of its old versions are outdated
+        if not version_path.exists():
+            shutil.rmtree(file_path, ignore_errors=True)
+        version_path.mkdir(parents=True, exist_ok=True)
+
+        for column in missing:
+            save_column(version_path, column, parsed[column])
+            cached[column] = parsed[column]
+
+    return pd.DataFrame({column: cached[column] for column in columns})
+
+def probe_image(path:pathlib.Path, cache_dir:pathlib.Path=None):
+    '''
+    Read the TR, shape and affine of an image from its header, without reading the voxel data.
+    The TR is taken from the BIDS JSON sidecar if it is not in the header.
+
+    Args
+        path: path to the image (e.g., a BOLD series)
+        cache_dir: path to the cache (the metadata is cached per file, keyed by its path, size and modification time). If None, the header is always read
+
+    Returns
+        metadata: dictionary with the "tr" (in seconds, 0 if unknown), "shape" and "affine" of the image
+    '''
+    path = pathlib.Path(path)
+
+    if cache_dir is not None:
+        stat = path.stat()
+        probe_file = pathlib.Path(cache_dir) / "headers" / f"{hash_params([str(path.resolve()), stat.st_size, stat.st_mtime_ns])}.json"
+
+        if probe_file.exists():
+            return json.loads(probe_file.read_text())
+
+    # only the header is read (the data of the image is loaded lazily)
+    header = nib.load(path).header
+
+    # TR from the header (pixdim[4], as in nibabel https://nipy.org/nibabel/devel/biaps/biap_0006.html)
+    tr = float(header["pixdim"][4]) if len(header.get_data_shape()) > 3 else 0.0
+
+    if tr == 0:
+        sidecar = path.with_name(path.name.split(".")[0] + ".json")
+        if sidecar.exists():
+            tr = float(json.loads(sidecar.read_text()).get("RepetitionTime", 0))
+
+    metadata = {"tr": tr, "shape": [int(n) for n in header.get_data_shape()], "affine": header.get_best_affine().tolist()}
+
+    if cache_dir is not None:
+        probe_file.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(probe_file, json.dumps(metadata).encode())
+
+    return metadata
+
+def check_run_geometry(paths:list, cache_dir:pathlib.Path=None):
+    '''
+    Check that all runs of a subject have the same TR and voxel grid (shape and affine), from their headers only.
+    Used before fitting, so a mismatch fails immediately instead of after loading the data.
+
+    Args
+        paths: paths to the images of all runs
+        cache_dir: path to the cache (see probe_image)
+
+    Returns
+        metadata: metadata of the first run (see probe_image)
+    '''
+    if len(paths) == 0:
+        raise ValueError("No runs to check (no images found)")
+
+    runs = [probe_image(path, cache_dir) for path in paths]
+
+    for path, run in zip(paths[1:], runs[1:]):
+        if run["shape"][:3] != runs[0]["shape"][:3] or not np.allclose(run["affine"], runs[0]["affine"]):
+            raise ValueError(f"{pathlib.Path(path).name} is not on the same voxel grid as {pathlib.Path(paths[0]).name}")
+
+        if not np.isclose(run["tr"], runs[0]["tr"]):
+            raise ValueError(f"{pathlib.Path(path).name} has another TR ({run['tr']}) than {pathlib.Path(paths[0]).name} ({runs[0]['tr']})")
+
+    return runs[0]
@@ -0,0 +1,225 @@
+'''
+Store of the subject and group masks (packed bits and flat voxel indices).
+'''
+import pathlib
+import json
+
+import numpy as np
+import nibabel as nib
+from nilearn import masking
+from nilearn.image import load_img, resample_img
+
+from cache import hash_file, hash_params, hash_array, write_atomic
+from ingest import write_npy
+
+def mask_from_img(mask_img):
+    '''
+    Get the voxels of a mask image as a boolean volume.
+    '''
+    mask_img = load_img(mask_img)
+
+    return np.asarray(mask_img.dataobj) != 0
+
+def save_mask_store(mask_img, name:str, masks_path:pathlib.Path, key:str=None):
+    '''
+    Save a mask as packed bits and flat voxel indices.
+
+    Args
+        mask_img: mask image (3D)
+        name: name of the mask (e.g., "sub-0116" or "group")
+        masks_path: path to the store (a folder with the name of the mask is made here)
+        key: key of the inputs of the mask (see subject_mask). If None, the mask is never reused
+
+    Returns
+        mask: the stored mask (output of load_mask_store)
+    '''
+    mask_img = load_img(mask_img)
+    mask = mask_from_img(mask_img)
+
+    mask_path = pathlib.Path(masks_path) / name
+    mask_path.mkdir(parents=True, exist_ok=True)
+
+    write_npy(mask_path / "bits.npy", np.packbits(mask.ravel()))
+    write_npy(mask_path / "voxels.npy", np.flatnonzero(mask))
+
+    # header is written last, so a mask is only found once its arrays are complete
+    header = {"shape": list(mask.shape), "affine": np.asarray(mask_img.affine).tolist(), "n_voxels": int(mask.sum()), "key": key}
+    write_atomic(mask_path / "header.json", json.dumps(header, indent=2).encode())
+
+    return load_mask_store(masks_path, name)
+
+def load_mask_store(masks_path:pathlib.Path, name:str):
+    '''
+    Load a stored mask.
+
+    Returns
+        mask: dictionary with the packed "bits", the flat indices of the "voxels", the "shape" and "affine" of the grid and the "key" of its inputs.
+              None if the mask is not stored
+    '''
+    mask_path = pathlib.Path(masks_path) / name
+
+    try:
+        with open(mask_path / "header.json") as f:
+            header = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    return {
+        "bits": np.load(mask_path / "bits.npy"),
+        "voxels": np.load(mask_path / "voxels.npy", mmap_mode="r"),
+        "shape": header["shape"],
+        "affine": np.array(header["affine"]),
+        "key": header["key"],
+    }
+
+def mask_to_img(mask):
+    '''
+    Rebuild the mask image of a stored mask (int8, as nilearn's intersect_masks).
+    '''
+    volume = np.unpackbits(mask["bits"], count=int(np.prod(mask["shape"]))).astype(np.int8)
+
+    return nib.Nifti1Image(volume.reshape(mask["shape"]), mask["affine"])
+
+def subject_mask(mask_paths:list, name:str=None, masks_path:pathlib.Path=None, threshold:float=0.8):
+    '''
+    Intersection of the run masks of a subject (nilearn's intersect_masks), computed once and stored.
+
+    Args
+        mask_paths: paths to the run masks
+        name: name of the mask in the store (e.g., "sub-0116")
+        masks_path: path to the mask store. If None, the mask is always computed and not stored
+        threshold: fraction of runs a voxel needs to be in (see nilearn.masking.intersect_masks)
+
+    Returns
+        mask_img: mask image of the subject
+    '''
+    if masks_path is None:
+        return masking.intersect_masks([nib.load(path) for path in mask_paths], threshold=threshold)
+
+    # reuse the stored mask if the run masks did not change
+    key = hash_params({"masks": [hash_file(path) for path in mask_paths], "threshold": threshold})
+    mask = load_mask_store(masks_path, name)
+
+    if mask is not None and mask["key"] == key:
+        return mask_to_img(mask)
+
+    mask_img = masking.intersect_masks([nib.load(path) for path in mask_paths], threshold=threshold)
+    save_mask_store(mask_img, name, masks_path, key=key)
+
+    return mask_img
+
+def intersect_mask_stores(masks, threshold:float=1):
+    '''
+    Intersection of stored masks on the same grid (as nilearn's intersect_masks with connected=False). With threshold 1, the packed bits are intersected directly.
+    The masks are read one at a time, so they can come from a generator or a lazy dictionary (e.g., utils.load_masks(...).values()).
+
+    Args
+        masks: stored masks (output of load_mask_store)
+        threshold: fraction of masks a voxel needs to be in (1 = all masks, 0 = the union of the masks)
+
+    Returns
+        mask: intersection of the masks (dictionary as the output of load_mask_store, not stored)
+    '''
+    first, bits, counts, n_masks = None, None, None, 0
+
+    for mask in masks:
+        if first is None:
+            first = mask
+            n_grid = int(np.prod(first["shape"]))
+        elif mask["shape"] != first["shape"] or not np.allclose(mask["affine"], first["affine"]):
+            raise ValueError("Masks must be on the same grid to be intersected")
+
+        if threshold >= 1:
+            bits = mask["bits"].copy() if bits is None else np.bitwise_and(bits, mask["bits"])
+        else:
+            # count per voxel (same rule as nilearn's intersect_masks)
+            if counts is None:
+                counts = np.zeros(n_grid, dtype=np.int32)
+            counts += np.unpackbits(mask["bits"], count=n_grid)
+
+        n_masks += 1
+
+    if first is None:
+        raise ValueError("No masks to intersect")
+
+    if threshold < 1:
+        bits = np.packbits(counts > threshold * n_masks)
+
+    return {
+        "bits": bits,
+        "voxels": np.flatnonzero(np.unpackbits(bits, count=n_grid)),
+        "shape": first["shape"],
+        "affine": first["affine"],
+        "key": None,
+    }
+
+def group_mask(names:list, masks_path:pathlib.Path, threshold:float=1, group_name:str="group"):
+    '''
+    Intersection of the stored masks of several subjects, computed once and stored as group_name (recomputed if the subject masks changed).
+
+    Args
+        names: names of the subject masks (e.g., ["sub-0116", "sub-0117"])
+        masks_path: path to the mask store
+        threshold: fraction of subjects a voxel needs to be in (see intersect_mask_stores)
+        group_name: name of the group mask in the store
+
+    Returns
+        mask: stored group mask (output of load_mask_store)
+    '''
+    masks = [load_mask_store(masks_path, name) for name in names]
+
+    missing = [name for name, mask in zip(names, masks) if mask is None]
+    if missing:
+        raise FileNotFoundError(f"No stored mask for {', '.join(missing)} in {masks_path}")
+
+    key = hash_params({"masks": [hash_array(mask["bits"]) for mask in masks], "threshold": threshold})
+    stored = load_mask_store(masks_path, group_name)
+
+    if stored is not None and stored["key"] == key:
+        return stored
+
+    return save_mask_store(mask_to_img(intersect_mask_stores(masks, threshold)), group_name, masks_path, key=key)
+
+def mask_voxels(mask_img, shape, affine):
+    '''
+    Flat indices of the voxels of a mask on a grid. The mask is only resampled (nearest neighbour) if it is not on that grid already.
+
+    Args
+        mask_img: mask image or stored mask (output of load_mask_store)
+        shape, affine: grid (e.g., of the beta maps)
+
+    Returns
+        voxels: flat indices of the voxels in the mask
+    '''
+    if isinstance(mask_img, dict):
+        if list(mask_img["shape"]) == list(shape[:3]) and np.allclose(mask_img["affine"], affine):
+            return np.asarray(mask_img["voxels"])
+        mask_img = mask_to_img(mask_img)
+
+    mask_img = load_img(mask_img)
+
+    if mask_img.shape[:3] != tuple(shape[:3]) or not np.allclose(mask_img.affine, affine):
+        mask_img = resample_img(mask_img, target_affine=affine, target_shape=tuple(shape[:3]), interpolation="nearest")
+
+    return np.flatnonzero(np.asarray(mask_img.dataobj))
+
+def values_to_img(values, mask):
+    '''
+    Put the values of the voxels of a stored mask back into a volume (Nifti image, zero outside the mask).
+
+    Args
+        values: array of shape (n_voxels,), or (n_maps, n_voxels) for a 4D image
+        mask: stored mask (output of load_mask_store or intersect_mask_stores)
+    '''
+    values = np.asarray(values, dtype=np.float32)
+    n_grid = int(np.prod(mask["shape"]))
+
+    if values.ndim == 1:
+        volume = np.zeros(n_grid, dtype=np.float32)
+        volume[mask["voxels"]] = values
+        return nib.Nifti1Image(volume.reshape(mask["shape"]), mask["affine"])
+
+    volumes = np.zeros((n_grid, values.shape[0]), dtype=np.float32)
+    volumes[mask["voxels"]] = values.T
+
+    return nib.Nifti1Image(volumes.reshape(*mask["shape"], values.shape[0]), mask["affine"])
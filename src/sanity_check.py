@@ -4,32 +4,30 @@ Perform sanity check using the first level models
 
 import pathlib
 import pickle
+import math
 from nilearn import plotting
 import matplotlib.pyplot as plt
 from nilearn.glm import threshold_stats_img
 import pandas as pd
 
 # custom packages
-from utils import load_all_flms
+from utils import load_contrast_maps
 from first_level import get_paths, get_events
+from bids_index import list_subjects
 
-def plot_contrasts(subject, flm, ax, contrast = "button_press"):
+def plot_contrasts(subject, zmap, ax):
     '''
     Plot contrast for a given subject against "baseline" (see notebook 13)
 
     Args
         subject: subject id
-        flm: first level model
+        zmap: z-score map of the contrast (e.g., from utils.load_contrast_maps)
         ax: axis to plot on
-        contrast: contrast to plot
     '''
 
-    # compute the contrast
-    contrast = flm.compute_contrast(contrast, output_type = "z_score")
-
     # make bonferroni correction
     contrast, threshold = threshold_stats_img(
-            contrast, 
+            zmap, 
             alpha=0.05, 
             height_control='bonferroni')
     
@@ -42,26 +40,41 @@ def plot_contrasts(subject, flm, ax, contrast = "button_press"):
     
     ax.set_title(f"Participant: {subject}")
 
-def plot_all_subjects_contrasts(flms, save_path):
-    
-    # set the canvas
-    fig, axes = plt.subplots(4,2,figsize=(10, 12))
+def plot_all_subjects_contrasts(zmaps, save_path):
+    '''
+    Plot the contrast of all subjects 
+
+    Args
+        zmaps: dictionary of subject id -> z-score map of the contrast (output of utils.load_contrast_maps)
+        save_path: path to save the plot
+    '''
+    # set the canvas (two subjects per row)
+    n_rows = math.ceil(len(zmaps) / 2)
+    fig, axes = plt.subplots(n_rows, 2, figsize=(10, 3 * n_rows), squeeze=False)
 
     # iterate over each subject in dictionary
-    for i, subject_id in enumerate(flms):
-        flm = flms[subject_id]
+    for i, subject_id in enumerate(zmaps):
+        zmap = zmaps[subject_id]
         
         # flatten axes
         ax = axes.flatten()[i]
 
         # plot contrasts
-        plot_contrasts(subject = subject_id, flm = flm, ax = ax, contrast = "button_press")
+        plot_contrasts(subject = subject_id, zmap = zmap, ax = ax)
 
     # save fig 
     if save_path: 
         plt.savefig(save_path)
 
-def get_button_press_per_run(bids_path, subjects_list,):
+def get_button_press_per_run(bids_path, subjects_list, table_cache=None):
+    '''
+    Count the button presses of every run of every subject.
+
+    Args
+        bids_path: path to bids directory (root)
+        subjects_list: list of subject IDs
+        table_cache: path to the columnar cache of the events (see ingest.read_table)
+    '''
     subject_counts = {}
 
     for subject in subjects_list: 
@@ -69,7 +82,7 @@ def get_button_press_per_run(bids_path, subjects_list,):
         fprep_f_paths, event_paths, confounds_paths, mask_paths = get_paths(bids_path, subject, n_runs=6)
 
         # get events df 
-        events = get_events(event_paths, drop_RT=False)
+        events = get_events(event_paths, drop_RT=False, table_cache=table_cache)
 
         # get number of button presses
         BP_per_run = {}
@@ -94,8 +107,9 @@ def plot_button_press_counts(counts_df, highlight_subjects, save_path=None):
     '''
     Plotting button press counts from a counts df using pandas 
     '''
-    # create subplots
-    fig, axes = plt.subplots(nrows=4, ncols=2, figsize=(10, 12))
+    # create subplots (two subjects per row)
+    n_rows = math.ceil(len(counts_df.columns) / 2)
+    fig, axes = plt.subplots(nrows=n_rows, ncols=2, figsize=(10, 3 * n_rows), squeeze=False)
     axes = axes.flatten()
 
     # set the plots
@@ -124,8 +138,8 @@ def test():
     save_path = path.parents[1] / "results"
     save_path.mkdir(parents=True, exist_ok=True)
     
-    subjects = ["0116", "0117", "0118", "0119", "0120", "0121", "0122", "0123"]
-    counts = get_button_press_per_run(bids_path, subjects)
+    subjects = list_subjects(bids_path, exclude_subjects=[])
+    counts = get_button_press_per_run(bids_path, subjects, table_cache=path.parents[1] / "data" / "cache" / "tables")
     print(counts)
 
     plot_button_press_counts(counts, highlight_subjects = ["0119"], save_path = save_path / "button_press_sanity_check.png")
@@ -138,15 +152,16 @@ def main():
     results_path = path.parents[1] / "results"
     results_path.mkdir(parents=True, exist_ok=True)
     
-    # plot contrasts
-    flms = load_all_flms(data_path / "all_flms")
-    plot_all_subjects_contrasts(flms, save_path = results_path / "contrast_sanity_check.png")
+    # plot contrasts (z-maps of the button press are read from the contrast cache, see flm_store.py, one subject at a time while the next one is prefetched)
+    zmaps = load_contrast_maps(data_path / "flm_store", "button_press", output_type="z_score")
+    plot_all_subjects_contrasts(zmaps, save_path = results_path / "contrast_sanity_check.png")
 
     # plot button press
     bids_path = path.parents[1] / "data" / "InSpePosNegData" / "BIDS_2023E"
-    subjects = ["0116", "0117", "0118", "0119", "0120", "0121", "0122", "0123"]
+    # all subjects with preprocessed data (0119 is kept, it is the subject the check is about)
+    subjects = list_subjects(bids_path, exclude_subjects=[])
     
-    counts = get_button_press_per_run(bids_path, subjects)
+    counts = get_button_press_per_run(bids_path, subjects, table_cache=data_path / "cache" / "tables")
     plot_button_press_counts(counts, highlight_subjects = ["0119"], save_path = results_path / "button_press_sanity_check.png")
 
 if __name__ == "__main__":
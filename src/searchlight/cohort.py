@@ -0,0 +1,167 @@
+'''
+Searchlight decoding for all subjects (in parallel), followed by the group level test of the accuracy maps.
+'''
+import pathlib, pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# import own functions
+import sys
+sys.path.append(str(pathlib.Path(__file__).parents[2] / "src"))
+
+from workers import split_cores, init_worker
+from second_level import second_level
+from bids_index import list_subjects
+
+from prep import prep_subject
+from train import train_subject
+from permutation import permute_subject
+from samples import load_samples, samples_process_mask
+from masks import intersect_mask_stores, mask_to_img
+
+import numpy as np
+import nibabel as nib
+
+def subject_searchlight_pipeline(bids_path, subject, data_path, n_jobs=1, batch=False, wholebrain=False, cache_dir=None, table_cache=None, bold_cache=None, max_bold_cache_bytes=None):
+    '''
+    Run beta maps, searchlight and permutation tests for a single subject.
+
+    Args
+        bids_path: path to bids directory (root)
+        subject: ID of subject (e.g., "0117")
+        data_path: path to the searchlight folder (each subject gets the folder "sub-{subject}" here)
+        n_jobs: number of processes used within the subject (runs fitted at the same time, whole brain permutation test)
+        batch: classify all pairs of conditions (see train.train_subject)
+        wholebrain: also run the whole brain permutation test (see permutation.permute_subject)
+        cache_dir: path to the sphere neighbourhood cache
+        table_cache: path to the cache of the events, confounds and image headers (see ingest.py)
+        bold_cache, max_bold_cache_bytes: cache of decompressed BOLD series (see prep.flm_new_design_matrix)
+
+    Returns
+        subject: ID of subject (the results are written to disk)
+        finished: names of the contrasts whose searchlight is finished (searchlights still worked on by other processes are left out)
+    '''
+    subject_path = data_path / f"sub-{subject}"
+
+    # beta maps (reused if they exist)
+    b_maps, conditions_label = prep_subject(bids_path, subject, subject_path, n_workers=n_jobs, table_cache=table_cache, bold_cache=bold_cache, max_bold_cache_bytes=max_bold_cache_bytes)
+
+    # searchlight (the sample matrix is reused and the searchlight resumes from its checkpoint)
+    samples, searchlights = train_subject(bids_path, subject, subject_path, batch=batch, cache_dir=cache_dir, b_maps=b_maps, conditions_label=conditions_label)
+
+    finished = [contrast for contrast, searchlight in searchlights.items() if searchlight is not None]
+
+    # searchlights that are not finished yet are finished (and permuted) by another process
+    for contrast in finished:
+        # skip permutation tests done after the searchlight was last fitted
+        results_file = subject_path / f"permutation_results_{contrast}.pkl"
+        if results_file.exists() and results_file.stat().st_mtime >= (subject_path / f"searchlight_{contrast}.pkl").stat().st_mtime:
+            continue
+
+        permute_subject(subject_path, wholebrain=wholebrain, n_jobs=n_jobs, cache_dir=cache_dir, contrast=contrast, samples=samples)
+
+    return subject, finished
+
+def group_accuracy_test(subject_paths, contrast="pos_neg", chance=0.5):
+    '''
+    Test the searchlight accuracy against chance at group level (one sample test of accuracy - chance, see second_level.second_level).
+
+    Args
+        subject_paths: paths to the searchlight folders of the subjects
+        contrast: name of the contrast
+        chance: chance level accuracy
+
+    Returns
+        second_level_mdl: fitted second level model
+        zmap: z map of the group level test
+    '''
+    accuracy_imgs, masks = [], []
+
+    for subject_path in subject_paths:
+        with open(subject_path / f"searchlight_{contrast}.pkl", 'rb') as f:
+            searchlight, searchlight_scores = pickle.load(f)
+
+        # the scores are on the grid of the sphere centres (the whole brain mask of the subject, see samples.samples_process_mask)
+        mask = samples_process_mask(load_samples(subject_path / "samples"))
+
+        accuracy = np.zeros(np.prod(mask["shape"]), dtype=np.float32)
+        accuracy[mask["voxels"]] = searchlight_scores.ravel()[mask["voxels"]] - chance
+
+        accuracy_imgs.append(nib.Nifti1Image(accuracy.reshape(mask["shape"]), mask["affine"]))
+        masks.append(mask)
+
+    # only voxels within the searchlight of every subject (the subjects are in the same template space, so the masks are intersected on their packed bits)
+    group_mask = mask_to_img(intersect_mask_stores(masks, threshold=1))
+
+    second_level_mdl = second_level(accuracy_imgs, mask_img=group_mask)
+    zmap = second_level_mdl.compute_contrast(output_type="z_score")
+
+    return second_level_mdl, zmap
+
+def cohort_pipeline(bids_path, subjects_list, data_path, n_workers=None, n_cores=None, mem_per_worker=None, batch=False, wholebrain=False, cache_dir=None, table_cache=None, bold_cache=None, max_bold_cache_bytes=None):
+    '''
+    Searchlight decoding for all subjects (in parallel worker processes) followed by the group level test of every contrast.
+
+    Args
+        bids_path: path to bids directory (root)
+        subjects_list: list of subject IDs
+        data_path: path to the searchlight folder
+        n_workers, n_cores, mem_per_worker: see workers.split_cores (subjects are processed by n_workers processes, each using n_cores // n_workers cores)
+        batch, wholebrain, cache_dir, table_cache, bold_cache, max_bold_cache_bytes: see subject_searchlight_pipeline
+
+    Returns
+        zmaps: dictionary of contrast name -> z map of the group level test (of the subjects whose searchlight is finished)
+    '''
+    n_workers, n_jobs = split_cores(len(subjects_list), n_workers=n_workers, n_cores=n_cores, mem_per_worker=mem_per_worker)
+
+    print(f"[INFO:] Searchlight for {len(subjects_list)} subjects with {n_workers} workers ({n_jobs} jobs each) ...")
+
+    # contrasts with a finished searchlight per subject
+    finished = {}
+
+    if n_workers == 1:
+        for subject in subjects_list:
+            subject, finished[subject] = subject_searchlight_pipeline(bids_path, subject, data_path, n_jobs=n_jobs, batch=batch, wholebrain=wholebrain, cache_dir=cache_dir, table_cache=table_cache, bold_cache=bold_cache, max_bold_cache_bytes=max_bold_cache_bytes)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(mem_per_worker, 1)) as executor:
+            futures = [executor.submit(subject_searchlight_pipeline, bids_path, subject, data_path, n_jobs, batch, wholebrain, cache_dir, table_cache, bold_cache, max_bold_cache_bytes) for subject in subjects_list]
+
+            for future in as_completed(futures):
+                subject, finished[subject] = future.result()
+                print(f"[INFO:] Subject {subject} done")
+
+    # group level test of every contrast
+    contrasts = ["pos_neg", "pos_but", "neg_but"] if batch else ["pos_neg"]
+    group_path = data_path / "group"
+    group_path.mkdir(parents=True, exist_ok=True)
+
+    zmaps = {}
+
+    for contrast in contrasts:
+        # subjects whose searchlight is still worked on by other processes are left out (their searchlight file is missing or outdated)
+        subjects = [subject for subject in subjects_list if contrast in finished[subject]]
+        if len(subjects) < len(subjects_list):
+            print(f"[INFO:] Leaving out subjects {', '.join(sorted(set(subjects_list) - set(subjects)))} from the group level test of {contrast} (searchlight not finished)")
+
+        if len(subjects) < 2:
+            continue
+
+        print(f"[INFO:] Group level test of {contrast} ...")
+        second_level_mdl, zmaps[contrast] = group_accuracy_test([data_path / f"sub-{subject}" for subject in subjects], contrast=contrast)
+        nib.save(zmaps[contrast], group_path / f"accuracy_{contrast}_zmap.nii.gz")
+
+    return zmaps
+
+def main():
+    # define paths
+    path = pathlib.Path(__file__)
+    data_path = path.parents[2] / "data" / "searchlight"
+    bids_path = path.parents[2] / "data" / "InSpePosNegData" / "BIDS_2023E"
+
+    # subject 0119 is excluded based on the sanity check (as in second_level.py)
+    subjects = list_subjects(bids_path, exclude_subjects=["0119"])
+
+    cohort_pipeline(bids_path, subjects, data_path, mem_per_worker=16 * 1024**3, cache_dir=data_path.parent / "cache" / "neighbourhoods", table_cache=data_path.parent / "cache" / "tables", bold_cache=data_path.parent / "cache" / "bold", max_bold_cache_bytes=100 * 1024**3)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,912 @@
+'''
+Fast searchlight engine for Gaussian naive Bayes (all spheres scored at once with a sparse sphere neighbourhood matrix).
+'''
+import pathlib, os, json, time
+import io
+import shutil
+import socket
+from concurrent.futures import ProcessPoolExecutor
+
+# import own functions
+import sys 
+sys.path.append(str(pathlib.Path(__file__).parents[2] / "src"))
+
+from cache import hash_array, hash_params, touch, evict_lru, write_atomic, write_atomic_exclusive
+
+import numpy as np
+from scipy import sparse
+from sklearn.neighbors import NearestNeighbors
+from sklearn.model_selection import StratifiedKFold
+from sklearn.utils import check_random_state
+
+from nilearn.image import load_img, resample_img
+from nilearn.image.resampling import coord_transform
+from nilearn.masking import apply_mask
+
+def searchlight_data(mask_img, imgs):
+    '''
+    Mask the beta maps with the mask (resampled to the grid of the beta maps, as in nilearn's SearchLight).
+
+    Args
+        mask_img: whole brain mask (nifti image)
+        imgs: 4D image of beta maps, or an array of shape (n_samples, n_voxels) already masked with mask_img (e.g., a sample matrix from samples.py),
+              in which case mask_img must be on the grid of the beta maps
+
+    Returns
+        X: array of shape (n_samples, n_voxels)
+        mask: 3D boolean array of the resampled mask
+        affine: affine of the beta maps
+    '''
+    if isinstance(imgs, np.ndarray):
+        mask_img = load_img(mask_img)
+        return imgs, mask_img.get_fdata() != 0, mask_img.affine
+
+    imgs = load_img(imgs)
+
+    mask_img = resample_img(load_img(mask_img), target_affine=imgs.affine, target_shape=imgs.shape[:3], interpolation="nearest")
+    mask = mask_img.get_fdata() != 0
+
+    X = apply_mask(imgs, mask_img)
+
+    return X, mask, imgs.affine
+
+def sphere_neighbourhoods(process_mask_img, mask, affine, radius:float):
+    '''
+    Find the voxels within radius (in mm) of every voxel of the process mask (the centres of the spheres).
+
+    Args
+        process_mask_img: mask of the sphere centres (nifti image, e.g., the whole brain mask)
+        mask: 3D boolean array of the voxels in the data (output of searchlight_data)
+        affine: affine of the data
+        radius: radius of the spheres in mm
+
+    Returns
+        A: sparse matrix of shape (n_spheres, n_voxels), where A[i, j] = 1 if voxel j is in sphere i
+    '''
+    process_mask_img = load_img(process_mask_img)
+    process_mask = process_mask_img.get_fdata() != 0
+
+    # world coordinates of the sphere centres and of the voxels
+    seeds = np.asarray(coord_transform(*np.where(process_mask), process_mask_img.affine)).T
+    voxel_coords = np.asarray(coord_transform(*np.where(mask), affine)).T
+
+    A = NearestNeighbors(radius=radius).fit(voxel_coords).radius_neighbors_graph(seeds).tocsr()
+
+    # the voxel nearest to each centre is always part of its sphere (as in nilearn)
+    voxel_index = np.full(mask.shape, -1)
+    voxel_index[mask] = np.arange(mask.sum())
+
+    nearest = np.round(np.asarray(coord_transform(*seeds.T, np.linalg.inv(affine)))).astype(int).T
+    inside = np.all((nearest >= 0) & (nearest < mask.shape), axis=1)
+    nearest_index = np.full(len(seeds), -1)
+    nearest_index[inside] = voxel_index[tuple(nearest[inside].T)]
+    has_nearest = nearest_index >= 0
+
+    A = A + sparse.csr_matrix((np.ones(has_nearest.sum()), (np.flatnonzero(has_nearest), nearest_index[has_nearest])), shape=A.shape)
+    A.data[:] = 1
+
+    if np.any(np.diff(A.indptr) == 0):
+        raise ValueError(f"These spheres are empty: {np.flatnonzero(np.diff(A.indptr) == 0)}")
+
+    return A
+
+# maximum size of the neighbourhood cache in bytes (least recently used indices are evicted)
+MAX_INDEX_CACHE_BYTES = 10 * 1024**3
+
+def neighbourhood_index(mask_img, imgs, radius:float, cache_dir:pathlib.Path=None, process_mask_img=None, max_bytes:int=MAX_INDEX_CACHE_BYTES):
+    '''
+    Get the sphere neighbourhoods of a mask on the grid of the beta maps, loaded from the cache if they were computed before for the same masks and radius.
+
+    Args
+        mask_img: whole brain mask (nifti image)
+        imgs: 4D image of beta maps (only the affine and shape are used), or an array of masked beta maps (see searchlight_data)
+        radius: radius of the spheres in mm
+        cache_dir: path to the neighbourhood cache. If None, the neighbourhoods are always computed
+        process_mask_img: mask of the sphere centres. If None, mask_img is used
+        max_bytes: maximum size of the cache in bytes. If None, the cache is unbounded
+
+    Returns
+        index: dictionary with the sphere neighbourhoods "A" (sparse matrix of shape (n_spheres, n_voxels)), 
+               the flat indices of the voxels in the grid of the beta maps "voxels", and the "shape" and "affine" of that grid
+    '''
+    process_mask_img = load_img(process_mask_img if process_mask_img is not None else mask_img)
+
+    # mask on the grid of the beta maps (as in searchlight_data)
+    if isinstance(imgs, np.ndarray):
+        mask_img = load_img(mask_img)
+        mask, affine = mask_img.get_fdata() != 0, mask_img.affine
+    else:
+        imgs = load_img(imgs)
+        mask = resample_img(load_img(mask_img), target_affine=imgs.affine, target_shape=imgs.shape[:3], interpolation="nearest").get_fdata() != 0
+        affine = imgs.affine
+
+    index_path = None
+
+    if cache_dir is not None:
+        key = hash_params({
+            "process_mask": hash_array(process_mask_img.get_fdata() != 0),
+            "process_affine": process_mask_img.affine.tolist(),
+            "mask": hash_array(mask),
+            "affine": affine.tolist(),
+            "radius": radius,
+        })
+        index_path = pathlib.Path(cache_dir) / key
+
+        # load cached neighbourhoods (memory-mapped)
+        if (index_path / "header.json").exists():
+            touch(index_path)
+            return load_neighbourhood_index(index_path)
+
+    A = sphere_neighbourhoods(process_mask_img, mask, affine, radius)
+    index = {"A": A, "voxels": np.flatnonzero(mask), "shape": list(mask.shape), "affine": affine}
+
+    if index_path is not None:
+        save_neighbourhood_index(index, index_path)
+
+        if max_bytes is not None:
+            evict_lru(cache_dir, max_bytes, keep=[key])
+
+    return index
+
+def save_neighbourhood_index(index, index_path:pathlib.Path):
+    '''
+    Save sphere neighbourhoods as CSR arrays (plus a small header with the grid of the voxels).
+    The index is written to a temporary folder and renamed, so other processes never see a half-written index.
+    '''
+    tmp_path = index_path.with_name(f".{index_path.name}.{os.getpid()}.tmp")
+    tmp_path.mkdir(parents=True, exist_ok=True)
+
+    A = index["A"].tocsr()
+    np.save(tmp_path / "indptr.npy", A.indptr)
+    np.save(tmp_path / "indices.npy", A.indices)
+    np.save(tmp_path / "voxels.npy", index["voxels"])
+
+    header = {"n_spheres": A.shape[0], "n_voxels": A.shape[1], "shape": list(index["shape"]), "affine": np.asarray(index["affine"]).tolist()}
+    with open(tmp_path / "header.json", "w") as f:
+        json.dump(header, f)
+
+    try:
+        os.rename(tmp_path, index_path)
+    except OSError: # written by another process in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+def load_neighbourhood_index(index_path:pathlib.Path):
+    '''
+    Load sphere neighbourhoods saved with save_neighbourhood_index (the arrays are memory-mapped).
+    '''
+    with open(index_path / "header.json") as f:
+        header = json.load(f)
+
+    indptr = np.load(index_path / "indptr.npy", mmap_mode="r")
+    indices = np.load(index_path / "indices.npy", mmap_mode="r")
+    A = sparse.csr_matrix((np.ones(indices.shape[0]), indices, indptr), shape=(header["n_spheres"], header["n_voxels"]))
+
+    return {"A": A, "voxels": np.load(index_path / "voxels.npy", mmap_mode="r"), "shape": header["shape"], "affine": np.array(header["affine"])}
+
+def class_statistics(X, y_idx, n_classes:int, var_smoothing:float=1e-9, epsilon:float=None):
+    '''
+    Fit a Gaussian naive Bayes on all voxels at once (same estimates as GaussianNB).
+
+    Args
+        X: training data of shape (n_samples, n_voxels)
+        y_idx: class index of each sample (0, ..., n_classes - 1)
+        n_classes: number of classes
+        var_smoothing: portion of the largest variance added to all variances (as in GaussianNB)
+        epsilon: variance added to all variances. If None, computed from var_smoothing and X (pass it when X only holds part of the voxels)
+
+    Returns
+        means: array of shape (n_classes, n_voxels)
+        variances: array of shape (n_classes, n_voxels)
+        log_priors: array of shape (n_classes,)
+    '''
+    # GaussianNB takes the largest variance of the voxels it is fitted on. Here the largest variance of all voxels is used for all spheres,
+    # which only matters for voxels without variance within a class
+    if epsilon is None:
+        epsilon = var_smoothing * np.var(X, axis=0).max()
+
+    means = np.zeros((n_classes, X.shape[1]))
+    variances = np.zeros((n_classes, X.shape[1]))
+    counts = np.zeros(n_classes)
+
+    for c in range(n_classes):
+        X_c = X[y_idx == c]
+        means[c] = X_c.mean(axis=0)
+        variances[c] = X_c.var(axis=0) + epsilon
+        counts[c] = X_c.shape[0]
+
+    log_priors = np.log(counts / counts.sum())
+
+    return means, variances, log_priors
+
+def voxel_log_likelihood(X_test, means, variances):
+    '''
+    Log-likelihood of every test sample and class in every voxel.
+
+    Args
+        X_test: test data of shape (n_test, n_voxels)
+        means, variances: output of class_statistics
+
+    Returns
+        voxel_ll: array of shape (n_voxels, n_test * n_classes)
+    '''
+    n_test, n_classes = X_test.shape[0], means.shape[0]
+
+    voxel_ll = -0.5 * (np.log(2. * np.pi * variances)[None] + (X_test[:, None, :] - means[None]) ** 2 / variances[None])
+
+    return voxel_ll.reshape(n_test * n_classes, -1).T
+
+def sphere_log_likelihood(X_test, means, variances, log_priors, A):
+    '''
+    Joint log-likelihood of every test sample and class in every sphere.
+
+    Args
+        X_test: test data of shape (n_test, n_voxels)
+        means, variances, log_priors: output of class_statistics
+        A: sphere neighbourhoods of shape (n_spheres, n_voxels) (output of sphere_neighbourhoods)
+
+    Returns
+        jll: array of shape (n_spheres, n_test, n_classes)
+    '''
+    n_test, n_classes = X_test.shape[0], means.shape[0]
+
+    # sum the log-likelihood of every voxel over the voxels of each sphere
+    jll = np.asarray(A @ voxel_log_likelihood(X_test, means, variances)).reshape(A.shape[0], n_test, n_classes)
+
+    return jll + log_priors
+
+def sphere_accuracy(X, y_idx, n_classes:int, A, folds, var_smoothing:float=1e-9, chunk_size:int=16, epsilons:list=None):
+    '''
+    Cross-validated accuracy of a Gaussian naive Bayes in every sphere (mean over folds, as cross_val_score).
+
+    Args
+        X: data of shape (n_samples, n_voxels)
+        y_idx: class index of each sample
+        n_classes: number of classes
+        A: sphere neighbourhoods (output of sphere_neighbourhoods)
+        folds: list of (train, test) indices
+        var_smoothing: see class_statistics
+        chunk_size: number of test samples scored at a time (bounds the memory used)
+        epsilons: variance smoothing of every fold (see fold_epsilons). If None, computed from X
+
+    Returns
+        scores: array of shape (n_spheres,)
+    '''
+    scores = np.zeros(A.shape[0])
+
+    if epsilons is None:
+        epsilons = fold_epsilons(X, folds, var_smoothing)
+
+    for (train, test), epsilon in zip(folds, epsilons):
+        means, variances, log_priors = class_statistics(X[train], y_idx[train], n_classes, epsilon=epsilon)
+
+        correct = np.zeros(A.shape[0])
+
+        for start in range(0, len(test), chunk_size):
+            test_chunk = test[start:start + chunk_size]
+            jll = sphere_log_likelihood(X[test_chunk], means, variances, log_priors, A)
+            correct += (jll.argmax(axis=2) == y_idx[test_chunk]).sum(axis=1)
+
+        scores += correct / len(test)
+
+    return scores / len(folds)
+
+def gnb_searchlight(mask_img, imgs, y, radius:float=5, cv:int=3, var_smoothing:float=1e-9, process_mask_img=None, cache_dir:pathlib.Path=None):
+    '''
+    Searchlight with a Gaussian naive Bayes classifier (same scores as nilearn's SearchLight with estimator=GaussianNB()).
+
+    Args
+        mask_img: whole brain mask (nifti image)
+        imgs: 4D image of beta maps (or masked beta maps, see searchlight_data)
+        y: labels of the beta maps
+        radius: radius of the spheres in mm
+        cv: number of (stratified) folds
+        var_smoothing: see class_statistics
+        process_mask_img: mask of the sphere centres. If None, mask_img is used
+        cache_dir: path to the neighbourhood cache (see neighbourhood_index)
+
+    Returns
+        scores: array with the accuracy of every sphere at its centre (same shape as the process mask, as SearchLight.scores_)
+    '''
+    process_mask_img = load_img(process_mask_img if process_mask_img is not None else mask_img)
+
+    X, mask, affine = searchlight_data(mask_img, imgs)
+    A = neighbourhood_index(mask_img, imgs, radius, cache_dir=cache_dir, process_mask_img=process_mask_img)["A"]
+
+    # classes in sorted order (as GaussianNB)
+    classes, y_idx = np.unique(np.asarray(y), return_inverse=True)
+    folds = list(StratifiedKFold(n_splits=cv).split(X, y_idx))
+
+    sphere_scores = sphere_accuracy(X, y_idx, len(classes), A, folds, var_smoothing)
+
+    # put the scores at the sphere centres
+    scores = np.zeros(process_mask_img.shape[:3])
+    scores[process_mask_img.get_fdata() != 0] = sphere_scores
+
+    return scores
+
+def fold_ids(y_idx, cv:int):
+    '''
+    Fold of every sample for stratified k-fold cross-validation (same folds as StratifiedKFold(n_splits=cv)).
+    '''
+    folds = np.zeros(len(y_idx), dtype=int)
+
+    for fold, (train, test) in enumerate(StratifiedKFold(n_splits=cv).split(np.zeros(len(y_idx)), y_idx)):
+        folds[test] = fold
+
+    return folds
+
+def gnb_cv_scores(X, X2, labels, n_classes:int, cv:int=3, var_smoothing:float=1e-9):
+    '''
+    Cross-validated accuracy of a Gaussian naive Bayes (on all voxels of X) for many labelings at once.
+
+    Args
+        X: data of shape (n_samples, n_voxels)
+        X2: X squared (precomputed, as it is shared between all labelings)
+        labels: class indices of shape (n_labelings, n_samples), e.g., permutations of the true labels
+        n_classes: number of classes
+        cv: number of (stratified) folds, computed per labeling as in permutation_test_score
+        var_smoothing: see class_statistics
+
+    Returns
+        scores: array of shape (n_labelings,) with the mean accuracy over folds
+    '''
+    n_labelings, n_samples = labels.shape
+
+    # fold of every sample for every labeling (n_labelings, n_samples)
+    folds = np.stack([fold_ids(y_idx, cv) for y_idx in labels])
+
+    # training samples of every fold (n_labelings, cv, n_samples) and of every class within those (n_labelings, cv, n_classes, n_samples)
+    train = folds[:, None, :] != np.arange(cv)[None, :, None]
+    train_class = train[:, :, None, :] & (labels[:, None, None, :] == np.arange(n_classes)[None, None, :, None])
+
+    # class means and variances from the sums of x and x^2
+    counts = train_class.sum(axis=3)
+    W = train_class.reshape(-1, n_samples).astype(X.dtype)
+    means = (W @ X).reshape(n_labelings, cv, n_classes, -1) / counts[..., None]
+    variances = np.maximum((W @ X2).reshape(n_labelings, cv, n_classes, -1) / counts[..., None] - means ** 2, 0)
+
+    # variance smoothing from the largest variance of the training samples of each fold (as GaussianNB)
+    n_train = train.sum(axis=2)[..., None]
+    W_train = train.reshape(-1, n_samples).astype(X.dtype)
+    train_means = (W_train @ X).reshape(n_labelings, cv, -1) / n_train
+    train_variances = (W_train @ X2).reshape(n_labelings, cv, -1) / n_train - train_means ** 2
+    variances += var_smoothing * train_variances.max(axis=2)[:, :, None, None]
+
+    # joint log-likelihood of every sample under every fitted model: sum over voxels of -0.5 * (log(2 pi var) + (x - mean)^2 / var)
+    precisions = 1. / variances
+    constant = np.log(counts / counts.sum(axis=2, keepdims=True)) - 0.5 * (np.log(2. * np.pi * variances) + means ** 2 * precisions).sum(axis=3)
+    quadratic = X2 @ precisions.reshape(-1, X.shape[1]).T - 2 * X @ (means * precisions).reshape(-1, X.shape[1]).T
+    jll = constant.reshape(-1)[None, :] - 0.5 * quadratic
+
+    # predictions of every fold's model for every sample (n_labelings, cv, n_samples)
+    predictions = jll.reshape(n_samples, n_labelings, cv, n_classes).argmax(axis=3).transpose(1, 2, 0)
+
+    # accuracy on the test samples of each fold, averaged over folds
+    test = ~train
+    correct = (predictions == labels[:, None, :]) & test
+
+    return (correct.sum(axis=2) / test.sum(axis=2)).mean(axis=1)
+
+def gnb_permutation_test(X, y, cv:int=3, n_permutations:int=1000, random_state=None, block_size:int=100, var_smoothing:float=1e-9):
+    '''
+    Permutation test of a Gaussian naive Bayes (same results as sklearn's permutation_test_score with GaussianNB()), with the permutations evaluated in blocks.
+
+    Args
+        X: data of shape (n_samples, n_voxels)
+        y: labels
+        cv: number of (stratified) folds
+        n_permutations: number of permutations
+        random_state: seed (or RandomState) used to draw the permutations
+        block_size: number of permutations evaluated at a time (bounds the memory used)
+        var_smoothing: see class_statistics
+
+    Returns
+        score: cross-validated accuracy on the true labels
+        permutation_scores: array of shape (n_permutations,) with the accuracies on the permuted labels
+        pvalue: (number of permutation scores >= score + 1) / (n_permutations + 1)
+    '''
+    X = np.asarray(X, dtype=np.float64)
+    X2 = X ** 2
+
+    classes, y_idx = np.unique(np.asarray(y), return_inverse=True)
+    random_state = check_random_state(random_state)
+
+    score = gnb_cv_scores(X, X2, y_idx[None], len(classes), cv, var_smoothing)[0]
+
+    # permutations are drawn in the same order as in permutation_test_score, and evaluated block by block
+    permutation_scores = np.zeros(n_permutations)
+
+    for start in range(0, n_permutations, block_size):
+        n_block = min(block_size, n_permutations - start)
+        labels = np.stack([y_idx[random_state.permutation(len(y_idx))] for _ in range(n_block)])
+        permutation_scores[start:start + n_block] = gnb_cv_scores(X, X2, labels, len(classes), cv, var_smoothing)
+
+    pvalue = (np.sum(permutation_scores >= score) + 1.0) / (n_permutations + 1)
+
+    return score, permutation_scores, pvalue
+
+def permuted_sphere_accuracy(X, labels, n_classes:int, A, folds, epsilons, chunk_size:int=4):
+    '''
+    Cross-validated accuracy of a Gaussian naive Bayes in every sphere for many labelings at once, with the same folds for all labelings.
+
+    Args
+        X: data of shape (n_samples, n_voxels)
+        labels: class indices of shape (n_labelings, n_samples), e.g., permutations of the true labels
+        n_classes: number of classes
+        A: sphere neighbourhoods (output of sphere_neighbourhoods)
+        folds: list of (train, test) indices
+        epsilons: variance smoothing of every fold (does not depend on the labels, see fold_epsilons)
+        chunk_size: number of test samples scored at a time (bounds the memory used)
+
+    Returns
+        scores: array of shape (n_labelings, n_spheres)
+    '''
+    n_labelings = labels.shape[0]
+    scores = np.zeros((n_labelings, A.shape[0]))
+
+    for (train, test), epsilon in zip(folds, epsilons):
+        X_train = X[train]
+
+        # class means and variances of all labelings at once (n_labelings, n_classes, n_voxels)
+        onehot = labels[:, train][:, None, :] == np.arange(n_classes)[None, :, None]
+        counts = onehot.sum(axis=2)
+        W = onehot.reshape(-1, len(train)).astype(X.dtype)
+
+        means = (W @ X_train).reshape(n_labelings, n_classes, -1) / counts[..., None]
+        variances = np.maximum((W @ X_train ** 2).reshape(n_labelings, n_classes, -1) / counts[..., None] - means ** 2, 0) + epsilon
+        log_variances = np.log(2. * np.pi * variances)
+        log_priors = np.log(counts / counts.sum(axis=1, keepdims=True))
+
+        for start in range(0, len(test), chunk_size):
+            test_chunk = test[start:start + chunk_size]
+            X_test = X[test_chunk]
+
+            # log-likelihood of every voxel (n_labelings, n_test, n_classes, n_voxels), summed over the voxels of each sphere
+            voxel_ll = -0.5 * (log_variances[:, None] + (X_test[None, :, None, :] - means[:, None]) ** 2 / variances[:, None])
+            jll = np.asarray(A @ voxel_ll.reshape(-1, X.shape[1]).T).reshape(A.shape[0], n_labelings, len(test_chunk), n_classes)
+            jll += log_priors[None, :, None, :]
+
+            correct = (jll.argmax(axis=3) == labels[:, test_chunk][None]).sum(axis=2)
+            scores += correct.T / len(test)
+
+    return scores / len(folds)
+
+def fold_epsilons(X, folds, var_smoothing:float=1e-9):
+    '''
+    Variance smoothing of every fold (portion of the largest variance of the training samples, as GaussianNB).
+    '''
+    return [var_smoothing * np.var(X[train], axis=0).max() for train, test in folds]
+
+# data shared by the permutation workers (set once per worker by init_permutation_worker)
+WORKER_DATA = {}
+
+def init_permutation_worker(X, A, folds, epsilons, n_classes, observed):
+    WORKER_DATA.update(X=X, A=A, folds=folds, epsilons=epsilons, n_classes=n_classes, observed=observed)
+
+def permutation_worker(labels):
+    '''
+    Score a block of permutations (worker function for gnb_searchlight_permutation_test).
+
+    Returns
+        max_scores: maximum accuracy over all spheres for each permutation
+        exceedances: number of permutations in which each sphere scored at least its observed accuracy
+    '''
+    scores = permuted_sphere_accuracy(WORKER_DATA["X"], labels, WORKER_DATA["n_classes"], WORKER_DATA["A"], WORKER_DATA["folds"], WORKER_DATA["epsilons"])
+
+    return scores.max(axis=1), (scores >= WORKER_DATA["observed"][None]).sum(axis=0)
+
+def gnb_searchlight_permutation_test(mask_img, imgs, y, radius:float=5, cv:int=3, n_permutations:int=1000, random_state=None, block_size:int=8, 
+                                     n_jobs:int=1, var_smoothing:float=1e-9, process_mask_img=None, cache_dir=None):
+    '''
+    Whole-brain permutation test of a Gaussian naive Bayes searchlight with family-wise error correction (maximum statistic).
+
+    Args
+        mask_img: whole brain mask (nifti image)
+        imgs: 4D image of beta maps (or masked beta maps, see searchlight_data)
+        y: labels of the beta maps
+        radius: radius of the spheres in mm
+        cv: number of (stratified) folds
+        n_permutations: number of permutations
+        random_state: seed (or RandomState) used to draw the permutations
+        block_size: number of permutations scored at a time by each process
+        n_jobs: number of processes
+        var_smoothing: see class_statistics
+        process_mask_img: mask of the sphere centres. If None, mask_img is used
+        cache_dir: path to the neighbourhood cache (see neighbourhood_index)
+
+    Returns
+        scores: accuracy of every sphere at its centre (same shape as the process mask)
+        fwe_pvalues: family-wise error corrected p-value of every sphere (proportion of permutation maxima >= its accuracy)
+        uncorrected_pvalues: uncorrected p-value of every sphere
+        null_max: maximum accuracy over all spheres of every permutation (the null distribution)
+    '''
+    process_mask_img = load_img(process_mask_img if process_mask_img is not None else mask_img)
+    process_mask = process_mask_img.get_fdata() != 0
+
+    X, mask, affine = searchlight_data(mask_img, imgs)
+    A = neighbourhood_index(mask_img, imgs, radius, cache_dir=cache_dir, process_mask_img=process_mask_img)["A"]
+
+    classes, y_idx = np.unique(np.asarray(y), return_inverse=True)
+    folds = list(StratifiedKFold(n_splits=cv).split(X, y_idx))
+    epsilons = fold_epsilons(X, folds, var_smoothing)
+
+    # observed accuracy map
+    observed = permuted_sphere_accuracy(X, y_idx[None], len(classes), A, folds, epsilons)[0]
+
+    # draw all permutations up front (so the results do not depend on n_jobs)
+    random_state = check_random_state(random_state)
+    permutations = np.stack([y_idx[random_state.permutation(len(y_idx))] for _ in range(n_permutations)])
+    blocks = [permutations[start:start + block_size] for start in range(0, n_permutations, block_size)]
+
+    if n_jobs == 1:
+        init_permutation_worker(X, A, folds, epsilons, len(classes), observed)
+        results = [permutation_worker(block) for block in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_permutation_worker, initargs=(X, A, folds, epsilons, len(classes), observed)) as executor:
+            results = list(executor.map(permutation_worker, blocks))
+
+    null_max = np.concatenate([max_scores for max_scores, exceedances in results])
+    exceedances = np.sum([exceedances for max_scores, exceedances in results], axis=0)
+
+    # p-values (the observed labeling counts as one of the permutations)
+    fwe = (np.sum(null_max[None, :] >= observed[:, None], axis=1) + 1.0) / (n_permutations + 1)
+    uncorrected = (exceedances + 1.0) / (n_permutations + 1)
+
+    # put the results at the sphere centres
+    scores, fwe_pvalues, uncorrected_pvalues = np.zeros(process_mask.shape), np.ones(process_mask.shape), np.ones(process_mask.shape)
+    scores[process_mask], fwe_pvalues[process_mask], uncorrected_pvalues[process_mask] = observed, fwe, uncorrected
+
+    return scores, fwe_pvalues, uncorrected_pvalues, null_max
+
+def chunk_lock():
+    '''
+    Content of a chunk lock (host and pid of the process that claimed the chunk, and the time of the claim).
+    '''
+    return {"host": socket.gethostname(), "pid": os.getpid(), "time": time.time()}
+
+def lock_is_stale(lock_file:pathlib.Path, lock:dict, lock_timeout:float):
+    '''
+    A lock is stale if it is older than lock_timeout seconds, or if it was made on this host by a process that no longer runs (e.g., a preempted run).
+    '''
+    if time.time() - lock_file.stat().st_mtime > lock_timeout:
+        return True
+
+    if lock.get("host") != socket.gethostname():
+        return False
+
+    # a lock with the pid of this process is left by an earlier process with the same pid (this process never claims a chunk twice)
+    if lock.get("pid") == os.getpid():
+        return True
+
+    try:
+        os.kill(lock["pid"], 0)
+    except ProcessLookupError:
+        return True
+    except (PermissionError, KeyError, TypeError):
+        pass
+
+    return False
+
+def lock_generations(chunks_path:pathlib.Path, chunk:int):
+    '''
+    Generations of the lock files of a chunk ("{chunk}.lock-{generation}", a new generation is made when a stale lock is taken over).
+    '''
+    return sorted(int(file.name.rsplit("-", 1)[1]) for file in chunks_path.glob(f"{chunk}.lock-*"))
+
+def claim_chunk(chunks_path:pathlib.Path, chunk:int, lock_timeout:float):
+    '''
+    Claim a chunk by creating its lock file. A stale lock (see lock_is_stale) is taken over by creating the lock of the next generation.
+
+    Returns
+        lock_file: lock of this process (see release_chunk). None if the chunk is claimed by another process
+    '''
+    generations = lock_generations(chunks_path, chunk)
+
+    if generations:
+        current = chunks_path / f"{chunk}.lock-{generations[-1]}"
+        try:
+            if not lock_is_stale(current, json.loads(current.read_text() or "{}"), lock_timeout):
+                return None
+        except (FileNotFoundError, ValueError): # released or taken over in the meantime
+            return None
+
+    lock_file = chunks_path / f"{chunk}.lock-{generations[-1] + 1 if generations else 0}"
+
+    try:
+        write_atomic_exclusive(lock_file, json.dumps(chunk_lock()).encode())
+    except FileExistsError:
+        return None
+
+    # locks of earlier generations are stale
+    for generation in generations:
+        (chunks_path / f"{chunk}.lock-{generation}").unlink(missing_ok=True)
+
+    return lock_file
+
+def release_chunk(lock_file:pathlib.Path):
+    '''
+    Remove the lock of a chunk (a lock taken over by another process has already been removed).
+    '''
+    lock_file.unlink(missing_ok=True)
+
+def save_chunk(file_path:pathlib.Path, values):
+    '''
+    Save the scores of a chunk as .npy (atomically, so a chunk file is always complete).
+    '''
+    buffer = io.BytesIO()
+    np.save(buffer, values)
+    write_atomic(file_path, buffer.getvalue())
+
+def checkpointed_chunks(checkpoint_path:pathlib.Path, header:dict, n_spheres:int, chunk_size:int, lock_timeout:float, score_chunk):
+    '''
+    Score the spheres in chunks, each saved to checkpoint_path / "chunks" / "{chunk}.npy" when done, so a killed run resumes and several processes can share the work.
+
+    Args
+        checkpoint_path: folder of the checkpoint (one per searchlight)
+        header: description of the searchlight (a checkpoint of another searchlight raises a ValueError)
+        n_spheres: number of spheres
+        chunk_size: number of spheres per chunk
+        lock_timeout: seconds after which a chunk claimed by another process is considered abandoned (see lock_is_stale)
+        score_chunk: function that scores the spheres of a slice of rows of the neighbourhood matrix
+
+    Returns
+        scores: scores of all spheres (the chunks concatenated). None if other processes are still working on some chunks
+    '''
+    n_chunks = int(np.ceil(n_spheres / chunk_size))
+
+    checkpoint_path = pathlib.Path(checkpoint_path)
+    chunks_path = checkpoint_path / "chunks"
+    chunks_path.mkdir(parents=True, exist_ok=True)
+
+    # make sure the checkpoint belongs to this searchlight
+    header = {**header, "n_spheres": n_spheres, "chunk_size": chunk_size}
+    header_file = checkpoint_path / "header.json"
+
+    try:
+        write_atomic_exclusive(header_file, json.dumps(header).encode())
+    except FileExistsError:
+        if json.loads(header_file.read_text()) != header:
+            raise ValueError(f"The checkpoint in {checkpoint_path} belongs to another searchlight. Remove it or use another checkpoint path.")
+
+    chunk_files = [chunks_path / f"{chunk}.npy" for chunk in range(n_chunks)]
+
+    for chunk, chunk_file in enumerate(chunk_files):
+        if chunk_file.exists():
+            continue
+
+        lock_file = claim_chunk(chunks_path, chunk, lock_timeout)
+        if lock_file is None:
+            continue
+
+        # the chunk may have been finished by the process that held the lock before
+        if not chunk_file.exists():
+            print(f"Processing chunk {chunk + 1}/{n_chunks} ...")
+            save_chunk(chunk_file, score_chunk(slice(chunk * chunk_size, min((chunk + 1) * chunk_size, n_spheres))))
+
+        release_chunk(lock_file)
+
+    # other processes may still be working on some chunks
+    if not all(chunk_file.exists() for chunk_file in chunk_files):
+        return None
+
+    return np.concatenate([np.load(chunk_file) for chunk_file in chunk_files])
+
+def checkpointed_gnb_searchlight(mask_img, imgs, y, checkpoint_path:pathlib.Path, radius:float=5, cv:int=3, chunk_size:int=5000, 
+                                 var_smoothing:float=1e-9, process_mask_img=None, cache_dir=None, lock_timeout:float=3600):
+    '''
+    Searchlight with a Gaussian naive Bayes classifier (as gnb_searchlight), processed in checkpointed chunks of sphere centres (see checkpointed_chunks).
+
+    Args
+        mask_img, imgs, y, radius, cv, var_smoothing, process_mask_img, cache_dir: see gnb_searchlight
+        checkpoint_path: folder of the checkpoint (one per searchlight)
+        chunk_size: number of sphere centres per chunk
+        lock_timeout: seconds after which a chunk claimed by another process is considered abandoned (should be longer than a chunk takes)
+
+    Returns
+        scores: accuracy of every sphere at its centre (same shape as the process mask). None if other processes are still working on some chunks
+    '''
+    process_mask_img = load_img(process_mask_img if process_mask_img is not None else mask_img)
+    process_mask = process_mask_img.get_fdata() != 0
+
+    X, mask, affine = searchlight_data(mask_img, imgs)
+    A = neighbourhood_index(mask_img, imgs, radius, cache_dir=cache_dir, process_mask_img=process_mask_img)["A"]
+
+    classes, y_idx = np.unique(np.asarray(y), return_inverse=True)
+    folds = list(StratifiedKFold(n_splits=cv).split(X, y_idx))
+
+    # computed on all voxels, so every chunk uses the same variance smoothing
+    epsilons = fold_epsilons(X, folds, var_smoothing)
+
+    def score_chunk(rows):
+        # only the voxels in the spheres of this chunk are needed
+        A_chunk = A[rows]
+        voxels = np.unique(A_chunk.indices)
+
+        return sphere_accuracy(X[:, voxels], y_idx, len(classes), A_chunk[:, voxels], folds, epsilons=epsilons)
+
+    header = {"data": hash_array(X), "labels": hash_array(y_idx), "spheres": hash_array(A.indptr.astype(np.int64)), "radius": radius, "cv": cv, "var_smoothing": var_smoothing}
+    scores = checkpointed_chunks(checkpoint_path, header, A.shape[0], chunk_size, lock_timeout, score_chunk)
+
+    if scores is None:
+        return None
+
+    # put the scores at the sphere centres
+    scores_3d = np.zeros(process_mask.shape)
+    scores_3d[process_mask] = scores
+
+    return scores_3d
+
+def contrast_folds(contrasts:dict, cv:int=3):
+    '''
+    Split the samples of every contrast into (stratified) folds.
+
+    Args
+        contrasts: dictionary of contrast name -> (rows, y), with the rows of the data used by the contrast and their labels
+        cv: number of folds
+
+    Returns
+        fits: list with a dictionary per contrast and fold (name, rows and class indices of the training and test samples, number of classes)
+    '''
+    fits = []
+
+    for name, (rows, y) in contrasts.items():
+        rows = np.asarray(rows)
+        classes, y_idx = np.unique(np.asarray(y), return_inverse=True)
+
+        for train, test in StratifiedKFold(n_splits=cv).split(rows, y_idx):
+            fits.append({"name": name, "train": rows[train], "y_train": y_idx[train], "test": rows[test], "y_test": y_idx[test], "n_classes": len(classes)})
+
+    return fits
+
+def batched_class_moments(X, fits, var_smoothing:float=1e-9, voxel_chunk:int=10000):
+    '''
+    Class statistics (as class_statistics) of many contrasts and folds in one pass over the data.
+
+    Args
+        X: data of shape (n_samples, n_voxels) (can be memory-mapped)
+        fits: output of contrast_folds
+        var_smoothing: see class_statistics
+        voxel_chunk: number of voxels read at a time (bounds the memory used)
+
+    Returns
+        fits: the fits with their "means", "variances" and "log_priors" added
+    '''
+    # one row per class of every fit, plus one row with all training samples of every fit (for the variance smoothing)
+    groups = []
+    for fit in fits:
+        groups += [fit["train"][fit["y_train"] == c] for c in range(fit["n_classes"])] + [fit["train"]]
+
+    W = np.zeros((len(groups), X.shape[0]))
+    for g, rows in enumerate(groups):
+        W[g, rows] = 1 / len(rows)
+
+    means = np.zeros((len(groups), X.shape[1]))
+    variances = np.zeros((len(groups), X.shape[1]))
+
+    for start in range(0, X.shape[1], voxel_chunk):
+        X_chunk = np.asarray(X[:, start:start + voxel_chunk], dtype=np.float64)
+        means[:, start:start + voxel_chunk] = W @ X_chunk
+        variances[:, start:start + voxel_chunk] = np.maximum(W @ X_chunk**2 - means[:, start:start + voxel_chunk]**2, 0)
+
+    g = 0
+    for fit in fits:
+        n_classes = fit["n_classes"]
+        epsilon = var_smoothing * variances[g + n_classes].max()
+
+        fit["means"] = means[g:g + n_classes]
+        fit["variances"] = variances[g:g + n_classes] + epsilon
+        fit["log_priors"] = np.log(np.bincount(fit["y_train"], minlength=n_classes) / len(fit["train"]))
+        g += n_classes + 1
+
+    return fits
+
+def score_blocks(A, blocks, scores:dict, n_folds:int):
+    '''
+    Sum the voxel log-likelihoods of several blocks of test samples over the spheres with one sparse matrix product, and add their accuracy to the scores.
+
+    Args
+        A: sphere neighbourhoods
+        blocks: list of (contrast name, voxel log-likelihoods, log priors, labels of the test samples, number of test samples in the fold)
+        scores: dictionary of contrast name -> accuracy of every sphere (updated in place)
+        n_folds: number of folds (the accuracy is averaged over the folds)
+    '''
+    jll = np.asarray(A @ np.concatenate([voxel_ll for name, voxel_ll, log_priors, y_test, n_test in blocks], axis=1))
+
+    start = 0
+    for name, voxel_ll, log_priors, y_test, n_test in blocks:
+        block_jll = jll[:, start:start + voxel_ll.shape[1]].reshape(A.shape[0], len(y_test), len(log_priors)) + log_priors
+        scores[name] += (block_jll.argmax(axis=2) == y_test).sum(axis=1) / (n_test * n_folds)
+        start += voxel_ll.shape[1]
+
+def contrast_sphere_scores(X, A, fits, cv:int, chunk_size:int=16, batch_columns:int=256, voxels=None):
+    '''
+    Accuracy of every sphere for all contrasts (see gnb_searchlight_contrasts).
+
+    Args
+        X: data of shape (n_samples, n_voxels)
+        A: sphere neighbourhoods (restricted to the columns voxels if given)
+        fits: output of batched_class_moments
+        cv, chunk_size, batch_columns: see gnb_searchlight_contrasts
+        voxels: columns of X in the spheres of A (e.g., for a chunk of spheres). If None, all columns
+
+    Returns
+        sphere_scores: dictionary of contrast name -> accuracy of every sphere (rows of A)
+    '''
+    sphere_scores = {fit["name"]: np.zeros(A.shape[0]) for fit in fits}
+    blocks = []
+
+    for fit in fits:
+        means, variances = (fit["means"], fit["variances"]) if voxels is None else (fit["means"][:, voxels], fit["variances"][:, voxels])
+
+        for start in range(0, len(fit["test"]), chunk_size):
+            test_chunk = fit["test"][start:start + chunk_size]
+            X_test = np.asarray(X[test_chunk], dtype=np.float64)
+            voxel_ll = voxel_log_likelihood(X_test if voxels is None else X_test[:, voxels], means, variances)
+            blocks.append((fit["name"], voxel_ll, fit["log_priors"], fit["y_test"][start:start + chunk_size], len(fit["test"])))
+
+            if sum(block[1].shape[1] for block in blocks) >= batch_columns:
+                score_blocks(A, blocks, sphere_scores, cv)
+                blocks = []
+
+    if blocks:
+        score_blocks(A, blocks, sphere_scores, cv)
+
+    return sphere_scores
+
+def gnb_searchlight_contrasts(mask_img, imgs, contrasts:dict, radius:float=5, cv:int=3, var_smoothing:float=1e-9, process_mask_img=None, cache_dir=None, 
+                              chunk_size:int=16, batch_columns:int=256, checkpoint_path:pathlib.Path=None, sphere_chunk_size:int=5000, lock_timeout:float=3600):
+    '''
+    Searchlight with a Gaussian naive Bayes classifier (as gnb_searchlight) for several contrasts at once, sharing the data and the sphere neighbourhoods.
+
+    Args
+        mask_img, imgs, radius, cv, var_smoothing, process_mask_img, cache_dir: see gnb_searchlight
+        contrasts: dictionary of contrast name -> (rows, y), with the rows of imgs used by the contrast and their labels
+        chunk_size: number of test samples of a fold scored at a time
+        batch_columns: number of columns (test samples x classes) summed over the spheres at a time (bounds the memory used)
+        checkpoint_path: if specified, the spheres are processed in checkpointed chunks of sphere_chunk_size spheres saved here (see checkpointed_chunks)
+        lock_timeout: see checkpointed_gnb_searchlight
+
+    Returns
+        scores: dictionary of contrast name -> accuracy of every sphere at its centre (same shape as the process mask).
+                None if checkpointed and other processes are still working on some chunks
+    '''
+    process_mask_img = load_img(process_mask_img if process_mask_img is not None else mask_img)
+    process_mask = process_mask_img.get_fdata() != 0
+
+    X, mask, affine = searchlight_data(mask_img, imgs)
+    A = neighbourhood_index(mask_img, imgs, radius, cache_dir=cache_dir, process_mask_img=process_mask_img)["A"]
+
+    fits = batched_class_moments(X, contrast_folds(contrasts, cv), var_smoothing)
+
+    if checkpoint_path is None:
+        sphere_scores = contrast_sphere_scores(X, A, fits, cv, chunk_size, batch_columns)
+    else:
+        names = list(contrasts)
+
+        def score_chunk(rows):
+            # only the voxels in the spheres of this chunk are needed
+            A_chunk = A[rows]
+            voxels = np.unique(A_chunk.indices)
+            chunk_scores = contrast_sphere_scores(X, A_chunk[:, voxels], fits, cv, chunk_size, batch_columns, voxels=voxels)
+
+            return np.stack([chunk_scores[name] for name in names], axis=1)
+
+        header = {
+            "data": hash_array(X),
+            "contrasts": {name: [hash_array(np.asarray(rows)), hash_array(np.unique(np.asarray(y), return_inverse=True)[1])] for name, (rows, y) in contrasts.items()},
+            "spheres": hash_array(A.indptr.astype(np.int64)), "radius": radius, "cv": cv, "var_smoothing": var_smoothing,
+        }
+        chunk_scores = checkpointed_chunks(checkpoint_path, header, A.shape[0], sphere_chunk_size, lock_timeout, score_chunk)
+
+        if chunk_scores is None:
+            return None
+
+        sphere_scores = {name: chunk_scores[:, i] for i, name in enumerate(names)}
+
+    # put the scores at the sphere centres
+    scores = {}
+    for name in contrasts:
+        scores[name] = np.zeros(process_mask.shape)
+        scores[name][process_mask] = sphere_scores[name]
+
+    return scores
@@ -1,19 +1,21 @@
 from sklearn.naive_bayes import GaussianNB
-from nilearn.input_data import NiftiMasker
-import pathlib
+import pathlib, os
 from nilearn.image import new_img_like, load_img
 from sklearn.model_selection import permutation_test_score
 import numpy as np
 import pickle
 
+from engine import gnb_permutation_test, gnb_searchlight_permutation_test
+from samples import load_samples, samples_mask_img, samples_process_mask_img, split_samples, split_rows, mask_columns
+
 def find_most_important_voxels(searchlight_scores, mask_wb_filename, n_voxels=500):
     """
     Find the most important voxels in the searchlight analysis.
 
     Args:
         searchlight_scores (numpy array): array of scores from the searchlight analysis
-        anat_filename (nifti image): anatomical image of the subject
-        n_voxels (int): number of voxels to select
+        mask_wb_filename (nifti image): whole brain mask of the sphere centres (the scores are on its grid)
+        n_voxels (int): number of voxels to select (exactly n_voxels, ties at the cutoff are broken by voxel order)
 
     
     Returns:
@@ -22,35 +24,36 @@ def find_most_important_voxels(searchlight_scores, mask_wb_filename, n_voxels=50
 
     """
 
-    # find the percentile that makes the cutoff for x best voxels
-    perc=100*(1-n_voxels/searchlight_scores.size)
-    
-    # find the cutoff
-    cut=np.percentile(searchlight_scores, perc)
-
     # load mask
     mask_img = load_img(mask_wb_filename)
+    mask = mask_img.get_fdata() != 0
 
-    # make copy of mask
-    process_mask = mask_img.get_fdata().astype(int)
+    # find the x best voxels of the mask
+    voxels = np.flatnonzero(mask)
+    best_voxels = voxels[np.argsort(-searchlight_scores.ravel()[voxels], kind="stable")[:n_voxels]]
 
-    # set all voxels below the cutoff to 0
-    process_mask[searchlight_scores<cut]=0
+    # the cutoff is the score of the worst selected voxel
+    cut = searchlight_scores.ravel()[best_voxels].min()
 
-    process_mask_img = new_img_like(mask_img, process_mask)
+    process_mask = np.zeros(mask.size, dtype=int)
+    process_mask[best_voxels] = 1
+
+    process_mask_img = new_img_like(mask_img, process_mask.reshape(mask.shape))
 
     return process_mask_img, cut
 
 
-def do_permutation(process_mask_img, fmri_img_test, conditions_test, data_path):
+def do_permutation(process_mask_img, samples, data_path, engine="gnb", n_permutations=1000, contrast=None):
     """
     Does permutation test on the test data based on the process mask.
 
     Args:
         process_mask_img (nifti image): mask of the voxels to be used in the permutation test (top 500)
-        fmri_img_test (nifti image): fMRI image of the test data
-        conditions_test (list): conditions of the test data
+        samples (dict): sample matrix with the test data (see samples.load_samples)
         data_path (pathlib path): path to the data folder
+        engine (str): "gnb" to evaluate the permutations in batches (see engine.gnb_permutation_test, same results for the same seed) or "sklearn" to use permutation_test_score
+        n_permutations (int): number of permutations
+        contrast (str): name of the contrast in the sample matrix (if None, the first contrast)
     
     Returns:
         score_cv_test (float): classification score of the test data
@@ -58,21 +61,26 @@ def do_permutation(process_mask_img, fmri_img_test, conditions_test, data_path):
         pvalue (float): pvalue of the permutation test
     
     """
-    # We have our fMRI data as a 4D file, we need to use a masker to convert it to a
-    masker = NiftiMasker(mask_img=process_mask_img, standardize=False)
-
-    # We use masker to retrieve a 2D array ready for machine learning with scikit-learn
-    fmri_masked = masker.fit_transform(fmri_img_test)
+    # The sample matrix is already masked with the whole brain mask, so we only need to select the voxels of the process mask
+    columns = mask_columns(samples, process_mask_img)
+    rows = split_rows(samples, "test", contrast)
+    fmri_masked = samples["X"][np.ix_(rows, columns)]
+    conditions_test = samples["labels"][rows]
 
     print(fmri_masked.shape)
 
     # Create the model
-    score_cv_test, scores_perm, pvalue = permutation_test_score(
-        GaussianNB(), fmri_masked, conditions_test, cv=3, n_permutations=1000, 
-        n_jobs=-1, random_state=2502, verbose=0, scoring=None)
-
-    # Save the results
-    f = open(data_path / 'permutation_results.pkl', 'wb')
+    if engine == "gnb":
+        score_cv_test, scores_perm, pvalue = gnb_permutation_test(
+            fmri_masked, conditions_test, cv=3, n_permutations=n_permutations, random_state=2502)
+    else:
+        score_cv_test, scores_perm, pvalue = permutation_test_score(
+            GaussianNB(), fmri_masked, conditions_test, cv=3, n_permutations=n_permutations, 
+            n_jobs=-1, random_state=2502, verbose=0, scoring=None)
+
+    # Save the results (one file per contrast)
+    filename = 'permutation_results.pkl' if contrast is None else f'permutation_results_{contrast}.pkl'
+    f = open(data_path / filename, 'wb')
     pickle.dump([score_cv_test, scores_perm, pvalue], f)
     f.close()
 
@@ -82,32 +90,92 @@ def do_permutation(process_mask_img, fmri_img_test, conditions_test, data_path):
     return score_cv_test, scores_perm, pvalue
 
 
-def main(): 
-    subject = "0117"
+def do_wholebrain_permutation(samples, data_path, n_permutations=1000, n_jobs=-1, cache_dir=None, contrast=None):
+    """
+    Does a permutation test across the entire searchlight map, FWE corrected with the maximum accuracy (see engine.gnb_searchlight_permutation_test).
 
-    # define paths 
-    path = pathlib.Path(__file__)
-    bids_path = path.parents[2] / "data" / "InSpePosNegData" / "BIDS_2023E"
+    Args:
+        samples (dict): sample matrix with the training data (see samples.load_samples)
+        data_path (pathlib path): path to the data folder
+        n_permutations (int): number of permutations
+        n_jobs (int): number of processes (-1 for all cores)
+        cache_dir (pathlib path): path to the sphere neighbourhood cache
+        contrast (str): name of the contrast in the sample matrix (if None, the first contrast)
 
-    data_path = path.parents[2] / "data" / "searchlight"
-    results_path = path.parents[2] / "results"
+    Returns:
+        fwe_pvalues_img (nifti image): family-wise error corrected p-value of every voxel
+        null_max (numpy array): maximum accuracy over the brain for every permutation
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+
+    # same spheres as the searchlight (see train.run_searchlight)
+    mask_img = samples_mask_img(samples)
+    process_mask_img = samples_process_mask_img(samples)
+    fmri_train, conditions_train = split_samples(samples, "train", contrast)
+
+    searchlight_scores, fwe_pvalues, uncorrected_pvalues, null_max = gnb_searchlight_permutation_test(
+        mask_img, fmri_train, conditions_train, radius=5, cv=3, n_permutations=n_permutations, 
+        random_state=2502, n_jobs=n_jobs, process_mask_img=process_mask_img, cache_dir=cache_dir)
+
+    fwe_pvalues_img = new_img_like(process_mask_img, fwe_pvalues)
+
+    # Save the results (one file per contrast)
+    filename = 'wholebrain_permutation_results.pkl' if contrast is None else f'wholebrain_permutation_results_{contrast}.pkl'
+    f = open(data_path / filename, 'wb')
+    pickle.dump([searchlight_scores, fwe_pvalues_img, uncorrected_pvalues, null_max], f)
+    f.close()
 
-    mask_wb_filename = bids_path / pathlib.Path(f'derivatives/sub-{subject}/anat/sub-{subject}_acq-T1sequence_run-1_space-MNI152NLin2009cAsym_desc-brain_mask.nii.gz')
+    print("Voxels with FWE corrected p < 0.05: %s" % np.sum(fwe_pvalues < 0.05))
 
+    return fwe_pvalues_img, null_max
+
+
+def permute_subject(subject_path, wholebrain=False, n_jobs=-1, cache_dir=None, contrast="pos_neg", samples=None):
+    """
+    Permutation tests of a single subject on its searchlight results (see train.py).
+
+    Args:
+        subject_path (pathlib path): path to the searchlight folder of the subject (e.g., data/searchlight/sub-0117)
+        wholebrain (bool): also run the permutation test across the whole searchlight map (FWE corrected)
+        n_jobs (int): number of processes for the whole brain permutation test (-1 for all cores)
+        cache_dir (pathlib path): path to the sphere neighbourhood cache of the whole brain permutation test
+        contrast (str): name of the contrast
+        samples (dict): sample matrix (if None, it is loaded from subject_path)
+
+    Returns:
+        score_cv_test (float): classification score of the test data
+        pvalue (float): pvalue of the permutation test
+    """
     # load the searchlight file
-    with open(data_path / "searchlight_pos_neg.pkl", 'rb') as f:
+    with open(subject_path / f"searchlight_{contrast}.pkl", 'rb') as f:
         searchlight, searchlight_scores  = pickle.load(f)
 
-    # load reshaped data 
-    with open(data_path / "searchlight_reshaped_data.pkl", 'rb') as f:
-        fmri_img_train, fmri_img_test, conditions_train, conditions_test = pickle.load(f)
+    # load sample matrix (memory-mapped), the searchlight was fitted on its voxels with the whole brain mask as sphere centres
+    if samples is None:
+        samples = load_samples(subject_path / "samples")
+    mask_wb_img = samples_process_mask_img(samples)
 
     # find top 500 voxels
-    process_mask_img, cut = find_most_important_voxels(searchlight_scores, mask_wb_filename, n_voxels=500)
+    process_mask_img, cut = find_most_important_voxels(searchlight_scores, mask_wb_img, n_voxels=500)
 
     # do permutation test
-    score_cv_test, scores_perm, pvalue = do_permutation(process_mask_img, fmri_img_test, conditions_test, data_path)
+    score_cv_test, scores_perm, pvalue = do_permutation(process_mask_img, samples, subject_path, contrast=contrast)
+
+    # permutation test across the whole searchlight map (FWE corrected)
+    if wholebrain:
+        do_wholebrain_permutation(samples, subject_path, n_jobs=n_jobs, cache_dir=cache_dir, contrast=contrast)
+
+    return score_cv_test, pvalue
+
+
+def main(subject="0117", wholebrain=False): 
+    # define paths 
+    path = pathlib.Path(__file__)
+    data_path = path.parents[2] / "data" / "searchlight"
+
+    permute_subject(data_path / f"sub-{subject}", wholebrain=wholebrain, cache_dir=data_path.parent / "cache" / "neighbourhoods")
     
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -22,7 +22,7 @@ def plot_searchlight_outcome(anat_filename, searchlight_scores, results_path):
     # plot the searchlight scores
     surface_plot = plotting.plot_glass_brain(searchlight_img, cmap="prism", colorbar=True,threshold=0.60,title='Positive vs Negative (Acc>0.6)')
     
-    deep_plot = plot_stat_map(searchlight_img, cmap='jet',threshold=0.6, cut_coords=[-30,-20,-10,0,10,20,30],
+    deep_plot = plot_stat_map(searchlight_img, bg_img=anat_filename, cmap='jet',threshold=0.6, cut_coords=[-30,-20,-10,0,10,20,30],
               display_mode='z',  black_bg=False,
               title='Positive vs Negative (Acc>0.6)')
 
@@ -45,20 +45,19 @@ def plot_most_important_voxels(anat_filename, searchlight_scores, results_path,
     # save plot
     plot.savefig(results_path / "searchlight_topvoxels.png")
 
-def main():
-    subject = "0117"
-
+def main(subject="0117"):
     # define paths 
     path = pathlib.Path(__file__)
     bids_path = path.parents[2] / "data" / "InSpePosNegData" / "BIDS_2023E"
 
-    data_path = path.parents[2] / "data" / "searchlight"
-    results_path = path.parents[2] / "results"
+    subject_path = path.parents[2] / "data" / "searchlight" / f"sub-{subject}"
+    results_path = path.parents[2] / "results" / "searchlight" / f"sub-{subject}"
+    results_path.mkdir(parents=True, exist_ok=True)
 
     anat_filename= bids_path / pathlib.Path(f'derivatives/sub-{subject}/anat/sub-{subject}_acq-T1sequence_run-1_space-MNI152NLin2009cAsym_desc-preproc_T1w.nii.gz')
     
     # load the searchlight file
-    with open(data_path / "searchlight_pos_neg.pkl", 'rb') as f:
+    with open(subject_path / "searchlight_pos_neg.pkl", 'rb') as f:
         searchlight, searchlight_scores  = pickle.load(f)
 
     plot_searchlight_outcome(anat_filename, searchlight_scores, results_path)
@@ -66,4 +65,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -2,14 +2,17 @@
 Preparation for searchlight classification
 '''
 
-import pathlib
+import pathlib, os
+from concurrent.futures import ProcessPoolExecutor
 
 # import own functions
 import sys 
 sys.path.append(str(pathlib.Path(__file__).parents[2] / "src"))
 
-from utils import load_all_flms
-from first_level import get_paths, get_events, get_confounds
+from first_level import get_paths, get_events, get_confounds, get_masks
+from workers import limit_worker_threads
+from ingest import probe_image, check_run_geometry
+from bold_cache import cached_bold, release_runs
 
 # import packages
 import pandas as pd
@@ -20,13 +23,16 @@ import numpy as np
 from nilearn.glm.first_level import make_first_level_design_matrix
 from nilearn.glm.first_level import FirstLevelModel
 
-def first_level_matrix(events:list, confounds:list, fprep_f_paths): 
+def first_level_matrix(events:list, confounds:list, fprep_f_paths, table_cache=None): 
     '''
     Create first level matrix for a single participant
+
+    Args
+        table_cache: path to the cache of the image headers (see ingest.probe_image)
     '''
     
     # calculate frame times
-    TR = int(nib.load(fprep_f_paths[0]).header["pixdim"][4]) # get TR from first functional fmri path (based on https://nipy.org/nibabel/devel/biaps/biap_0006.html)
+    TR = int(probe_image(fprep_f_paths[0], cache_dir=table_cache)["tr"]) # get TR from the header of the first functional fmri path (without loading the data)
     frame_times = np.linspace(0, TR*len(confounds[0]), len(confounds[0]), endpoint=False)
 
     trial_dms = []
@@ -50,81 +56,191 @@ def first_level_matrix(events:list, confounds:list, fprep_f_paths):
     return trial_dms
 
 
-def flm_new_design_matrix(events:list, confounds:list, fprep_f_paths, trial_dms, data_path): 
-    models=[]
-    
-    for idx, event_df in enumerate(events):
-        # load functional images
-        imgs = fprep_f_paths[idx]
+def fit_run(img, design_matrix, mask_img, bold_cache=None, max_bold_cache_bytes=None):
+    '''
+    Fit a first level model for a single run (worker function for flm_new_design_matrix), read through the BOLD cache if bold_cache is given.
+    '''
+    if bold_cache is not None:
+        img = cached_bold(img, mask_img, bold_cache, max_bold_cache_bytes)
+
+    model = FirstLevelModel(mask_img=mask_img)
+    try:
+        model.fit(img, design_matrices=design_matrix)
+    finally:
+        release_runs([img])
 
-        # ready the model
-        models.append(FirstLevelModel())
+    return model
 
-        # Fit the model and append it
-        print('Fitting GLM: ', idx+1)
-        models[idx].fit(imgs,design_matrices=trial_dms[idx])
+def flm_new_design_matrix(events:list, confounds:list, fprep_f_paths, trial_dms, subject_path, mask_paths=None, n_workers=None, bold_cache=None, max_bold_cache_bytes=None): 
+    '''
+    Fit a first level model per run on the trial design matrices. Runs are fitted in parallel worker processes.
+
+    Args
+        events: list of events dataframes (one per run)
+        confounds: list of confounds dataframes (one per run)
+        fprep_f_paths: paths to functional fMRIprep processed data (one per run)
+        trial_dms: list of trial design matrices (output of first_level_matrix)
+        subject_path: path to the searchlight folder of the subject (e.g., data/searchlight/sub-0117)
+        mask_paths: paths to the run masks. If given, their intersection is computed once and shared by all runs. If None, each model computes its own mask
+        n_workers: number of runs fitted at the same time. If None, all runs at once (bounded by all cores except 1)
+        bold_cache: if specified, the runs are read through the cache of decompressed BOLD series here (shared with first_level.py, see bold_cache.py). Only used if mask_paths is given
+        max_bold_cache_bytes: maximum size of the BOLD cache in bytes. If None, the cache is unbounded
+
+    Returns
+        models: list of fitted first level models (in run order)
+    '''
+    # compute the mask once for all runs
+    mask_img = get_masks(mask_paths) if mask_paths is not None else None
+
+    if n_workers is None:
+        n_workers = max(1, min(len(events), (os.cpu_count() or 1) - 1))
+
+    print(f'Fitting {len(events)} GLMs with {n_workers} workers ...')
+
+    # fit all runs (map keeps the models in run order), with one BLAS thread per worker
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=limit_worker_threads, initargs=(1,)) as executor:
+        models = list(executor.map(fit_run, fprep_f_paths[:len(events)], trial_dms, [mask_img] * len(events), [bold_cache] * len(events), [max_bold_cache_bytes] * len(events)))
 
     # save file with all models
-    f = open(data_path / "searchlight" / "all_flms.pkl", "wb")
+    f = open(subject_path / "all_flms.pkl", "wb")
     pickle.dump([models, trial_dms], f)
     f.close()
 
     return models
 
 
-def create_bmaps(events, trial_dms, models, data_path): 
+def extract_beta_series(model, n_trials:int):
+    '''
+    Extract the betas of all trial regressors (least squares all) from a fitted model in one pass over the masked data.
+
+    Args
+        model: fitted first level model (single run), with the trial regressors as the first n_trials columns of its design matrix
+        n_trials: number of trials
+
+    Returns
+        betas: array of shape (n_trials, n_voxels) with the betas of all trials in the mask of the model
+    '''
+    labels = model.labels_[0]
+    results = model.results_[0]
+
+    betas = np.zeros((n_trials, labels.size), dtype=np.float32)
+
+    # the AR(1) model fits one regression per label (voxels with similar autocorrelation), so betas are gathered back in voxel order
+    for label, result in results.items():
+        betas[:, labels == label] = result.theta[:n_trials]
+
+    return betas
+
+def create_bmaps(events, trial_dms, models, subject_path): 
+    '''
+    Create beta maps for all trials of all runs and the matching condition labels. 
+    The beta maps are saved as a single (uncompressed) 4D image "bmaps.nii", which is memory-mapped when loaded.
+
+    Args
+        events: list of events dataframes (one per run)
+        trial_dms: list of trial design matrices (output of first_level_matrix)
+        models: list of fitted first level models (output of flm_new_design_matrix)
+        subject_path: path to the searchlight folder of the subject
+
+    Returns
+        b_maps: 4D image with one beta map per trial
+        conditions_label: list of condition labels (one per trial)
+    '''
     b_maps = []
     conditions_label = []
 
     for idx, event_df in enumerate(events):
         N=event_df.shape[0]
-        # make an identity matrix with N= number of trials
-        contrasts=np.eye(N)
-
-        # g ind difference between columns in design matrix and number of trials
-        dif=trial_dms[idx].shape[1]-contrasts.shape[1]
-        
-        #Pad with zeros
-        contrasts=np.pad(contrasts, ((0,0),(0,dif)),'constant')
         
-        print('Making contrasts for session : ', idx+1)
-        print('Number of contrasts : ', N)
+        print('Extracting betas for session : ', idx+1)
+        print('Number of trials : ', N)
+
+        # betas of all trials in one pass (trials x voxels), put back into volumes (x, y, z, trials)
+        betas = extract_beta_series(models[idx], N)
+        b_maps.append(models[idx].masker_.inverse_transform(betas).get_fdata(dtype=np.float32))
         
-        for i in range(N):
-            # Add a beta-contrast image from each trial
-            b_maps.append(models[idx].compute_contrast(contrasts[i,], output_type='effect_size'))
-            
-            # Make a variable with condition labels for use in later classification
-            conditions_label.append(trial_dms[idx].columns[i])
-
-    f = open(data_path / "searchlight" / "bmaps_conditions.pkl", "wb")
-    pickle.dump([b_maps, conditions_label], f)
+        # Make a variable with condition labels for use in later classification
+        conditions_label.extend(trial_dms[idx].columns[:N])
+
+    # save all beta maps as one 4D image (uncompressed, so it can be memory-mapped)
+    bmaps_file = subject_path / "bmaps.nii"
+    nib.save(nib.Nifti1Image(np.concatenate(b_maps, axis=3), models[0].masker_.mask_img_.affine), bmaps_file)
+    b_maps = nib.load(bmaps_file, mmap=True)
+
+    # only the file name of the beta maps is pickled (the data is in bmaps.nii)
+    f = open(subject_path / "bmaps_conditions.pkl", "wb")
+    pickle.dump([bmaps_file.name, conditions_label], f)
     f.close()
 
     return b_maps, conditions_label
 
-def main():
-    subject = "0117"
+def load_bmaps(subject_path):
+    '''
+    Load the beta maps (memory-mapped) and condition labels saved by create_bmaps.
+
+    Returns
+        b_maps: 4D image with one beta map per trial (None if the beta maps have not been created yet)
+        conditions_label: list of condition labels (one per trial)
+    '''
+    if not (subject_path / "bmaps_conditions.pkl").exists():
+        return None, None
+
+    with open(subject_path / "bmaps_conditions.pkl", 'rb') as f:
+        b_maps, conditions_label  = pickle.load(f)
+
+    # the beta maps are stored as one 4D image next to the pickle
+    return nib.load(subject_path / b_maps, mmap=True), conditions_label
+
+def prep_subject(bids_path, subject, subject_path, n_workers=None, overwrite=False, table_cache=None, bold_cache=None, max_bold_cache_bytes=None):
+    '''
+    Create the beta maps of a single subject. Beta maps created before are reused unless overwrite is True.
+
+    Args
+        bids_path: path to bids directory (root)
+        subject: ID of subject (e.g., "0117")
+        subject_path: path to the searchlight folder of the subject (e.g., data/searchlight/sub-0117)
+        n_workers: number of runs fitted at the same time (see flm_new_design_matrix)
+        overwrite: refit the models even if the beta maps exist
+        table_cache: path to the cache of the events, confounds and image headers (see ingest.py)
+        bold_cache, max_bold_cache_bytes: cache of decompressed BOLD series (see flm_new_design_matrix)
+
+    Returns
+        b_maps: 4D image with one beta map per trial
+        conditions_label: list of condition labels (one per trial)
+    '''
+    subject_path.mkdir(parents=True, exist_ok=True)
+
+    if not overwrite:
+        b_maps, conditions_label = load_bmaps(subject_path)
+        if b_maps is not None:
+            return b_maps, conditions_label
 
-    # define paths 
-    path = pathlib.Path(__file__)
-    data_path = path.parents[2] / "data"
-    bids_path = data_path / "InSpePosNegData" / "BIDS_2023E"
     fprep_f_paths, event_paths, confounds_paths, mask_paths = get_paths(bids_path, subject, n_runs=6)
     
-    # load flms, events and confounds
-    flms = load_all_flms(data_path / "all_flms")
-    events = get_events(event_paths)
-    confounds = get_confounds(confounds_paths)
+    # load events and confounds
+    events = get_events(event_paths, table_cache=table_cache)
+    confounds = get_confounds(confounds_paths, table_cache=table_cache)
+
+    # check that all runs are on the same grid before fitting
+    check_run_geometry(fprep_f_paths[:len(events)], cache_dir=table_cache)
 
     # create first level matrices
-    trial_dms = first_level_matrix(events, confounds, fprep_f_paths)
+    trial_dms = first_level_matrix(events, confounds, fprep_f_paths, table_cache=table_cache)
 
     # create new first_level_models
-    models = flm_new_design_matrix(events, confounds, fprep_f_paths, trial_dms, data_path)
+    models = flm_new_design_matrix(events, confounds, fprep_f_paths, trial_dms, subject_path, mask_paths=mask_paths, n_workers=n_workers, bold_cache=bold_cache, max_bold_cache_bytes=max_bold_cache_bytes)
     
     # create bmaps
-    bmaps, conditions_label = create_bmaps(events, trial_dms, models, data_path)
+    return create_bmaps(events, trial_dms, models, subject_path)
+
+def main(subject="0117"):
+    # define paths 
+    path = pathlib.Path(__file__)
+    data_path = path.parents[2] / "data"
+    bids_path = data_path / "InSpePosNegData" / "BIDS_2023E"
+
+    # create bmaps (each subject has its own folder)
+    bmaps, conditions_label = prep_subject(bids_path, subject, data_path / "searchlight" / f"sub-{subject}", overwrite=True, table_cache=data_path / "cache" / "tables", bold_cache=data_path / "cache" / "bold", max_bold_cache_bytes=100 * 1024**3)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,161 @@
+'''
+Masked sample matrix (trials x voxels) of the beta maps used for classification.
+'''
+import pathlib
+import json
+
+import numpy as np
+import nibabel as nib
+
+from nilearn.image import load_img
+
+# import own functions
+import sys
+sys.path.append(str(pathlib.Path(__file__).parents[2] / "src"))
+
+from masks import mask_voxels, save_mask_store, load_mask_store, mask_to_img
+
+def save_samples(b_maps, idx, labels, mask_img, splits:dict, samples_path:pathlib.Path):
+    '''
+    Mask the beta maps of the selected trials and save them as a sample matrix.
+
+    Args
+        b_maps: beta maps (4D image, ideally memory-mapped, or list of 3D images)
+        idx: indices of the selected trials (in the order of the rows of the sample matrix)
+        labels: label of every selected trial
+        mask_img: whole brain mask, image or stored mask (resampled to the grid of the beta maps, as in nilearn's SearchLight). 
+                  It is also stored as is as the mask of the sphere centres (see samples_process_mask)
+        splits: dictionary of contrast name -> (rows of the training samples, rows of the test samples)
+        samples_path: folder to save the sample matrix in
+
+    Returns
+        samples: the sample matrix (output of load_samples)
+    '''
+    samples_path = pathlib.Path(samples_path)
+    samples_path.mkdir(parents=True, exist_ok=True)
+
+    # grid of the beta maps
+    first_img = load_img(b_maps[0]) if isinstance(b_maps, list) else b_maps
+    shape, affine = first_img.shape[:3], first_img.affine
+
+    # voxels of the mask (only resampled if the mask is not on the grid of the beta maps, see masks.mask_voxels)
+    voxels = mask_voxels(mask_img, shape, affine)
+
+    # mask one trial at a time, so only one volume is in memory
+    X = np.lib.format.open_memmap(samples_path / "X.npy", mode="w+", dtype=np.float32, shape=(len(idx), voxels.size))
+
+    for row, trial in enumerate(idx):
+        volume = load_img(b_maps[trial]).get_fdata() if isinstance(b_maps, list) else np.asarray(b_maps.dataobj[..., trial])
+        X[row] = volume.ravel()[voxels]
+
+    X.flush()
+    del X
+
+    np.save(samples_path / "labels.npy", np.asarray(labels).astype(str))
+    np.save(samples_path / "voxels.npy", voxels)
+
+    # sphere centres of the searchlight are the voxels of the mask on its own grid (as SearchLight without a process_mask_img)
+    save_mask_store(mask_to_img(mask_img) if isinstance(mask_img, dict) else mask_img, "process_mask", samples_path)
+
+    # the splits are small, so they are stored in the header
+    header = {
+        "shape": list(shape), 
+        "affine": np.asarray(affine).tolist(), 
+        "trials": np.asarray(idx).tolist(),
+        "splits": {name: {"train": np.asarray(train).tolist(), "test": np.asarray(test).tolist()} for name, (train, test) in splits.items()},
+    }
+
+    with open(samples_path / "header.json", "w") as f:
+        json.dump(header, f, indent=2)
+
+    return load_samples(samples_path)
+
+def load_samples(samples_path:pathlib.Path):
+    '''
+    Load a sample matrix (the data is memory-mapped).
+
+    Returns
+        samples: dictionary with the data "X" (n_trials, n_voxels), the "labels", the row indices of the "train" and "test" samples of every contrast ("splits"),
+                 the flat indices of the voxels in the grid of the beta maps "voxels", the "shape" and "affine" of that grid, and the "path" of the sample matrix
+    '''
+    samples_path = pathlib.Path(samples_path)
+
+    with open(samples_path / "header.json") as f:
+        header = json.load(f)
+
+    return {
+        "X": np.load(samples_path / "X.npy", mmap_mode="r"),
+        "labels": np.load(samples_path / "labels.npy"),
+        "splits": {name: {split: np.array(rows, dtype=int) for split, rows in rows_split.items()} for name, rows_split in header["splits"].items()},
+        "voxels": np.load(samples_path / "voxels.npy"),
+        "shape": header["shape"],
+        "affine": np.array(header["affine"]),
+        "path": samples_path,
+    }
+
+def samples_mask(samples):
+    '''
+    Mask of the voxels in the sample matrix as a stored mask (packed bits and flat voxel indices, see masks.py).
+    '''
+    mask = np.zeros(np.prod(samples["shape"]), dtype=bool)
+    mask[samples["voxels"]] = True
+
+    return {"bits": np.packbits(mask), "voxels": samples["voxels"], "shape": samples["shape"], "affine": samples["affine"], "key": None}
+
+def samples_mask_img(samples):
+    '''
+    Mask of the voxels in the sample matrix (Nifti image on the grid of the beta maps).
+    '''
+    mask = np.zeros(np.prod(samples["shape"]), dtype=np.int8)
+    mask[samples["voxels"]] = 1
+
+    return nib.Nifti1Image(mask.reshape(samples["shape"]), samples["affine"])
+
+def samples_process_mask(samples):
+    '''
+    Mask of the sphere centres of the searchlight as a stored mask: the whole brain mask the sample matrix was made with, on its own grid (e.g., the anatomical grid).
+    Sample matrices saved without it fall back to the mask of the sample matrix (see samples_mask).
+    '''
+    mask = load_mask_store(samples["path"], "process_mask") if "path" in samples else None
+
+    return mask if mask is not None else samples_mask(samples)
+
+def samples_process_mask_img(samples):
+    '''
+    Mask of the sphere centres of the searchlight (Nifti image, see samples_process_mask).
+    '''
+    return mask_to_img(samples_process_mask(samples))
+
+def split_samples(samples, split:str="train", contrast:str=None):
+    '''
+    Get the data and labels of the training or test samples of a contrast.
+
+    Args
+        samples: sample matrix (output of load_samples)
+        split: "train" or "test"
+        contrast: name of the contrast. If None, the first contrast is used
+
+    Returns
+        X: array of shape (n_samples, n_voxels)
+        labels: label of every sample
+    '''
+    rows = split_rows(samples, split, contrast)
+
+    return samples["X"][rows], samples["labels"][rows]
+
+def split_rows(samples, split:str="train", contrast:str=None):
+    '''
+    Rows of the training or test samples of a contrast (the first contrast if None).
+    '''
+    if contrast is None:
+        contrast = next(iter(samples["splits"]))
+
+    return samples["splits"][contrast][split]
+
+def mask_columns(samples, mask_img):
+    '''
+    Columns of the sample matrix within a mask (resampled to the grid of the beta maps if needed).
+    '''
+    voxels = mask_voxels(mask_img, samples["shape"], samples["affine"])
+
+    return np.flatnonzero(np.isin(samples["voxels"], voxels))
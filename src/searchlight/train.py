@@ -3,17 +3,23 @@ Searchlight classification
 '''
 import pathlib
 import pickle
+import shutil
 
 import numpy as np
 import pandas as pd
+import nibabel as nib
 
-from nilearn.image import index_img, concat_imgs
 from nilearn.image import new_img_like, load_img
+from nilearn.masking import unmask
 from sklearn.model_selection import train_test_split
 
 from nilearn.decoding import SearchLight
 from sklearn.naive_bayes import GaussianNB
 
+from engine import gnb_searchlight, checkpointed_gnb_searchlight, gnb_searchlight_contrasts
+from samples import save_samples, load_samples, samples_mask_img, samples_process_mask_img, split_samples, split_rows
+from prep import load_bmaps
+
 def remake_labels(conditions_label): 
     '''
     Remake labels for classification
@@ -41,67 +47,119 @@ def remake_labels(conditions_label):
     return idx_neg, idx_pos, idx_but, idx_but_press, conditions_label
 
 
-def reshape_classify(idx_cond1, idx_cond2, conditions_label, b_maps, data_path, filename):
+def reshape_classify(idx_cond1, idx_cond2, conditions_label, b_maps, mask_img, samples_path, contrast="pos_neg"):
     '''
     Reshape for classification. Select two conditions of interest by inserting their indicies.
+    The beta maps of the selected trials are masked once into a sample matrix (see samples.py), split into training and testing rows.
 
     Args
         idx_cond1: indicies of condition 1
         idx_cond2: indicies of condition 2 
         conditions_label: labels of conditions 
-        b_maps: beta maps 
-        data_path: where the returned arguments should be saved
-        filename: name of the file of the returned arguments to be saved 
+        b_maps: beta maps (4D image or list of 3D images)
+        mask_img: whole brain mask
+        samples_path: folder where the sample matrix should be saved
+        contrast: name of the contrast
+
+    Returns
+        samples: sample matrix (see samples.load_samples)
     '''
-    # concatenate bmaps
-    b_maps_conc=concat_imgs(b_maps)
+    return reshape_classify_batch({contrast: (idx_cond1, idx_cond2)}, conditions_label, b_maps, mask_img, samples_path)
 
-    # select conditions (indexes of relevant cnonds)
-    idx = np.concatenate((idx_cond1, idx_cond2))
 
-    # select trials
-    conditions = np.array(conditions_label)[idx]
-    
-    # select bmaps
-    b_maps_img = index_img(b_maps_conc, idx)
-
-    # Make an index for spliting fMRI data with same size as class labels
-    idx2 = np.arange(conditions.shape[0])
-
-    # create training and testing vars on the basis of class labels (is this the correct split?? Notebook says this)
-    idx_train, idx_test, conditions_train, conditions_test = train_test_split(
-        idx2, 
-        conditions, 
-        test_size=0.2, 
-        random_state=2502
-        )
-    
-    # reshape data
-    fmri_img_train = index_img(b_maps_img, idx_train)
-    fmri_img_test = index_img(b_maps_img, idx_test)
+def reshape_classify_batch(condition_pairs, conditions_label, b_maps, mask_img, samples_path):
+    '''
+    Reshape for classification of several pairs of conditions (one sample matrix, training and testing rows per pair as in reshape_classify).
 
-    f = open(data_path / filename, 'wb')
-    pickle.dump([fmri_img_train, fmri_img_test, conditions_train, conditions_test], f)
-    f.close()
+    Args
+        condition_pairs: dictionary of contrast name -> (indicies of condition 1, indicies of condition 2), e.g., {"pos_neg": (idx_pos, idx_neg)}
+        conditions_label: labels of conditions 
+        b_maps: beta maps (4D image or list of 3D images)
+        mask_img: whole brain mask
+        samples_path: folder where the sample matrix should be saved
+
+    Returns
+        samples: sample matrix (see samples.load_samples)
+    '''
+    # all selected trials (each trial only once, in the order they are first selected)
+    idx_all = np.concatenate([np.concatenate(pair) for pair in condition_pairs.values()]).astype(int)
+    idx_all = idx_all[np.sort(np.unique(idx_all, return_index=True)[1])]
+    row_of_trial = {trial: row for row, trial in enumerate(idx_all)}
+
+    splits = {}
+
+    for contrast, (idx_cond1, idx_cond2) in condition_pairs.items():
+        # select conditions (indexes of relevant cnonds)
+        idx = np.concatenate((idx_cond1, idx_cond2)).astype(int)
+
+        # select trials
+        conditions = np.array(conditions_label)[idx]
+
+        # Make an index for spliting fMRI data with same size as class labels
+        idx2 = np.arange(conditions.shape[0])
+
+        # create training and testing vars on the basis of class labels (is this the correct split?? Notebook says this)
+        idx_train, idx_test, conditions_train, conditions_test = train_test_split(
+            idx2, 
+            conditions, 
+            test_size=0.2, 
+            random_state=2502
+            )
 
-    return fmri_img_train, fmri_img_test, conditions_train, conditions_test
+        # rows of the sample matrix
+        splits[contrast] = ([row_of_trial[trial] for trial in idx[idx_train]], [row_of_trial[trial] for trial in idx[idx_test]])
+    
+    # mask the selected beta maps (the splits are stored as row indices)
+    samples = save_samples(b_maps, idx_all, np.array(conditions_label)[idx_all], mask_img, splits, samples_path)
+
+    return samples
 
 
-def run_searchlight(mask_img, fmri_img_train, conditions_train, data_path, filename):
+def run_searchlight(samples, data_path, filename, engine="gnb", cache_dir=None, checkpoint_path=None, contrast=None):
     '''
-    Run searchlight classification. Save to data path.
+    Run searchlight classification on the training samples. Save to data path.
+
+    Args
+        samples: sample matrix (output of reshape_classify or samples.load_samples)
+        contrast: name of the contrast in the sample matrix (if None, the first contrast)
+        engine: "gnb" to use the fast Gaussian naive Bayes engine (see engine.py) or "nilearn" to fit nilearn's SearchLight
+        cache_dir: path to the sphere neighbourhood cache (only used by the "gnb" engine, see engine.neighbourhood_index)
+        checkpoint_path: if specified, the "gnb" engine processes the spheres in chunks saved here, so a killed run resumes where it stopped 
+                         (see engine.checkpointed_gnb_searchlight)
+
+    Returns
+        searchlight: fitted searchlight. None if other processes are still working on the same checkpoint (nothing is saved then)
     '''
+    # the spheres hold the voxels of the sample matrix, their centres are the voxels of the whole brain mask on its own grid (as SearchLight without a process mask)
+    mask_img = samples_mask_img(samples)
+    process_mask_img = samples_process_mask_img(samples)
+    X_train, conditions_train = split_samples(samples, "train", contrast)
+
     # initialize searchlight
     print("Intializing searchlight ...")
     searchlight = SearchLight(
     mask_img,
+    process_mask_img=process_mask_img,
     estimator=GaussianNB(),
     radius=5, n_jobs=-1,
     verbose=5, cv=3)
     
     # fit searchlight
     print("Fitting searchlight ...")
-    searchlight.fit(fmri_img_train, conditions_train)
+    if engine == "gnb" and checkpoint_path is not None:
+        scores = checkpointed_gnb_searchlight(mask_img, X_train, conditions_train, checkpoint_path, radius=searchlight.radius, cv=searchlight.cv, process_mask_img=process_mask_img, cache_dir=cache_dir)
+
+        # the remaining chunks are done by other processes (the last one to finish saves the searchlight)
+        if scores is None:
+            print("Other processes are still working on this searchlight")
+            return None
+
+        searchlight.scores_ = scores
+    elif engine == "gnb":
+        # same scores as searchlight.fit, computed for all spheres at once
+        searchlight.scores_ = gnb_searchlight(mask_img, X_train, conditions_train, radius=searchlight.radius, cv=searchlight.cv, process_mask_img=process_mask_img, cache_dir=cache_dir)
+    else:
+        searchlight.fit(unmask(X_train, mask_img), conditions_train)
     
     # save searchlight pickle
     f = open(data_path / filename, 'wb')
@@ -111,39 +169,125 @@ def run_searchlight(mask_img, fmri_img_train, conditions_train, data_path, filen
     return searchlight
 
 
-def main(): 
-    subject = "0117"
-    np.random.seed(2502)
-    
-    # define paths 
-    path = pathlib.Path(__file__)
-    data_path = path.parents[2] / "data" / "searchlight"
-    bids_path = path.parents[2] / "data" / "InSpePosNegData" / "BIDS_2023E"
+def run_searchlight_batch(samples, data_path, cache_dir=None, checkpoint_path=None):
+    '''
+    Run searchlight classification (with the "gnb" engine) for all contrasts in the sample matrix at once, saved as "searchlight_{contrast}.pkl".
+
+    Args
+        samples: sample matrix (output of reshape_classify_batch or samples.load_samples)
+        cache_dir: path to the sphere neighbourhood cache
+        checkpoint_path: if specified, the spheres are processed in chunks saved here, so a killed run resumes where it stopped (as in run_searchlight)
+
+    Returns
+        searchlights: dictionary of contrast name -> fitted searchlight (None for all contrasts if other processes are still working on the same checkpoint)
+    '''
+    # voxels of the spheres and sphere centres (as in run_searchlight)
+    mask_img = samples_mask_img(samples)
+    process_mask_img = samples_process_mask_img(samples)
+
+    # training rows and labels of every contrast
+    contrasts = {}
+    for contrast in samples["splits"]:
+        rows = split_rows(samples, "train", contrast)
+        contrasts[contrast] = (rows, samples["labels"][rows])
+
+    print(f"Fitting searchlight for {len(contrasts)} contrasts ...")
+    scores = gnb_searchlight_contrasts(mask_img, samples["X"], contrasts, radius=5, cv=3, process_mask_img=process_mask_img, cache_dir=cache_dir, checkpoint_path=checkpoint_path)
+
+    # the remaining chunks are done by other processes (the last one to finish saves the searchlights)
+    if scores is None:
+        print("Other processes are still working on this searchlight")
+        return {contrast: None for contrast in contrasts}
+
+    searchlights = {}
+
+    for contrast, contrast_scores in scores.items():
+        searchlight = SearchLight(
+        mask_img,
+        process_mask_img=process_mask_img,
+        estimator=GaussianNB(),
+        radius=5, n_jobs=-1,
+        verbose=5, cv=3)
+        searchlight.scores_ = contrast_scores
 
-    # load all flms, trial_dms for particular subject
-    with open(data_path / "all_flms.pkl", 'rb') as f:
-        all_flms, trial_dms  = pickle.load(f)
+        # save searchlight pickle
+        f = open(data_path / f"searchlight_{contrast}.pkl", 'wb')
+        pickle.dump([searchlight, searchlight.scores_], f)
+        f.close()
 
-    # load all bmaps and condition labels for particular subject
-    with open(data_path / "bmaps_conditions.pkl", 'rb') as f:
-        b_maps, conditions_label  = pickle.load(f)
+        searchlights[contrast] = searchlight
+
+    return searchlights
+
+
+def train_subject(bids_path, subject, subject_path, batch=False, cache_dir=None, b_maps=None, conditions_label=None):
+    '''
+    Run the searchlight classification of a single subject on its beta maps (see prep.py).
+    The sample matrix is reused if it was made before for the same pairs of conditions.
+
+    Args
+        bids_path: path to bids directory (root)
+        subject: ID of subject (e.g., "0117")
+        subject_path: path to the searchlight folder of the subject (e.g., data/searchlight/sub-0117)
+        batch: also classify the image conditions against the button images (all pairs in one batch)
+        cache_dir: path to the sphere neighbourhood cache
+        b_maps, conditions_label: beta maps and condition labels (output of prep.create_bmaps). If None, they are loaded from subject_path
+
+    Returns
+        samples: sample matrix (see samples.load_samples)
+        searchlights: dictionary of contrast name -> fitted searchlight (None for a searchlight other processes are still working on)
+    '''
+    # load all bmaps and condition labels for particular subject (memory-mapped)
+    if b_maps is None:
+        b_maps, conditions_label = load_bmaps(subject_path)
 
     # remake labels
-    idx_neg, idx_pos, idx_but, idx_but_press, conditions_label = remake_labels(conditions_label)
-    
-    # reshape and split for classification on the conditions we are interested in 
-    cond1, cond2 = idx_pos, idx_neg
-    filename_RESHAPE = "searchlight_reshaped_data.pkl"
-    fmri_img_train, fmri_img_test, conditions_train, conditions_test = reshape_classify(cond1, cond2, conditions_label, b_maps, data_path, filename_RESHAPE)
+    idx_neg, idx_pos, idx_but, idx_but_press, conditions_label = remake_labels(list(conditions_label))
+
+    # conditions we are interested in (the batch mode also classifies the image conditions against the button images)
+    condition_pairs = {"pos_neg": (idx_pos, idx_neg)}
+    if batch:
+        condition_pairs.update({"pos_but": (idx_pos, idx_but), "neg_but": (idx_neg, idx_but)})
+
+    # reuse the sample matrix if it has the same pairs and was made after the beta maps
+    samples_path = subject_path / "samples"
+    samples = None
+
+    if (samples_path / "header.json").exists() and (samples_path / "header.json").stat().st_mtime >= (subject_path / "bmaps_conditions.pkl").stat().st_mtime:
+        samples = load_samples(samples_path)
 
-    # get mask paths, load masks
-    mask_path = bids_path / pathlib.Path(f'derivatives/sub-{subject}/anat/sub-{subject}_acq-T1sequence_run-1_space-MNI152NLin2009cAsym_desc-brain_mask.nii.gz')
-    subject_mask = load_img(mask_path)
+    if samples is None or list(samples["splits"]) != list(condition_pairs):
+        # checkpoints of searchlights on an old sample matrix cannot be resumed
+        shutil.rmtree(subject_path / "checkpoints", ignore_errors=True)
+
+        # get mask paths, load masks
+        mask_path = bids_path / pathlib.Path(f'derivatives/sub-{subject}/anat/sub-{subject}_acq-T1sequence_run-1_space-MNI152NLin2009cAsym_desc-brain_mask.nii.gz')
+        subject_mask = load_img(mask_path)
+
+        # reshape and split for classification (masked once into a sample matrix shared by all pairs)
+        samples = reshape_classify_batch(condition_pairs, conditions_label, b_maps, subject_mask, samples_path)
 
     # run searchlight 
-    filename_SL = 'searchlight_pos_neg.pkl'
-    searchlight = run_searchlight(subject_mask, fmri_img_train, conditions_train, data_path, filename_SL)
+    if batch:
+        searchlights = run_searchlight_batch(samples, subject_path, cache_dir=cache_dir, checkpoint_path=subject_path / "checkpoints" / "searchlight_batch")
+    else:
+        filename_SL = 'searchlight_pos_neg.pkl'
+        searchlights = {"pos_neg": run_searchlight(samples, subject_path, filename_SL, cache_dir=cache_dir, 
+                                                   checkpoint_path=subject_path / "checkpoints" / pathlib.Path(filename_SL).stem)}
+
+    return samples, searchlights
+
+
+def main(subject="0117", batch=False): 
+    np.random.seed(2502)
+    
+    # define paths 
+    path = pathlib.Path(__file__)
+    data_path = path.parents[2] / "data" / "searchlight"
+    bids_path = path.parents[2] / "data" / "InSpePosNegData" / "BIDS_2023E"
+
+    samples, searchlights = train_subject(bids_path, subject, data_path / f"sub-{subject}", batch=batch, cache_dir=data_path.parent / "cache" / "neighbourhoods")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -2,26 +2,91 @@
 Script to perform GLM analysis on the data (including plotting)
 '''
 import pathlib
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from nilearn.glm.first_level import FirstLevelModel
 from nilearn.glm.second_level import SecondLevelModel
 from nilearn import plotting
 from nilearn.plotting import plot_stat_map
 from scipy.stats import norm
 import atlasreader 
 
-from utils import load_all_flms, remove_flms
 
-def second_level(flms):
+from masks import group_mask, values_to_img, intersect_mask_stores
+from group_ols import stack_effect_maps, fit_ols, compute_group_contrasts, group_stats, add_subject, remove_subject, fit_group_stats, leave_one_subject_out, save_group_stats, load_group_stats
+from group_permutation import sign_flip_inference
+from flm_store import store_key
+
+def second_level(flms, mask_img=None):
     '''
-    Perform second level analysis on the data using already created first level models
+    Perform second level analysis on the data using already created first level models (or first level contrast maps, see utils.load_contrast_maps)
+
+    Args
+        flms: first level models or maps (e.g., contrast maps or searchlight accuracy maps)
+        mask_img: group mask. If None, computed by the second level model
     '''
     # init second level model with smoothing parameter (njobs = -2 to use all cores EXCEPT 1 for faster compute)
-    second_level_mdl = SecondLevelModel(smoothing_fwhm=8.0, n_jobs=-2)
+    second_level_mdl = SecondLevelModel(mask_img=mask_img, smoothing_fwhm=8.0, n_jobs=-2)
 
-    # fit second level model
-    second_level_mdl = second_level_mdl.fit(flms)
+    # fit second level model (contrast maps need a design matrix, here a one sample test)
+    if isinstance(flms[0], FirstLevelModel):
+        second_level_mdl = second_level_mdl.fit(flms)
+    else:
+        design_matrix = pd.DataFrame([1] * len(flms), columns=["intercept"])
+        second_level_mdl = second_level_mdl.fit(flms, design_matrix=design_matrix)
 
     return second_level_mdl
 
+def update_group_stats(stats_path, store_path, contrast, subjects, stats_mask, smoothing_fwhm=8.0):
+    '''
+    Update the saved statistics of a one sample group model to a list of subjects (only the maps of removed and added subjects are loaded).
+    The statistics are rebuilt if the voxels changed, or if the model of a subject was refitted or deleted.
+
+    Args
+        stats_path: folder of the statistics (e.g., data/group_stats/positive_img-negative_img_fwhm-8.0)
+        store_path: path to the first level model store
+        contrast: first level contrast
+        subjects: list of subject ids of the group model
+        stats_mask: mask of the voxels of the statistics (stored mask). Should contain the group mask of any list of subjects (e.g., the union of all subject masks),
+                    as the group mask grows when a subject is removed
+        smoothing_fwhm: smoothing of the first level maps in mm
+
+    Returns
+        stats: statistics of the group model of the subjects
+    '''
+    stats, voxels, saved_versions = load_group_stats(stats_path)
+
+    # version of the first level model of every subject (the key of its fit in the store header, None if it is not in the store)
+    versions = {subject: store_key(store_path, subject) for subject in set(subjects) | set(stats["subjects"] if stats else [])}
+
+    outdated = stats is None or voxels is None or not np.array_equal(voxels, stats_mask["voxels"]) or any(saved_versions.get(subject) != versions[subject] for subject in stats["subjects"])
+
+    removed = [subject for subject in stats["subjects"] if subject not in subjects] if not outdated else []
+
+    # only the maps of the subjects that are removed or added are loaded
+    if not outdated:
+        try:
+            for subject, y in zip(removed, stack_effect_maps(store_path, contrast, removed, stats_mask, smoothing_fwhm=smoothing_fwhm)):
+                stats = remove_subject(stats, subject, y)
+        except FileNotFoundError: # the store of a removed subject was deleted
+            outdated = True
+
+    if outdated:
+        stats = group_stats(len(stats_mask["voxels"]))
+
+    added = [subject for subject in subjects if subject not in stats["subjects"]]
+
+    if not removed and not added:
+        return stats
+
+    for subject, y in zip(added, stack_effect_maps(store_path, contrast, added, stats_mask, smoothing_fwhm=smoothing_fwhm)):
+        stats = add_subject(stats, subject, y)
+
+    save_group_stats(stats, stats_path, voxels=stats_mask["voxels"], versions={subject: versions[subject] for subject in stats["subjects"]})
+
+    return stats
+
 def plot_wholebrain_contrasts(second_level_mdl, contrast = "positive_img - negative_img", pval = 0.001, save_path = None):
     '''
     Plot wholebrain contrasts for a group with a second level model
@@ -33,11 +98,33 @@ def plot_wholebrain_contrasts(second_level_mdl, contrast = "positive_img - negat
     Returns
         surface_plot, deep_plot: wholebrain plots of the contrast        
     '''
-    # setting the threshold (converts wanted p-value into critical value for said p-value)
-    threshold = norm.isf(pval)
+    # compute contrassts (if fitted on contrast maps, the first level contrast is already computed)
+    if isinstance(second_level_mdl.second_level_input_[0], FirstLevelModel):
+        zmap_g = second_level_mdl.compute_contrast(first_level_contrast = contrast, output_type="z_score")
+    else:
+        zmap_g = second_level_mdl.compute_contrast(output_type="z_score")
+
+    surface_plot, deep_plot = plot_zmap(zmap_g, pval=pval, save_path=save_path)
     
-    # compute contrassts
-    zmap_g = second_level_mdl.compute_contrast(first_level_contrast = contrast, output_type="z_score")
+    return surface_plot, deep_plot, zmap_g
+
+def plot_zmap(zmap_g, pval = 0.001, save_path = None, threshold = None, prefix = ""):
+    '''
+    Plot a group z map (e.g., from the group statistics, see main)
+
+    Args
+        zmap_g: z map
+        pval: uncorrected p-value to threshold the z map at
+        save_path: path to save the plots in
+        threshold: critical value to threshold the z map at (overrides pval, e.g., for a map that is already masked by corrected p-values)
+        prefix: prefix of the file names (e.g., "tfce_")
+
+    Returns
+        surface_plot, deep_plot: wholebrain plots of the z map
+    '''
+    # setting the threshold (converts wanted p-value into critical value for said p-value)
+    if threshold is None:
+        threshold = norm.isf(pval)
 
     # plot contrast
     surface_plot = plotting.plot_glass_brain(zmap_g, cmap="roy_big_bl", colorbar=True, threshold=threshold,
@@ -47,48 +134,110 @@ def plot_wholebrain_contrasts(second_level_mdl, contrast = "positive_img - negat
               display_mode='z',  black_bg=False)
     
     if save_path is not None:
-        surface_plot.savefig(save_path / "surface_plot.png")
-        deep_plot.savefig(save_path / "deep_plot.png")
+        surface_plot.savefig(save_path / f"{prefix}surface_plot.png")
+        deep_plot.savefig(save_path / f"{prefix}deep_plot.png")
     
-    return surface_plot, deep_plot, zmap_g
+    return surface_plot, deep_plot
 
-def get_atlas(stat_map, save_path, pval:int=0.001): 
+def permutation_inference(Y, mask, n_permutations=5000, alpha=0.05, save_path=None, **kwargs):
+    '''
+    Non-parametric group inference of a one sample test (sign-flip permutations with TFCE, see group_permutation.py).
+
+    Args
+        Y: stacked first level maps (output of group_ols.stack_effect_maps)
+        mask: group mask (stored mask)
+        n_permutations: number of sign flips
+        alpha: FWE corrected significance level
+        save_path: if specified, the FWE corrected p-maps are saved here (p_voxel_fwe.nii.gz, p_tfce_fwe.nii.gz and p_cluster_fwe.nii.gz)
+        kwargs: passed to group_permutation.sign_flip_inference (e.g., cluster_pval, n_jobs)
+
+    Returns
+        results: output of sign_flip_inference
+        pmaps: dictionary of "p_voxel_fwe", "p_tfce_fwe" and "p_cluster_fwe" -> p-map (Nifti image)
+        tfce_zmap: z map of the voxels significant after TFCE (zero elsewhere)
+    '''
+    results = sign_flip_inference(Y, mask, n_permutations=n_permutations, **kwargs)
+
+    pmaps = {name: values_to_img(results[name], mask) for name in ["p_voxel_fwe", "p_tfce_fwe", "p_cluster_fwe"]}
+
+    # z map of the group t map (as the z map of the OLS fit), restricted to the voxels surviving the correction
+    z = compute_group_contrasts(fit_ols(Y), {"intercept": "intercept"}, output_types=["z_score"])["intercept"]["z_score"]
+    tfce_zmap = values_to_img(np.where(results["p_tfce_fwe"] < alpha, z, 0), mask)
+
+    if save_path is not None:
+        save_path.mkdir(parents=True, exist_ok=True)
+        for name, pmap in pmaps.items():
+            nib.save(pmap, save_path / f"{name}.nii.gz")
+
+    return results, pmaps, tfce_zmap
+
+def get_atlas(stat_map, save_path, pval:int=0.001, threshold=None, cluster_extent=10): 
     '''
     Use atlas reader to extract coordinates 
 
     Args
         stat_map: fmri image statistical map (e.g., zmap_g)
+        threshold: critical value (overrides pval, e.g., for a map masked by corrected p-values)
+        cluster_extent: minimum number of voxels of a cluster (0 for a map that is already corrected at cluster level)
     '''
-    threshold = norm.isf(pval)
+    if threshold is None:
+        threshold = norm.isf(pval)
 
-    atlasreader.create_output(stat_map, voxel_thresh=threshold, cluster_extent=10, outdir=save_path)
+    atlasreader.create_output(stat_map, voxel_thresh=threshold, cluster_extent=cluster_extent, outdir=save_path)
     
 
 def main(): 
     # define paths 
     path = pathlib.Path(__file__)
-    data_path = path.parents[1] / "data" / "all_flms"
+    store_path = path.parents[1] / "data" / "flm_store"
 
-    # load all first level models (excludes subject 0119 based on sanity check)
-    flms_dict = load_all_flms(data_path, exclude_subjects=["0119"])
+    # subjects in the store (excludes subject 0119 based on sanity check)
+    subjects = sorted(folder.name[4:] for folder in store_path.iterdir() if folder.name.startswith("sub-") and folder.name != "sub-0119")
 
-    # get flms only 
-    flms = [val for val in flms_dict.values()]
+    # group mask (intersection of the subject masks saved by first_level.py, computed once and stored next to them)
+    mask = group_mask([f"sub-{subject}" for subject in subjects], path.parents[1] / "data" / "masks")
 
-    # perform second level analysis
+    # perform second level analysis (one sample test of the first level contrast) from the saved group statistics,
+    # which are updated with only the subjects that were added or excluded since the last run
     print("[INFO:] Making second level model ...")
-    second_level_mdl = second_level(flms)
+    # the subject masks are loaded one at a time (the next one is prefetched while the current one is added to the union)
+    stats_mask = intersect_mask_stores(load_masks(path.parents[1] / "data" / "masks", as_store=True).values(), threshold=0)
+
+    contrast = "positive_img - negative_img"
+    stats = update_group_stats(path.parents[1] / "data" / "group_stats" / "positive_img-negative_img_fwhm-8.0", store_path, contrast, subjects, stats_mask, smoothing_fwhm=8.0)
+
+    columns = np.searchsorted(stats_mask["voxels"], mask["voxels"])
+    zmap_g = values_to_img(compute_group_contrasts(fit_group_stats(stats, columns), {"intercept": "intercept"}, output_types=["z_score"])["intercept"]["z_score"], mask)
 
     # save path
     results_path = path.parents[1] / "results"
 
     # plot wholebrain contrasts
     print("[INFO:] Plotting results ...")
-    surface_plot, deep_plot, zmap_g = plot_wholebrain_contrasts(second_level_mdl, pval=0.001, save_path = results_path)
+    surface_plot, deep_plot = plot_zmap(zmap_g, pval=0.001, save_path = results_path)
 
     # read atlas 
     print("[INFO:] Finding clusters ...")
     atlas = get_atlas(zmap_g, results_path / "atlas_reader", pval=0.001)
+
+    # stack the smoothed first level contrast maps (only the contrast maps are loaded, not the whole models), used by the leave-one-subject-out analysis and the permutations
+    Y = stack_effect_maps(store_path, contrast, subjects, mask, smoothing_fwhm=8.0)
+
+    # sensitivity of the group map to each subject (leave-one-subject-out, one downdate of the statistics per subject)
+    print("[INFO:] Leave-one-subject-out analysis ...")
+    loso = leave_one_subject_out(stats, Y, subjects, columns=columns)
+
+    (results_path / "loso").mkdir(parents=True, exist_ok=True)
+    for subject, maps in loso.items():
+        nib.save(values_to_img(maps["intercept"]["z_score"], mask), results_path / "loso" / f"zmap_without_{subject}.nii.gz")
+
+    # non-parametric inference (FWE corrected with sign-flip permutations and TFCE)
+    print("[INFO:] Running permutation inference with TFCE ...")
+    results, pmaps, tfce_zmap = permutation_inference(Y, mask, n_permutations=5000, alpha=0.05, save_path=results_path / "permutation")
+
+    # every voxel left in the TFCE map survived the correction, so no further voxel or cluster threshold is applied
+    plot_zmap(tfce_zmap, save_path=results_path, threshold=1e-6, prefix="tfce_")
+    get_atlas(tfce_zmap, results_path / "atlas_reader_tfce", threshold=1e-6, cluster_extent=0)
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,5 +1,13 @@
 import pathlib
 import pickle
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from cache import cache_load, get_refs
+from flm_store import open_flm_store, load_contrast, store_to_img
+from masks import load_mask_store, mask_to_img
 
 def remove_flms(flms_dict, subject_ids=[]):
     '''
@@ -19,74 +27,235 @@ def remove_flms(flms_dict, subject_ids=[]):
     
     return flms_dict
 
-def load_all_flms(flm_path:pathlib.Path, exclude_subjects:list=[]): 
+class LazyDict(MutableMapping):
+    '''
+    Dictionary of subject id -> object, where each object is only loaded when it is accessed.
+    The next subject is prefetched in the background, and only the max_loaded most recently used objects are kept in memory.
+
+    Args
+        loaders: dictionary of subject id -> function without arguments that loads the object
+        max_loaded: number of objects kept in memory
+        prefetch: whether to load the next subject in the background
+    '''
+    def __init__(self, loaders:dict, max_loaded:int=1, prefetch:bool=True):
+        self.loaders = dict(loaders)
+        self.max_loaded = max_loaded
+        self.loaded = OrderedDict()
+        self.pinned = {}
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+    def __getitem__(self, subject_id):
+        if subject_id in self.pinned:
+            return self.pinned[subject_id]
+
+        if subject_id not in self.loaders:
+            raise KeyError(subject_id)
+
+        if subject_id in self.loaded:
+            self.loaded.move_to_end(subject_id)
+            obj = self.loaded[subject_id]
+        else:
+            # use the prefetched object if it is there, otherwise load it now
+            future = self.pending.pop(subject_id, None)
+            obj = future.result() if future is not None else self.loaders[subject_id]()
+
+            self.loaded[subject_id] = obj
+
+            # evict least recently used objects
+            while len(self.loaded) > self.max_loaded:
+                self.loaded.popitem(last=False)
+
+        self.prefetch_next(subject_id)
+
+        return obj
+
+    def prefetch_next(self, subject_id):
+        '''
+        Start loading the subject after subject_id in the background.
+        '''
+        if self.executor is None:
+            return
+
+        subject_ids = list(self.loaders)
+        position = subject_ids.index(subject_id)
+
+        if position + 1 < len(subject_ids):
+            next_id = subject_ids[position + 1]
+
+            if next_id not in self.loaded and next_id not in self.pending:
+                self.pending[next_id] = self.executor.submit(self.loaders[next_id])
+
+    def __setitem__(self, subject_id, obj):
+        # objects that are set directly are kept in memory
+        self.pinned[subject_id] = obj
+        self.loaders.pop(subject_id, None)
+
+    def __delitem__(self, subject_id):
+        if subject_id not in self.loaders and subject_id not in self.pinned:
+            raise KeyError(subject_id)
+
+        self.pinned.pop(subject_id, None)
+        self.loaders.pop(subject_id, None)
+        self.loaded.pop(subject_id, None)
+
+        future = self.pending.pop(subject_id, None)
+        if future is not None:
+            future.cancel()
+
+    def __iter__(self):
+        return iter([*self.loaders, *self.pinned])
+
+    def __len__(self):
+        return len(self.loaders) + len(self.pinned)
+
+def load_pickle(file:pathlib.Path):
+    with open(file, 'rb') as f:
+        return pickle.load(f)
+
+def load_cached_flm(cache_dir:pathlib.Path, key:str, file:pathlib.Path=None):
+    '''
+    Load a first level model from the model cache, falling back to its pickle file if it has been evicted from the cache.
+    '''
+    flm = cache_load(cache_dir, key)
+
+    if flm is None:
+        if file is None:
+            raise FileNotFoundError(f"First level model {key} was evicted from {cache_dir} and has no pickle file")
+        flm = load_pickle(file)
+
+    return flm
+
+def load_all_flms(flm_path:pathlib.Path, exclude_subjects:list=[], cache_dir:pathlib.Path=None, lazy:bool=True, max_loaded:int=1, prefetch:bool=True): 
     '''
     Load the first level models from a specified path. Option to exclude subjects based on their ID.
 
     Args
         flm_path: path to the first level models
-        exclude_subjects: list of subject ids to exclude
+        exclude_subjects: list of subject ids to exclude (their files are never opened)
+        cache_dir: if specified, models are resolved through the model cache of first_level.py (subjects in the cache take precedence over the files in flm_path)
+        lazy: if True, models are loaded when they are accessed (see LazyDict). If False, all models are loaded up front
+        max_loaded, prefetch: number of models kept in memory and whether to prefetch the next subject (see LazyDict)
 
     Returns
-        fl_models: list of first level models (objects)
+        fl_models: dictionary of subject id -> first level model (object)
     '''
 
-    # obtain all file paths (except for the excluded )
+    # obtain all file paths
     flm_files = [file for file in flm_path.iterdir() if file.name.endswith(".pkl")]
 
     # sort list of file paths
     flm_files.sort()
 
-    # initialize list for all models
-    all_flms = {}
+    # get the cache keys of all models in the cache (by subject id)
+    cache_keys = {}
+    if cache_dir is not None: 
+        cache_keys = {name.split("_")[1][:4]: key for name, key in get_refs(cache_dir).items() if name.startswith("flm_")}
+
+    # initialize loaders for all models
+    loaders = {}
 
     # iterate over file names
     for file in flm_files:
         # get subject id from name
         subject_id = file.name.split("_")[1][:4]
 
-        # load flm
-        flm = pickle.load(open(file, 'rb'))
+        # load flm (from the cache if possible)
+        if subject_id in cache_keys:
+            loaders[subject_id] = partial(load_cached_flm, cache_dir, cache_keys[subject_id], file)
+        else:
+            loaders[subject_id] = partial(load_pickle, file)
 
-        # append to list
-        all_flms[subject_id] = flm
+    # add models that are only in the cache
+    for subject_id, key in sorted(cache_keys.items()):
+        if subject_id not in loaders:
+            loaders[subject_id] = partial(load_cached_flm, cache_dir, key)
     
-    # remove the subjects should be excluded
-    all_flms = remove_flms(all_flms, subject_ids=exclude_subjects)
+    # remove the subjects should be excluded (before anything is loaded)
+    loaders = remove_flms(loaders, subject_ids=exclude_subjects)
+
+    if lazy:
+        return LazyDict(loaders, max_loaded=max_loaded, prefetch=prefetch)
+
+    # load all models 
+    all_flms = {subject_id: loader() for subject_id, loader in loaders.items()}
 
     return all_flms
 
 
-def load_masks(masks_object_path:pathlib.Path):
+def load_contrast_map(store_path:pathlib.Path, subject_id:str, contrast:str, output_type:str):
+    store = open_flm_store(store_path, subject_id)
+
+    return store_to_img(store, load_contrast(store, contrast, output_type=output_type))
+
+def load_contrast_maps(store_path:pathlib.Path, contrast:str, output_type:str="effect_size", exclude_subjects:list=[], lazy:bool=True, max_loaded:int=1, prefetch:bool=True):
     '''
-    Load saved mask objects from a specified path.
+    Load a contrast map per subject from the contrast cache of the first level model store (see flm_store.py).
 
     Args
-        masks_object_path: path to the mask objects (pkl)
+        store_path: path to the first level model store
+        contrast: contrast expression (e.g., "positive_img - negative_img")
+        output_type: "z_score", "stat", "effect_size" or "effect_variance"
+        exclude_subjects: list of subject ids to exclude
+        lazy, max_loaded, prefetch: see load_all_flms
 
     Returns
-        masks: list of masks (objects)
+        contrast_maps: dictionary of subject id -> contrast map (Nifti image)
     '''
+    # get subject ids from folder names (sub-0116)
+    subject_ids = sorted(folder.name[4:] for folder in store_path.iterdir() if folder.name.startswith("sub-"))
 
-    # obtain all file paths
-    mask_files = [file for file in masks_object_path.iterdir() if file.name.endswith(".pkl")]
+    loaders = {subject_id: partial(load_contrast_map, store_path, subject_id, contrast, output_type) for subject_id in subject_ids if subject_id not in exclude_subjects}
+
+    if lazy:
+        return LazyDict(loaders, max_loaded=max_loaded, prefetch=prefetch)
+
+    return {subject_id: loader() for subject_id, loader in loaders.items()}
+
+
+def load_stored_mask_img(masks_path:pathlib.Path, name:str):
+    '''
+    Load a mask from the mask store as a Nifti image.
+    '''
+    return mask_to_img(load_mask_store(masks_path, name))
+
+def load_masks(masks_path:pathlib.Path, exclude_subjects:list=[], as_store:bool=False, lazy:bool=True, max_loaded:int=1, prefetch:bool=True):
+    '''
+    Load the saved subject masks from the mask store (see masks.py).
+
+    Args
+        masks_path: path to the mask store (e.g., data/masks)
+        exclude_subjects: list of subject ids to exclude (their files are never opened)
+        as_store: return the stored masks (packed bits and flat voxel indices, see masks.load_mask_store) instead of Nifti images
+        lazy, max_loaded, prefetch: see load_all_flms
+
+    Returns
+        masks: dictionary of subject id -> mask (Nifti image, or stored mask if as_store)
+    '''
+
+    # obtain all subject folders (sub-0116)
+    mask_folders = [folder for folder in masks_path.iterdir() if folder.name.startswith("sub-") and (folder / "header.json").exists()]
 
     # sort 
-    mask_files.sort()
+    mask_folders.sort()
 
-    # initialize list for all masks
-    masks = {}
+    # initialize loaders for all masks
+    loaders = {}
 
-    # iterate over file names
-    for file in mask_files:
+    # iterate over folder names
+    for folder in mask_folders:
 
         # get subject id from name 
-        subject_id = file.name.split("_")[1][:4]
+        subject_id = folder.name[4:]
+
+        # add to to dict (unless excluded)
+        if subject_id not in exclude_subjects:
+            loaders[subject_id] = partial(load_mask_store if as_store else load_stored_mask_img, masks_path, folder.name)
 
-        # load mask
-        mask = pickle.load(open(file, 'rb'))
+    if lazy:
+        return LazyDict(loaders, max_loaded=max_loaded, prefetch=prefetch)
 
-        # add to to dict
-        masks[subject_id] = mask
+    # load masks
+    masks = {subject_id: loader() for subject_id, loader in loaders.items()}
     
-    return masks
\ No newline at end of file
+    return masks
@@ -0,0 +1,99 @@
+'''
+Resource limits of worker processes (shared by the process pools of the first level fits, the searchlight and the group permutations)
+'''
+import os
+
+# address space reserved for the stack of every thread (default of glibc)
+THREAD_STACK_BYTES = 8 * 1024**2
+
+def split_cores(n_subjects, n_workers=None, n_cores=None, mem_per_worker=None):
+    '''
+    Split the core budget between subject-level parallelism (worker processes) and run-level parallelism (n_jobs of each FirstLevelModel).
+
+    Args
+        n_subjects: number of subjects to fit
+        n_workers: number of subjects fitted at the same time. If None, as many as the cores (and memory) allow
+        n_cores: total number of cores to use. If None, all cores except 1
+        mem_per_worker: memory cap per worker in bytes. If given, the number of workers is bounded by the available memory
+
+    Returns
+        n_workers: number of worker processes
+        n_jobs: number of jobs passed to each FirstLevelModel
+    '''
+    if n_cores is None:
+        n_cores = max(1, (os.cpu_count() or 1) - 1)
+
+    if n_workers is None:
+        n_workers = min(n_subjects, n_cores)
+
+    # do not start more workers than fit in memory
+    if mem_per_worker is not None:
+        try:
+            available_mem = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+            n_workers = min(n_workers, max(1, available_mem // mem_per_worker))
+        except (ValueError, OSError, AttributeError): # sysconf is not available on all platforms
+            pass
+
+    n_workers = max(1, min(n_workers, n_subjects))
+
+    # give the remaining cores to the run-level fits within each worker
+    n_jobs = max(1, n_cores // n_workers)
+
+    return n_workers, n_jobs
+
+def limit_worker_memory(mem_per_worker, mapped_bytes:int=0, n_threads:int=1):
+    '''
+    Cap the address space of a worker process (RLIMIT_AS). A subject exceeding the cap fails with a MemoryError instead of taking down the node.
+    The address space also counts what the worker maps without using it as memory: the interpreter and the imported libraries (the address space in use when the cap is set), 
+    the memory-mapped files of the task (e.g., the runs in the BOLD cache) and the thread stacks. These are added on top of mem_per_worker.
+    Only the soft limit is set, so the cap can be set again for every task of the worker.
+
+    Args
+        mem_per_worker: memory cap in bytes (None for no cap)
+        mapped_bytes: bytes of the files memory-mapped by the task (e.g., see bold_cache.mapped_bytes)
+        n_threads: number of threads of the worker (see limit_worker_threads)
+    '''
+    if mem_per_worker is None:
+        return
+
+    import resource # only available on unix
+
+    # address space in use (first field of /proc/self/statm, in pages)
+    try:
+        with open("/proc/self/statm") as f:
+            in_use = int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError): # /proc is not available on all platforms
+        in_use = 0
+
+    limit = in_use + mem_per_worker + mapped_bytes + n_threads * THREAD_STACK_BYTES
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+def limit_worker_threads(n_threads:int=1):
+    '''
+    Limit the BLAS/OpenMP threads of a worker process (initializer for process pools, also set in the environment for processes it starts).
+
+    Args
+        n_threads: number of threads per worker
+    '''
+    from threadpoolctl import threadpool_limits # installed with scikit-learn
+
+    for variable in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]:
+        os.environ[variable] = str(n_threads)
+
+    threadpool_limits(limits=n_threads)
+
+def init_worker(mem_per_worker=None, n_threads:int=1):
+    '''
+    Initializer of the process pools: limit the BLAS/OpenMP threads and cap the memory of the worker.
+
+    Args
+        mem_per_worker: memory cap in bytes (None for no cap, see limit_worker_memory)
+        n_threads: number of threads per worker
+    '''
+    limit_worker_threads(n_threads)
+    limit_worker_memory(mem_per_worker, n_threads=n_threads)
@@ -0,0 +1,8 @@
+'''
+The modules in src (and src/searchlight) are scripts, not a package, so they are imported from their folders.
+'''
+import pathlib
+import sys
+
+src_path = pathlib.Path(__file__).parents[1] / "src"
+sys.path[:0] = [str(src_path), str(src_path / "searchlight")]
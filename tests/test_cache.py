@@ -0,0 +1,79 @@
+'''
+Eviction of the on-disk caches while other threads and processes use them.
+'''
+import threading
+from multiprocessing import Process
+
+import numpy as np
+import nibabel as nib
+
+from cache import evict_lru, hash_file, entry_size
+from bold_cache import cached_bold, release_runs
+
+def fill_cache(cache_dir, inputs_path, n_entries=100):
+    # file entries, folder entries and memoized file hashes
+    for i in range(n_entries):
+        (cache_dir / f"e{i}.pkl").write_bytes(b"x" * 1000)
+
+        folder = cache_dir / f"dir{i}"
+        folder.mkdir()
+        (folder / "data.npy").write_bytes(b"y" * 1000)
+
+        input_file = inputs_path / f"input_{i}"
+        input_file.write_bytes(b"z")
+        hash_file(input_file, memo_dir=cache_dir)
+
+def test_evict_lru_concurrent(tmp_path):
+    cache_dir, inputs_path = tmp_path / "cache", tmp_path / "inputs"
+    cache_dir.mkdir()
+    inputs_path.mkdir()
+    fill_cache(cache_dir, inputs_path)
+
+    errors = []
+
+    def evict():
+        try:
+            for _ in range(10):
+                evict_lru(cache_dir, 50_000)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=evict) for _ in range(4)]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+
+    assert errors == []
+    assert sum(entry_size(entry) for entry in cache_dir.iterdir() if not entry.name.startswith(".")) <= 50_000
+
+def test_pinned_entry_is_not_evicted(tmp_path):
+    rng = np.random.default_rng(0)
+    affine = np.diag([3.0, 3.0, 3.0, 1.0])
+    shape = (7, 8, 9, 12)
+
+    bold_path = tmp_path / "sub-0116_run-1_bold.nii.gz"
+    nib.save(nib.Nifti1Image(rng.normal(size=shape).astype(np.float32), affine), bold_path)
+
+    mask = np.zeros(shape[:3], dtype=np.uint8)
+    mask[1:6, 2:7, 1:8] = 1
+
+    img = cached_bold(bold_path, nib.Nifti1Image(mask, affine), tmp_path / "bold")
+    entry_path = img.dataobj.entry_path
+
+    # the cached run equals the run within the mask, also when only a part of it is read
+    expected = np.asarray(nib.load(bold_path).dataobj) * (mask[..., None] != 0)
+    np.testing.assert_array_equal(img.get_fdata(), expected)
+    np.testing.assert_array_equal(img.dataobj[..., 3], expected[..., 3])
+    np.testing.assert_array_equal(img.dataobj[2, 1:5, ::2, -1], expected[2, 1:5, ::2, -1])
+
+    # another process cannot evict the entry while it is pinned
+    evictor = Process(target=evict_lru, args=(tmp_path / "bold", 0))
+    evictor.start()
+    evictor.join()
+    assert entry_path.exists()
+
+    release_runs([img])
+
+    evictor = Process(target=evict_lru, args=(tmp_path / "bold", 0))
+    evictor.start()
+    evictor.join()
+    assert not entry_path.exists()
@@ -0,0 +1,116 @@
+'''
+The GaussianNB searchlight engine against nilearn's SearchLight, and the chunk locks of checkpointed searchlights.
+'''
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import nibabel as nib
+import pytest
+from nilearn.decoding import SearchLight
+from sklearn.naive_bayes import GaussianNB
+
+import engine
+from permutation import find_most_important_voxels
+from samples import save_samples, samples_mask_img, samples_process_mask_img
+
+@pytest.fixture(scope="module")
+def data():
+    # informative voxels in a small block of a random volume series
+    rng = np.random.default_rng(1)
+    shape, n_samples = (10, 11, 9), 60
+
+    affine = np.diag([3.0, 3.0, 3.0, 1.0])
+    affine[:3, 3] = [-10, -12, -8]
+
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[2:8, 2:9, 2:7] = 1
+
+    y = np.array(["P", "N"] * (n_samples // 2))
+    volumes = rng.normal(0, 1, shape + (n_samples,))
+    volumes[3:6, 3:6, 3:5, :] += (y == "P") * 0.8
+
+    return nib.Nifti1Image(mask, affine), nib.Nifti1Image(volumes, affine), y
+
+def test_gnb_searchlight(data):
+    mask_img, imgs, y = data
+
+    searchlight = SearchLight(mask_img, estimator=GaussianNB(), radius=5, cv=3, n_jobs=1).fit(imgs, y)
+
+    np.testing.assert_allclose(engine.gnb_searchlight(mask_img, imgs, y, radius=5, cv=3), searchlight.scores_, atol=1e-10)
+
+def test_neighbourhood_cache(data, tmp_path):
+    mask_img, imgs, y = data
+
+    first = engine.gnb_searchlight(mask_img, imgs, y, cache_dir=tmp_path)
+    cached = engine.gnb_searchlight(mask_img, imgs, y, cache_dir=tmp_path)
+
+    np.testing.assert_array_equal(first, cached)
+
+def test_most_important_voxels(data):
+    mask_img, imgs, y = data
+
+    # tied scores at the cutoff still select exactly n_voxels
+    scores = np.round(engine.gnb_searchlight(mask_img, imgs, y), 1)
+
+    process_mask_img, cut = find_most_important_voxels(scores, mask_img, n_voxels=20)
+    process_mask = process_mask_img.get_fdata() != 0
+
+    assert process_mask.sum() == 20
+    assert scores[process_mask].min() == cut and scores[(mask_img.get_fdata() != 0) & ~process_mask].max() <= cut
+
+def test_anatomical_sphere_centres(data, tmp_path):
+    mask_img, imgs, y = data
+
+    # whole brain mask on a finer grid than the beta maps (as the anatomical mask): the sphere centres are its voxels
+    fine_affine = mask_img.affine.copy()
+    fine_affine[:3, :3] /= 2
+    fine_mask = np.zeros((20, 22, 18), dtype=np.uint8)
+    fine_mask[5:15, 5:17, 5:13] = 1
+    fine_mask_img = nib.Nifti1Image(fine_mask, fine_affine)
+
+    samples = save_samples(imgs, np.arange(len(y)), y, fine_mask_img, {"pos_neg": (np.arange(len(y)), [])}, tmp_path)
+    scores = engine.gnb_searchlight(samples_mask_img(samples), samples["X"], y, process_mask_img=samples_process_mask_img(samples))
+
+    searchlight = SearchLight(fine_mask_img, estimator=GaussianNB(), radius=5, cv=3, n_jobs=1).fit(imgs, y)
+
+    np.testing.assert_allclose(scores, searchlight.scores_, atol=1e-6)
+
+def test_checkpoint_resume(data, tmp_path):
+    mask_img, imgs, y = data
+    checkpoint_path = tmp_path / "checkpoint"
+
+    # chunk 1 is held by a live process on another host, so the first run stops with the other chunks done
+    (checkpoint_path / "chunks").mkdir(parents=True)
+    (checkpoint_path / "chunks" / "1.lock-0").write_text(json.dumps({"host": "other", "pid": 1, "time": 0}))
+
+    assert engine.checkpointed_gnb_searchlight(mask_img, imgs, y, checkpoint_path, chunk_size=50) is None
+
+    # the lock times out and the run resumes from the saved chunks
+    os.utime(checkpoint_path / "chunks" / "1.lock-0", (0, 0))
+    scores = engine.checkpointed_gnb_searchlight(mask_img, imgs, y, checkpoint_path, chunk_size=50, lock_timeout=60)
+
+    np.testing.assert_array_equal(scores, engine.gnb_searchlight(mask_img, imgs, y))
+
+def claim_and_hold(chunks_path):
+    # the winner keeps running while the others try, so its pid is not reused
+    won = engine.claim_chunk(chunks_path, 0, lock_timeout=60) is not None
+    time.sleep(0.5 if won else 0)
+
+    return won
+
+def test_claim_chunk_concurrent_takeover(tmp_path):
+    for trial in range(5):
+        # stale lock (older than the timeout)
+        (tmp_path / "0.lock-0").write_text(json.dumps({"host": "other", "pid": 1, "time": trial}))
+        os.utime(tmp_path / "0.lock-0", (0, 0))
+
+        with Pool(8, maxtasksperchild=1) as pool:
+            assert sum(pool.map(claim_and_hold, [tmp_path] * 8)) == 1
+
+        assert len(list(tmp_path.glob("0.lock-*"))) == 1
+
+        for lock_file in tmp_path.iterdir():
+            lock_file.unlink()
@@ -0,0 +1,62 @@
+'''
+Contrasts computed from the model store against FirstLevelModel.compute_contrast.
+'''
+import numpy as np
+import nibabel as nib
+import pandas as pd
+import pytest
+from nilearn.glm.first_level import FirstLevelModel
+
+import flm_store
+from group_ols import stack_effect_maps
+
+AFFINE = np.diag([3.0, 3.0, 3.0, 1.0])
+
+@pytest.fixture(scope="module")
+def flm():
+    # two runs, so the contrasts are fixed effects over the runs
+    rng = np.random.default_rng(0)
+    shape, n_scans = (6, 7, 5), 80
+
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[1:5, 1:6, 1:4] = 1
+
+    onsets = np.arange(5, 150, 10.0)
+    events = pd.DataFrame({"onset": onsets, "duration": 1.0, "trial_type": ["a", "b"] * (len(onsets) // 2) + ["a"] * (len(onsets) % 2)})
+    imgs = [nib.Nifti1Image(rng.normal(100, 5, shape + (n_scans,)).astype(np.float32), AFFINE) for _ in range(2)]
+
+    return FirstLevelModel(t_r=2, noise_model="ar1", mask_img=nib.Nifti1Image(mask, AFFINE), minimize_memory=True).fit(imgs, [events, events])
+
+@pytest.mark.parametrize("output_type", ["effect_size", "effect_variance", "stat", "z_score"])
+def test_compute_store_contrast(flm, output_type, tmp_path):
+    flm_store.save_flm_store(flm, "0001", tmp_path)
+    store = flm_store.open_flm_store(tmp_path, "0001")
+
+    expected = flm.compute_contrast("a - b", output_type=output_type).get_fdata()
+    values = flm_store.store_to_img(store, flm_store.compute_store_contrast(store, "a - b", output_type)).get_fdata()
+
+    np.testing.assert_allclose(values, expected, rtol=1e-4, atol=1e-4)
+
+def test_cached_contrast(flm, tmp_path):
+    flm_store.save_flm_store(flm, "0001", tmp_path)
+    store = flm_store.open_flm_store(tmp_path, "0001")
+
+    flm_store.cache_contrasts(store, ["a - b"])
+
+    np.testing.assert_allclose(flm_store.load_contrast(store, "a - b", "z_score"), flm_store.compute_store_contrast(store, "a - b", "z_score"), rtol=1e-5, atol=1e-6)
+
+def test_smoothed_contrast_outside_mask(flm, tmp_path, monkeypatch):
+    flm_store.save_flm_store(flm, "0001", tmp_path)
+    store = flm_store.open_flm_store(tmp_path, "0001")
+    flm_store.cache_smoothed_contrasts(store, ["a - b"], fwhm=6.0)
+
+    # expected: the whole volume smoothed (zero outside the mask of the subject)
+    volume = np.zeros(int(np.prod(store["shape"])), dtype=np.float32)
+    volume[flm_store.load_store_array(store, "mask")] = flm_store.load_contrast(store, "a - b", "effect_size")
+    expected = flm_store.smooth_volumes(volume.reshape(1, *store["shape"]), AFFINE, 6.0).ravel()
+
+    # a mask reaching outside the mask of the subject is read from the cache without smoothing again
+    monkeypatch.setattr(flm_store, "smooth_volumes", None)
+    union = {"voxels": np.arange(int(np.prod(store["shape"]))), "shape": store["shape"], "affine": store["affine"]}
+
+    np.testing.assert_allclose(stack_effect_maps(tmp_path, "a - b", ["0001"], union, smoothing_fwhm=6.0)[0], expected, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,89 @@
+'''
+The in-house group OLS engine (on stacked maps and from the sufficient statistics) against SecondLevelModel.
+'''
+import numpy as np
+import nibabel as nib
+import pandas as pd
+import pytest
+from nilearn.glm.second_level import SecondLevelModel
+
+from group_ols import fit_ols, compute_group_contrasts, group_stats, add_subject, remove_subject, fit_group_stats, leave_one_subject_out, save_group_stats, load_group_stats
+
+AFFINE = np.diag([3.0, 3.0, 3.0, 1.0])
+CONTRASTS = {"intercept": "intercept", "age": "age", "difference": [1, -1]}
+
+@pytest.fixture(scope="module")
+def group():
+    rng = np.random.default_rng(0)
+    shape, n_subjects = (8, 9, 7), 12
+
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[1:7, 2:8, 1:6] = 1
+
+    imgs = [nib.Nifti1Image((rng.normal(0.3, 1, shape) * mask).astype(np.float32), AFFINE) for _ in range(n_subjects)]
+    design_matrix = pd.DataFrame({"intercept": np.ones(n_subjects), "age": rng.normal(size=n_subjects)})
+
+    Y = np.stack([img.get_fdata()[mask != 0] for img in imgs]).astype(np.float32)
+
+    return nib.Nifti1Image(mask, AFFINE), imgs, design_matrix, Y
+
+def expected_maps(group, output_type):
+    mask_img, imgs, design_matrix, Y = group
+    model = SecondLevelModel(mask_img=mask_img).fit(imgs, design_matrix=design_matrix)
+
+    return {name: model.compute_contrast(contrast, output_type=output_type).get_fdata()[mask_img.get_fdata() != 0] for name, contrast in CONTRASTS.items()}
+
+@pytest.mark.parametrize("output_type", ["effect_size", "stat", "z_score"])
+def test_fit_ols(group, output_type):
+    mask_img, imgs, design_matrix, Y = group
+
+    maps = compute_group_contrasts(fit_ols(Y, design_matrix, voxel_chunk=50), CONTRASTS, output_types=[output_type])
+
+    for name, expected in expected_maps(group, output_type).items():
+        np.testing.assert_allclose(maps[name][output_type], expected, rtol=1e-4, atol=1e-4)
+
+def test_fit_group_stats(group):
+    mask_img, imgs, design_matrix, Y = group
+
+    stats = group_stats(Y.shape[1], columns=list(design_matrix.columns))
+    for row, y in enumerate(Y):
+        stats = add_subject(stats, f"{row:04d}", y, design_matrix.iloc[row].to_numpy())
+
+    maps = compute_group_contrasts(fit_group_stats(stats), CONTRASTS, output_types=["stat"])
+
+    for name, expected in expected_maps(group, "stat").items():
+        np.testing.assert_allclose(maps[name]["stat"], expected, rtol=1e-3, atol=1e-3)
+
+def test_remove_subject_and_leave_one_out(group):
+    mask_img, imgs, design_matrix, Y = group
+    subjects = [f"{row:04d}" for row in range(len(Y))]
+
+    stats = group_stats(Y.shape[1])
+    for subject, y in zip(subjects, Y):
+        stats = add_subject(stats, subject, y)
+
+    # removing a subject gives the fit of the other subjects
+    expected = compute_group_contrasts(fit_ols(Y[1:]), {"intercept": "intercept"}, ["stat"])["intercept"]["stat"]
+    removed = compute_group_contrasts(fit_group_stats(remove_subject(stats, subjects[0], Y[0])), {"intercept": "intercept"}, ["stat"])["intercept"]["stat"]
+    np.testing.assert_allclose(removed, expected, rtol=1e-3, atol=1e-4)
+
+    loso = leave_one_subject_out(stats, Y, subjects, output_types=["stat"])
+    np.testing.assert_allclose(loso[subjects[0]]["intercept"]["stat"], expected, rtol=1e-3, atol=1e-4)
+
+def test_save_load_group_stats(group, tmp_path):
+    mask_img, imgs, design_matrix, Y = group
+
+    stats = group_stats(Y.shape[1])
+    for row, y in enumerate(Y):
+        stats = add_subject(stats, f"{row:04d}", y)
+
+    save_group_stats(stats, tmp_path, voxels=np.arange(Y.shape[1]), versions={"0000": "key"})
+    save_group_stats(remove_subject(stats, "0000", Y[0]), tmp_path, voxels=np.arange(Y.shape[1]))
+
+    loaded, voxels, versions = load_group_stats(tmp_path)
+
+    # only the arrays of the last save are kept
+    assert len(list(tmp_path.glob("*.npy"))) == 3
+    assert list(loaded["subjects"]) == [f"{row:04d}" for row in range(1, len(Y))] and versions == {}
+    np.testing.assert_allclose(loaded["XtY"], remove_subject(stats, "0000", Y[0])["XtY"])
+    np.testing.assert_array_equal(voxels, np.arange(Y.shape[1]))
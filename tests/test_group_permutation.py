@@ -0,0 +1,60 @@
+'''
+Sign-flip permutation inference on synthetic data.
+'''
+import itertools
+
+import numpy as np
+import pytest
+
+from group_permutation import sign_flips, flipped_t, sign_flip_inference
+
+def test_sign_flips():
+    # few subjects: all sign flips, the original data first
+    flips = sign_flips(6, n_permutations=100)
+    assert flips.shape == (64, 6) and len({tuple(row) for row in flips}) == 64 and (flips[0] == 1).all()
+
+    # many subjects: random sign flips
+    flips = sign_flips(20, n_permutations=100, random_state=0)
+    assert flips.shape == (101, 20) and (flips[0] == 1).all()
+
+def test_flipped_t():
+    rng = np.random.default_rng(0)
+    Y = rng.normal(size=(8, 30)).astype(np.float32)
+    flips = sign_flips(8, n_permutations=10, random_state=0)
+
+    # one sample t test of the flipped maps
+    flipped = flips[:, :, None] * Y[None]
+    expected = flipped.mean(axis=1) / (flipped.std(axis=1, ddof=1) / np.sqrt(8))
+
+    np.testing.assert_allclose(flipped_t(Y, flips), expected, rtol=1e-4)
+
+@pytest.fixture(scope="module")
+def inference():
+    # effect in a block of the volume
+    rng = np.random.default_rng(0)
+    shape, n_subjects = (8, 8, 6), 8
+
+    effect = np.zeros(shape, dtype=np.float32)
+    effect[2:5, 2:5, 1:4] = 3.0
+
+    mask = {"voxels": np.arange(np.prod(shape)), "shape": shape}
+    Y = (rng.normal(size=(n_subjects,) + shape) + effect).reshape(n_subjects, -1).astype(np.float32)
+
+    return Y, effect.ravel() > 0, sign_flip_inference(Y, mask, n_permutations=1000, n_steps=20, chunk_size=32, n_jobs=2)
+
+def test_exact_voxel_pvalues(inference):
+    Y, effect, results = inference
+
+    # all 2^8 sign flips are used, so the max t p-values are exact
+    null_max = np.abs(flipped_t(Y, np.array(list(itertools.product([-1, 1], repeat=len(Y))), dtype=np.float32))).max(axis=1)
+    expected = [(null_max >= abs(t) * (1 - 1e-6)).mean() for t in results["t"]]
+
+    assert len(results["null_max_t"]) == 2 ** len(Y)
+    np.testing.assert_allclose(results["p_voxel_fwe"], expected)
+
+def test_tfce_detects_effect(inference):
+    Y, effect, results = inference
+
+    assert np.median(results["p_tfce_fwe"][effect]) < 0.05
+    assert (results["p_tfce_fwe"][~effect] < 0.05).mean() < 0.05
+    assert results["p_cluster_fwe"][effect].min() < 0.05
@@ -0,0 +1,51 @@
+'''
+Round trips of tables through the columnar cache.
+'''
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ingest import read_table
+
+@pytest.fixture
+def table(tmp_path):
+    # numbers with missing values, text with missing values, and names that only differ in characters that are not allowed in file names
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        "onset": np.arange(20) * 2.0,
+        "RT": np.where(rng.random(20) < 0.3, np.nan, rng.random(20)),
+        "trial_type": ["IMG_PS", "IMG_BI", None, "IMG_NO"] * 5,
+        "count": np.arange(20),
+        "a/b": rng.normal(size=20),
+        "a_b": rng.normal(size=20),
+        "mixed": [1, "x"] * 10,
+    })
+
+    path = tmp_path / "sub-0116_task-boldinnerspeech_run-1_events.tsv"
+    df.to_csv(path, sep="\t", index=False)
+
+    return path
+
+def test_read_table_round_trip(table, tmp_path):
+    columns = ["trial_type", "onset", "RT", "count", "a/b", "a_b", "mixed"]
+    expected = read_table(table, columns)
+
+    # parsed and cached, then read from the cache
+    for _ in range(2):
+        pd.testing.assert_frame_equal(read_table(table, columns, cache_dir=tmp_path / "cache"), expected)
+
+    # a subset of the cached columns
+    pd.testing.assert_frame_equal(read_table(table, ["RT", "onset"], cache_dir=tmp_path / "cache"), expected[["RT", "onset"]])
+
+def test_read_table_changed_file(table, tmp_path):
+    read_table(table, ["onset"], cache_dir=tmp_path / "cache")
+
+    # the file changes (new content and modification time), so the cached columns are outdated
+    time.sleep(0.01)
+    df = pd.read_csv(table, sep="\t")
+    df.loc[0, "onset"] = 99.0
+    df.to_csv(table, sep="\t", index=False)
+
+    assert read_table(table, ["onset"], cache_dir=tmp_path / "cache")["onset"][0] == 99.0
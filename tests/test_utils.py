@@ -0,0 +1,43 @@
+'''
+Lazy loading of the subject dictionaries and streaming intersection of stored masks.
+'''
+import numpy as np
+import nibabel as nib
+
+from utils import LazyDict, load_masks
+from masks import intersect_mask_stores, save_mask_store
+
+def test_lazy_dict_loads_on_access():
+    calls = []
+    loaders = {subject_id: (lambda subject_id=subject_id: calls.append(subject_id) or subject_id * 2) for subject_id in ["a", "b", "c"]}
+    lazy = LazyDict(loaders, max_loaded=1, prefetch=False)
+
+    assert calls == []
+    assert lazy["b"] == "bb"
+    assert list(lazy) == ["a", "b", "c"]
+
+    # only max_loaded objects are kept in memory
+    assert dict(lazy.items()) == {"a": "aa", "b": "bb", "c": "cc"}
+    assert list(lazy.loaded) == ["c"]
+
+    del lazy["a"]
+    lazy["d"] = "dd"
+    assert list(lazy) == ["b", "c", "d"] and len(lazy) == 3
+
+def test_lazy_dict_prefetch():
+    lazy = LazyDict({subject_id: (lambda subject_id=subject_id: subject_id) for subject_id in ["a", "b"]})
+
+    assert lazy["a"] == "a"
+    assert "b" in lazy.pending
+    assert lazy["b"] == "b" and not lazy.pending
+
+def test_intersect_lazy_mask_stores(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.random((3, 5, 6, 7)) > 0.5
+
+    for i, mask in enumerate(data):
+        save_mask_store(nib.Nifti1Image(mask.astype(np.uint8), np.eye(4)), f"sub-{i}", tmp_path)
+
+    for threshold, expected in [(1, data.all(axis=0)), (0, data.any(axis=0)), (0.5, data.sum(axis=0) > 1.5)]:
+        mask = intersect_mask_stores(load_masks(tmp_path, as_store=True).values(), threshold=threshold)
+        assert np.array_equal(mask["voxels"], np.flatnonzero(expected))
@@ -0,0 +1,45 @@
+'''
+Memory cap of the worker processes with memory-mapped files.
+'''
+from multiprocessing import get_context
+
+import numpy as np
+
+from workers import limit_worker_memory
+
+MB = 1024**2
+
+def map_and_allocate(path, mapped_bytes, queue):
+    limit_worker_memory(64 * MB, mapped_bytes=mapped_bytes)
+
+    try:
+        data = np.load(path, mmap_mode="r")
+        mapped = bool(data[::4096].sum() == 0)
+    except (MemoryError, OSError):
+        mapped = False
+
+    try:
+        np.ones(256 * MB, dtype=np.uint8)
+        allocated = True
+    except MemoryError:
+        allocated = False
+
+    queue.put((mapped, allocated))
+
+def run_worker(path, mapped_bytes):
+    context = get_context("fork")
+    queue = context.Queue()
+    process = context.Process(target=map_and_allocate, args=(path, mapped_bytes, queue))
+    process.start()
+    result = queue.get(timeout=60)
+    process.join()
+
+    return result
+
+def test_mapped_files_are_budgeted(tmp_path):
+    path = tmp_path / "data.npy"
+    np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(64 * MB,)).flush()
+
+    # the memory-mapped file (256 MB) only fits in the cap if it is budgeted, allocations above the cap still fail
+    assert run_worker(path, mapped_bytes=0) == (False, False)
+    assert run_worker(path, mapped_bytes=256 * MB) == (True, False)